@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+from collections import Counter
+import os
+
+import nibabel as nib
+import numpy as np
+
+from tractconverter.formats.tck import TCK
+
+from challenge_scoring.utils.filenames import mkdir
+from challenge_scoring.utils.json_formatter import load_dict_from_json_file, \
+                                                   save_dict_to_json_file
+
+
+# Default geometry of the phantom, close to the one of the challenge data.
+VOLUME_SHAPE = (90, 108, 90)
+VOXEL_SIZE = 2.
+
+# Radius of the ROIs, in voxels.
+ROI_RADIUS = 3.
+
+# Minimal distance between the two ROIs of a bundle, in voxels. Always
+# longer than the minimal length of the candidate IC.
+MIN_BUNDLE_DISTANCE = 30.
+
+PHANTOM_INFO_FNAME = 'phantom_info.json'
+
+
+def get_phantom_affine(shape=VOLUME_SHAPE, voxel_size=VOXEL_SIZE):
+    # Isotropic voxels, with the center of the volume at the origin.
+    affine = np.diag([voxel_size] * 3 + [1.])
+    affine[:3, 3] = -np.array(shape) * voxel_size / 2.
+    return affine
+
+
+def _random_in_ball(rng, nb, radius):
+    directions = rng.normal(size=(nb, 3))
+    directions /= np.sqrt(np.sum(directions ** 2, axis=1))[:, None]
+    return directions * radius * rng.uniform(size=(nb, 1)) ** (1 / 3.)
+
+
+def _generate_curves(heads, tails, controls, nb_points, shape):
+    # Quadratic Bezier curves from heads to tails, all with nb_points points,
+    # in voxel space aligned as expected by dipy.
+    t = np.linspace(0., 1., nb_points)[None, :, None]
+    curves = (1 - t) ** 2 * heads[:, None] + \
+        2 * (1 - t) * t * controls[:, None] + \
+        t ** 2 * tails[:, None]
+
+    return np.clip(curves, 0, np.array(shape) - 1).astype('f4')
+
+
+def _get_nb_points(heads, tails, controls, voxel_size, step_size):
+    length = np.sqrt(np.sum((controls - heads) ** 2, axis=-1)) + \
+        np.sqrt(np.sum((tails - controls) ** 2, axis=-1))
+    return np.maximum(np.ceil(length * voxel_size / step_size), 1).astype(int) + 1
+
+
+def _generate_bundle(rng, bundle, nb, info, endpoint_radius, control_noise,
+                     step_size):
+    head = np.array(bundle['head'])
+    tail = np.array(bundle['tail'])
+    control = np.array(bundle['control'])
+
+    nb_points = _get_nb_points(head, tail, control,
+                               info['voxel_size'], step_size)
+    heads = head + _random_in_ball(rng, nb, endpoint_radius)
+    tails = tail + _random_in_ball(rng, nb, endpoint_radius)
+    controls = control + rng.normal(scale=control_noise, size=(nb, 3))
+
+    return _generate_curves(heads, tails, controls, nb_points,
+                            info['shape'])
+
+
+def _to_world(curves, affine):
+    return np.dot(curves, affine[:3, :3].T.astype('f4')) + \
+        affine[:3, 3].astype('f4')
+
+
+def generate_phantom(out_dir, nb_bundles=10, nb_gt_streamlines=200,
+                     shape=VOLUME_SHAPE, voxel_size=VOXEL_SIZE,
+                     step_size=1., cluster_threshold=7., seed=0):
+    """
+    Generate a synthetic scoring data directory.
+
+    The directory has the same layout as the challenge scoring data:
+    bundles/*.tck, masks/rois/*.nii.gz, masks/bundles/*.nii.gz, masks/wm.nii.gz
+    and gt_bundles_attributes.json. Each GT bundle is a set of curved
+    streamlines connecting its own pair of spherical ROIs.
+
+    Parameters
+    ------------
+    out_dir : string
+        directory where the scoring data is created.
+    nb_bundles : int
+        number of GT bundles. Two ROIs are created for each bundle.
+    nb_gt_streamlines : int
+        number of streamlines of each GT bundle.
+    shape : tuple
+        shape of the volume.
+    voxel_size : float
+        isotropic voxel size, in mm.
+    step_size : float
+        distance between the points of the streamlines, in mm.
+    cluster_threshold : float
+        cluster_threshold attribute of all bundles.
+    seed : int
+        seed of the random generator.
+
+    Returns
+    ---------
+    info : dict
+        description of the phantom, also saved to phantom_info.json. Needed
+        to generate submissions, see generate_submission.
+    """
+    rng = np.random.RandomState(seed)
+    affine = get_phantom_affine(shape, voxel_size)
+    margin = ROI_RADIUS + 2
+    low = np.array([margin] * 3)
+    high = np.array(shape) - 1 - margin
+
+    # Place the ROIs two at a time, far enough from each other.
+    centers = []
+    nb_tries = 0
+    while len(centers) < 2 * nb_bundles:
+        nb_tries += 1
+        if nb_tries > 100000:
+            raise ValueError('Could not place {0} bundles in the '
+                             'volume.'.format(nb_bundles))
+
+        head = rng.uniform(low, high)
+        tail = rng.uniform(low, high)
+        if np.sqrt(np.sum((head - tail) ** 2)) < MIN_BUNDLE_DISTANCE:
+            continue
+        if any(np.sqrt(np.sum((c - p) ** 2)) < 2 * ROI_RADIUS + 2
+               for c in centers for p in (head, tail)):
+            continue
+        centers.extend([head, tail])
+
+    info = {'shape': list(shape),
+            'voxel_size': voxel_size,
+            'affine': affine.tolist(),
+            'step_size': step_size,
+            'seed': seed,
+            'rois': [],
+            'bundles': []}
+
+    for roi_idx, center in enumerate(centers):
+        info['rois'].append({'name': 'roi_{0:02d}'.format(roi_idx),
+                             'center': center.tolist()})
+
+    for bundle_idx in range(nb_bundles):
+        head = centers[2 * bundle_idx]
+        tail = centers[2 * bundle_idx + 1]
+
+        # Bend the bundle in a random direction perpendicular to it.
+        axis = (tail - head) / np.sqrt(np.sum((tail - head) ** 2))
+        bend = rng.normal(size=3)
+        bend -= np.dot(bend, axis) * axis
+        bend /= np.sqrt(np.sum(bend ** 2))
+        control = (head + tail) / 2. + bend * rng.uniform(0., 0.3) * \
+            np.sqrt(np.sum((tail - head) ** 2))
+        control = np.clip(control, low, high)
+
+        info['bundles'].append({'name': 'bundle_{0:02d}'.format(bundle_idx),
+                                'rois': [2 * bundle_idx, 2 * bundle_idx + 1],
+                                'head': head.tolist(),
+                                'tail': tail.tolist(),
+                                'control': control.tolist()})
+
+    bundles_dir = mkdir(os.path.join(out_dir, 'bundles'))
+    rois_dir = mkdir(os.path.join(out_dir, 'masks', 'rois'))
+    bundles_masks_dir = mkdir(os.path.join(out_dir, 'masks', 'bundles'))
+
+    grid = np.indices(shape).reshape((3, -1)).T
+    wm = np.zeros(shape, dtype=np.uint8)
+
+    for roi in info['rois']:
+        dists = np.sqrt(np.sum((grid - roi['center']) ** 2, axis=1))
+        roi_data = (dists <= ROI_RADIUS).reshape(shape).astype(np.uint8)
+        wm |= roi_data
+        nib.save(nib.Nifti1Image(roi_data, affine),
+                 os.path.join(rois_dir, roi['name'] + '.nii.gz'))
+
+    attribs = {}
+    for bundle in info['bundles']:
+        curves = _generate_bundle(rng, bundle, nb_gt_streamlines, info,
+                                  ROI_RADIUS - 1, 1., step_size)
+
+        tck = TCK.create(os.path.join(bundles_dir, bundle['name'] + '.tck'))
+        tck += list(_to_world(curves, affine))
+
+        # The mask contains every voxel reached by a GT streamline.
+        voxels = np.round(curves.reshape((-1, 3))).astype(int)
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = 1
+        wm |= mask
+        nib.save(nib.Nifti1Image(mask, affine),
+                 os.path.join(bundles_masks_dir, bundle['name'] + '.nii.gz'))
+
+        attribs[bundle['name'] + '.tck'] = \
+            {'cluster_threshold': cluster_threshold}
+
+    nib.save(nib.Nifti1Image(wm, affine),
+             os.path.join(out_dir, 'masks', 'wm.nii.gz'))
+    save_dict_to_json_file(os.path.join(out_dir, 'gt_bundles_attributes.json'),
+                           attribs)
+    save_dict_to_json_file(os.path.join(out_dir, PHANTOM_INFO_FNAME), info)
+
+    return info
+
+
+def load_phantom_info(phantom_dir):
+    return load_dict_from_json_file(os.path.join(phantom_dir,
+                                                 PHANTOM_INFO_FNAME))
+
+
+def _generate_block(rng, info, nb_streamlines, vc_ratio, ic_ratio,
+                    step_size):
+    bundles = info['bundles']
+    centers = np.array([roi['center'] for roi in info['rois']])
+    shape = np.array(info['shape'])
+    bundles_pairs = set(tuple(sorted(b['rois'])) for b in bundles)
+
+    nb_vc, nb_ic, nb_nc = rng.multinomial(
+        nb_streamlines, [vc_ratio, ic_ratio, 1. - vc_ratio - ic_ratio])
+
+    curves = []
+
+    # VC are generated like the GT bundles, with more noise.
+    for bundle, nb in zip(bundles,
+                          rng.multinomial(nb_vc, [1. / len(bundles)] *
+                                          len(bundles))):
+        if nb:
+            curves.extend(_generate_bundle(rng, bundle, nb, info,
+                                           ROI_RADIUS, 1.5, step_size))
+
+    # IC connect pairs of ROIs that are not connected by a GT bundle.
+    pairs = rng.randint(0, len(centers), size=(nb_ic, 2))
+    pairs = [p for p in map(tuple, np.sort(pairs, axis=1))
+             if p[0] != p[1] and p not in bundles_pairs]
+    for pair, nb in sorted(Counter(pairs).items()):
+        head, tail = centers[pair[0]], centers[pair[1]]
+        controls = (head + tail) / 2. + rng.normal(scale=5., size=(1, 3))
+        controls = controls + rng.normal(scale=1.5, size=(nb, 3))
+        heads = head + _random_in_ball(rng, nb, ROI_RADIUS)
+        tails = tail + _random_in_ball(rng, nb, ROI_RADIUS)
+        nb_points = _get_nb_points(head, tail, controls[0],
+                                   info['voxel_size'], step_size)
+        curves.extend(_generate_curves(heads, tails, controls,
+                                       nb_points, shape))
+
+    # NC are mostly short, slightly curved streamlines anywhere in the
+    # volume. Rejected IC pairs are added to them.
+    nb_nc += nb_ic - len(pairs)
+    lengths = rng.uniform(5., 50., size=nb_nc) / info['voxel_size']
+    all_nb_points = np.maximum(np.ceil(lengths * info['voxel_size'] /
+                                       step_size), 1).astype(int) + 1
+    for nb_points in np.unique(all_nb_points):
+        group_lengths = lengths[all_nb_points == nb_points][:, None]
+        nb = len(group_lengths)
+        heads = rng.uniform(0, shape - 1, size=(nb, 3))
+        directions = rng.normal(size=(nb, 3))
+        directions /= np.sqrt(np.sum(directions ** 2, axis=1))[:, None]
+        tails = heads + directions * group_lengths
+        controls = (heads + tails) / 2. + \
+            rng.normal(scale=0.1, size=(nb, 3)) * group_lengths
+        curves.extend(_generate_curves(heads, tails, controls,
+                                       nb_points, shape))
+
+    return [curves[i] for i in rng.permutation(len(curves))]
+
+
+def generate_submission(out_fname, info, nb_streamlines, vc_ratio=0.4,
+                        ic_ratio=0.3, step_size=None, seed=0,
+                        block_size=10000):
+    """
+    Generate a synthetic submission for a phantom, as a TCK file.
+
+    Streamlines are generated and written by blocks, so any number of
+    streamlines can be generated with a bounded amount of memory.
+
+    Parameters
+    ------------
+    out_fname : string
+        path of the TCK file to create.
+    info : dict
+        description of the phantom, as returned by generate_phantom.
+    nb_streamlines : int
+        number of streamlines of the submission.
+    vc_ratio : float
+        approximate ratio of streamlines following a GT bundle.
+    ic_ratio : float
+        approximate ratio of streamlines connecting two ROIs that are not
+        connected by a GT bundle. Other streamlines are too short or do not
+        connect any ROI.
+    step_size : float
+        distance between the points of the streamlines, in mm. Uses the
+        step size of the phantom when None.
+    seed : int
+        seed of the random generator.
+    block_size : int
+        number of streamlines generated and written at once.
+    """
+    if step_size is None:
+        step_size = info['step_size']
+
+    rng = np.random.RandomState(seed)
+    affine = np.array(info['affine'])
+
+    tck = TCK.create(out_fname)
+    for start in range(0, nb_streamlines, block_size):
+        block = _generate_block(rng, info,
+                                min(block_size, nb_streamlines - start),
+                                vc_ratio, ic_ratio, step_size)
+        tck += [_to_world(s, affine) for s in block]
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+import datetime
+import multiprocessing
+import os
+import platform
+import subprocess
+
+import nibabel as nib
+import numpy as np
+
+from challenge_scoring.metrics.scoring import score_submission
+from challenge_scoring.utils.attributes import load_attribs
+from challenge_scoring.utils.profiling import Profiler, profile_stage
+
+
+# Bump when the layout of the report changes.
+REPORT_VERSION = 2
+
+# Main stages of score_submission, in the order in which they are run. The
+# report also contains the stages nested in them.
+STAGES = ['gt_preparation', 'load', 'vc_extraction', 'coverage', 'save_vcs',
+          'length_filter', 'ic_clustering', 'roi_assignment', 'save_ics',
+          'save_ncs']
+
+
+def get_environment_info():
+    """
+    Describe the current code version and machine, to identify a report.
+    """
+    code_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=code_dir,
+                stderr=devnull).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    try:
+        nb_cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        nb_cpus = None
+
+    return {'commit': commit,
+            'date': datetime.datetime.now().isoformat(),
+            'hostname': platform.node(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'nibabel': nib.__version__,
+            'nb_cpus': nb_cpus}
+
+
+def run_benchmark(tractogram_fname, base_dir, out_segmented_dir,
+                  nb_processes=1, nb_threads=1, nb_bundle_threads=1):
+    """
+    Score a tractogram with score_submission, and measure each of its
+    stages with a Profiler.
+
+    All segmented files are saved, to measure the saving stages.
+
+    Parameters
+    ------------
+    tractogram_fname : string
+        path of the tractogram to score, in TCK.
+    base_dir : string
+        path to the directory containing the scoring data.
+    out_segmented_dir : string
+        directory where the segmented files are saved.
+    nb_processes : int
+        number of processes used to extract the VCs.
+    nb_threads : int
+        number of threads used by each process to compute distances between
+        streamlines.
+    nb_bundle_threads : int
+        number of threads used by each process to extract the GT bundles of
+        a chunk at the same time.
+
+    Returns
+    ---------
+    stages : dict
+        for each stage name, its number of calls, total wall time, CPU time
+        and number of processed streamlines, maximal peak memory and
+        throughput, as summarized by Profiler.get_summary. The 'total' stage
+        measures the whole scoring.
+    counts : dict
+        number of streamlines classified in each category, to check that
+        compared reports used the same data.
+    records : list
+        records of all stages, sorted by start time, see Profiler.
+    """
+    basic_bundles_attribs = load_attribs(os.path.join(
+        base_dir, 'gt_bundles_attributes.json'))
+    base_name = os.path.splitext(os.path.basename(tractogram_fname))[0]
+    tract_attribs = {'orientation': 'RAS'}
+
+    profiler = Profiler()
+    with profile_stage(profiler, 'total') as stage:
+        scores = score_submission(tractogram_fname, tract_attribs, base_dir,
+                                  basic_bundles_attribs,
+                                  save_full_vc=True, save_full_ic=True,
+                                  save_full_nc=True, save_IBs=True,
+                                  save_VBs=True,
+                                  segmented_out_dir=out_segmented_dir,
+                                  segmented_base_name=base_name,
+                                  nb_processes=nb_processes,
+                                  nb_threads=nb_threads,
+                                  profiler=profiler,
+                                  nb_bundle_threads=nb_bundle_threads)
+        nb_total = scores['total_streamlines_count']
+        stage['nb_streamlines'] = nb_total
+
+    stages = profiler.get_summary()
+    for stage in stages.values():
+        nb_streamlines = stage.get('nb_streamlines')
+        if nb_streamlines is not None:
+            stage['throughput'] = nb_streamlines / max(stage['wall_time'],
+                                                       1e-9)
+
+    # The scores are fractions of the total number of streamlines.
+    counts = {'total': nb_total,
+              'VC': int(round(scores['VC'] * nb_total)),
+              'IC': int(round(scores['IC'] * nb_total)),
+              'NC': int(round(scores['NC'] * nb_total)),
+              'VB': scores['VB'],
+              'IB': scores['IB']}
+
+    return stages, counts, profiler.get_profile()['stages']
+
+
+def compare_reports(old_report, new_report):
+    """
+    Compare the wall time of each stage of two benchmark reports.
+
+    Returns
+    ---------
+    rows : list
+        list of (number of streamlines, stage, old wall time, new wall time,
+        speedup), for each run and stage found in both reports.
+    """
+    old_runs = dict((r['nb_streamlines'], r) for r in old_report['runs'])
+
+    rows = []
+    for new_run in new_report['runs']:
+        old_run = old_runs.get(new_run['nb_streamlines'])
+        if old_run is None:
+            continue
+
+        for stage in STAGES + ['total']:
+            old_stage = old_run['stages'].get(stage)
+            new_stage = new_run['stages'].get(stage)
+            if old_stage is None or new_stage is None:
+                continue
+
+            rows.append((new_run['nb_streamlines'], stage,
+                         old_stage['wall_time'], new_stage['wall_time'],
+                         old_stage['wall_time'] /
+                         max(new_stage['wall_time'], 1e-9)))
+
+    return rows
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+
+# Bump when the content or layout of the checkpoints changes, so that
+# checkpoints produced by older versions are never reused.
+CHECKPOINT_VERSION = 4
+
+
+def _hash_indices(indices):
+    # Identifies a set of streamlines by the hash of their indices.
+    return hashlib.sha1(np.ascontiguousarray(indices, dtype=np.int64)
+                        ).hexdigest()
+
+
+def _split(values, sizes):
+    # Splits concatenated values in groups of the given sizes.
+    if not len(sizes):
+        return []
+    return np.split(values, np.cumsum(sizes)[:-1])
+
+
+class ScoringCheckpoint(object):
+    """
+    Checkpoints of the scoring of a tractogram, used to resume a scoring
+    that was interrupted.
+
+    Checkpoints are saved after each chunk of the VC extraction and after
+    the IC clustering, and only hold the classification of the streamlines.
+    The IC clustering is only reused for the same candidate IC, which change
+    when the VCs are extracted with other chunks.
+    Each checkpoint is a npz file in checkpoint_dir, and is written
+    atomically. A checkpoint is only reused if it was produced for the same
+    tractogram file, loaded with the same attributes, and the same GT data.
+
+    Parameters
+    ------------
+    checkpoint_dir : string
+        directory where the checkpoints are saved.
+    streamlines_fname : string
+        path of the scored tractogram.
+    tracts_attribs : dictionary
+        attributes of the tractogram, whose 'orientation' and 'format'
+        change the loaded streamlines.
+    gt_hash : string
+        hash of the scoring data, as returned by prepare_gt_data.
+    resume : bool
+        if True, reuse the checkpoints already in checkpoint_dir. If False,
+        existing checkpoints are removed.
+    """
+
+    def __init__(self, checkpoint_dir, streamlines_fname, tracts_attribs,
+                 gt_hash, resume=False):
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
+
+        stat = os.stat(streamlines_fname)
+        self.key = json.dumps({'version': CHECKPOINT_VERSION,
+                               'tractogram': os.path.abspath(streamlines_fname),
+                               'size': stat.st_size,
+                               'mtime': stat.st_mtime,
+                               'orientation': tracts_attribs.get('orientation'),
+                               'format': tracts_attribs.get('format'),
+                               'gt': gt_hash},
+                              sort_keys=True)
+
+        if not resume:
+            self.clear()
+
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+    def clear(self):
+        """
+        Remove all checkpoints. Other files of checkpoint_dir are kept.
+        """
+        for fname in glob.glob(self._get_filename('vc_chunk_*')) + \
+                glob.glob(self._get_filename('ic_clustering')):
+            os.remove(fname)
+
+    def _get_filename(self, name):
+        return os.path.join(self.checkpoint_dir, name + '.npz')
+
+    def _save(self, name, **arrays):
+        fd, tmp_fname = tempfile.mkstemp(dir=self.checkpoint_dir,
+                                         suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as checkpoint_file:
+                np.savez(checkpoint_file, key=np.array(self.key), **arrays)
+            os.rename(tmp_fname, self._get_filename(name))
+        except Exception:
+            os.remove(tmp_fname)
+            raise
+
+    def _load(self, name):
+        # Returns the content of a checkpoint, or None if it does not exist
+        # or does not match the current scoring.
+        fname = self._get_filename(name)
+        if not self.resume or not os.path.isfile(fname):
+            return None
+
+        try:
+            with np.load(fname) as checkpoint:
+                content = dict((k, checkpoint[k]) for k in checkpoint.files)
+        except Exception as e:
+            logging.warning('Could not read checkpoint {0}: {1}'.format(
+                fname, e))
+            return None
+
+        if str(content.pop('key')) != self.key:
+            logging.warning('Ignoring checkpoint {0}, produced for another '
+                            'tractogram or GT.'.format(fname))
+            return None
+
+        logging.debug('Resuming from checkpoint {0}'.format(fname))
+        return content
+
+    def _get_vc_chunk_name(self, chunk_bounds):
+        return 'vc_chunk_{0}_{1}'.format(*chunk_bounds)
+
+    def save_vc_chunk(self, chunk_bounds, chunk_labels):
+        self._save(self._get_vc_chunk_name(chunk_bounds),
+                   labels=chunk_labels)
+
+    def load_vc_chunk(self, chunk_bounds):
+        """
+        Returns the labels of the streamlines of the chunk, or None.
+        """
+        content = self._load(self._get_vc_chunk_name(chunk_bounds))
+        if content is None:
+            return None
+
+        return content['labels']
+
+    def save_ic_clustering(self, candidate_indices, shuffled_order, clusters,
+                           ib_pairs, rejected_indices, ic_counts):
+        clusters_indices = [clusters[c]['indices'] for c in clusters]
+        pairs = list(ib_pairs.items())
+
+        self._save('ic_clustering',
+                   candidates=np.array(_hash_indices(candidate_indices)),
+                   shuffled_order=shuffled_order,
+                   clusters_sizes=np.array([len(c) for c in clusters_indices],
+                                           dtype=np.int64),
+                   clusters_indices=np.concatenate(
+                       [np.zeros((0,), dtype=np.int64)] +
+                       [np.asarray(c, dtype=np.int64)
+                        for c in clusters_indices]),
+                   ib_rois=np.array([k for k, _ in pairs], dtype=str),
+                   ib_sizes=np.array([len(v) for _, v in pairs],
+                                     dtype=np.int64),
+                   ib_clusters=np.array([c for _, v in pairs for c in v],
+                                        dtype=np.int64),
+                   rejected_indices=rejected_indices,
+                   ic_counts=np.array(ic_counts))
+
+    def load_ic_clustering(self, candidate_indices):
+        """
+        Returns the results of cluster_and_assign_ibs for the streamlines of
+        candidate_indices, or None.
+        """
+        content = self._load('ic_clustering')
+        if content is None:
+            return None
+
+        if str(content['candidates']) != _hash_indices(candidate_indices):
+            logging.warning('Ignoring the IC clustering checkpoint, produced '
+                            'for other candidate IC.')
+            return None
+
+        clusters_indices = _split(content['clusters_indices'],
+                                  content['clusters_sizes'])
+        clusters = dict((c, {'indices': indices})
+                        for c, indices in enumerate(clusters_indices))
+
+        ib_clusters = _split(content['ib_clusters'], content['ib_sizes'])
+        ib_pairs = dict((tuple(str(r) for r in rois), c.tolist())
+                        for rois, c in zip(content['ib_rois'], ib_clusters))
+
+        return content['shuffled_order'], clusters, ib_pairs, \
+            content['rejected_indices'], int(content['ic_counts'])
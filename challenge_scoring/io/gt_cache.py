@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from dipy.segment.clustering import ClusterCentroid, ClusterMapCentroid
+import numpy as np
+
+from challenge_scoring import NB_POINTS_RESAMPLE
+
+
+# Bump when the content or layout of the cache changes, so that caches
+# produced by older versions are never reused.
+GT_CACHE_VERSION = 2
+
+# Sub-directories of the scoring data that are used to prepare the GT.
+GT_DATA_SUBDIRS = ['bundles', 'masks']
+
+
+def _iter_gt_files(base_dir):
+    for subdir in GT_DATA_SUBDIRS:
+        for root, dirs, files in os.walk(os.path.join(base_dir, subdir)):
+            dirs.sort()
+            for f in sorted(files):
+                yield os.path.join(root, f)
+
+
+def compute_gt_hash(base_dir, gt_bundles_attribs, block_size=2**20):
+    """
+    Compute a hash of the content of the scoring data.
+
+    Parameters
+    ------------
+    base_dir : string
+        path to the directory containing the scoring data.
+    gt_bundles_attribs : dictionary
+        content of the gt_bundles_attributes.json file.
+    block_size : int
+        size of the blocks read when hashing the files.
+
+    Returns
+    ---------
+    hash : string
+        hexadecimal digest identifying the scoring data.
+    """
+    hasher = hashlib.sha1()
+    hasher.update('{0}:{1}'.format(GT_CACHE_VERSION,
+                                   NB_POINTS_RESAMPLE).encode('utf-8'))
+    hasher.update(json.dumps(gt_bundles_attribs,
+                             sort_keys=True).encode('utf-8'))
+
+    for fname in _iter_gt_files(base_dir):
+        hasher.update(os.path.relpath(fname, base_dir).encode('utf-8'))
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+def get_gt_cache_filename(cache_dir, gt_hash):
+    return os.path.join(cache_dir, 'gt_{0}.pkl'.format(gt_hash))
+
+
+def _pack_ref_bundle(ref_bundle):
+    cluster_map = ref_bundle['cluster_map']
+
+    return {'name': ref_bundle['name'],
+            'threshold': ref_bundle['threshold'],
+            'streamlines': np.array(cluster_map.refdata, dtype='f4'),
+            'centroids': np.array([c.centroid for c in cluster_map],
+                                  dtype='f4'),
+            'clusters_indices': [np.array(c.indices, dtype=np.int64)
+                                 for c in cluster_map],
+            'mask_indices': ref_bundle['mask_indices'],
+            'mask_shape': ref_bundle['mask_shape'],
+            'mask_affine': ref_bundle['mask_affine']}
+
+
+def _unpack_ref_bundle(packed):
+    cluster_map = ClusterMapCentroid()
+    for centroid, indices in zip(packed['centroids'],
+                                 packed['clusters_indices']):
+        cluster_map.add_cluster(ClusterCentroid(centroid,
+                                                indices=indices.tolist()))
+    cluster_map.refdata = packed['streamlines']
+
+    return {'name': packed['name'],
+            'threshold': packed['threshold'],
+            'cluster_map': cluster_map,
+            'mask_indices': packed['mask_indices'],
+            'mask_shape': packed['mask_shape'],
+            'mask_affine': packed['mask_affine']}
+
+
+def save_gt_cache(cache_fname, ref_bundles, rois_info):
+    """
+    Save the prepared GT bundles and ROIs information to a cache file.
+
+    The file is first written to a temporary file and then renamed, so
+    that concurrent scoring processes never read a partial cache.
+    """
+    cache_dir = os.path.dirname(cache_fname)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    content = {'version': GT_CACHE_VERSION,
+               'ref_bundles': [_pack_ref_bundle(b) for b in ref_bundles],
+               'rois_info': rois_info}
+
+    fd, tmp_fname = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as cache_file:
+            pickle.dump(content, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, cache_fname)
+    except Exception:
+        os.remove(tmp_fname)
+        raise
+
+
+def load_gt_cache(cache_fname):
+    """
+    Load the prepared GT bundles and ROIs information from a cache file.
+
+    Returns
+    ---------
+    (ref_bundles, rois_info) or None if the cache file does not exist or
+    was created by an incompatible version.
+    """
+    if not os.path.isfile(cache_fname):
+        return None
+
+    try:
+        with open(cache_fname, 'rb') as cache_file:
+            content = pickle.load(cache_file)
+    except Exception as e:
+        logging.warning('Could not read GT cache {0}: {1}'.format(
+            cache_fname, e))
+        return None
+
+    if content.get('version') != GT_CACHE_VERSION:
+        return None
+
+    ref_bundles = [_unpack_ref_bundle(b) for b in content['ref_bundles']]
+
+    return ref_bundles, content['rois_info']
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# Bump when the content or layout of the partial results changes, so that
+# partial results produced by older versions are never merged.
+PARTIAL_RESULT_VERSION = 1
+
+
+def get_partial_result_key(streamlines_fname, nb_streamlines, ref_bundles):
+    """
+    Identify the scoring which a partial result belongs to.
+
+    Shards can be scored on other machines, with their own copy of the
+    tractogram, so the tractogram is identified by its name, size and number
+    of streamlines instead of its path.
+    """
+    return json.dumps({'version': PARTIAL_RESULT_VERSION,
+                       'tractogram': os.path.basename(streamlines_fname),
+                       'size': os.path.getsize(streamlines_fname),
+                       'nb_streamlines': nb_streamlines,
+                       'bundles': [[b['name'], b['threshold']]
+                                   for b in ref_bundles]},
+                      sort_keys=True)
+
+
+def save_partial_result(fname, partial):
+    """
+    Save the partial result of a shard to a npz file, atomically.
+
+    Parameters
+    ------------
+    fname : string
+        path of the npz file.
+    partial : dict
+        partial result, see
+        challenge_scoring.metrics.scoring.score_submission_shard.
+    """
+    vbs_voxels = partial['vbs_voxels']
+
+    # Voxels of all bundles are concatenated. Bundles without any streamline
+    # have a size of -1.
+    voxels_sizes = np.array([-1 if v is None else len(v) for v in vbs_voxels],
+                            dtype=np.int64)
+    voxels = np.concatenate([np.zeros((0,), dtype=np.int64)] +
+                            [v for v in vbs_voxels if v is not None])
+
+    fd, tmp_fname = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(fname)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as partial_file:
+            np.savez(partial_file,
+                     key=np.array(partial['key']),
+                     shard_bounds=np.array(partial['shard_bounds'],
+                                           dtype=np.int64),
+                     chunk_size=np.array(partial['chunk_size']),
+                     labels=partial['labels'],
+                     voxels_sizes=voxels_sizes,
+                     voxels=voxels)
+        os.rename(tmp_fname, fname)
+    except Exception:
+        os.remove(tmp_fname)
+        raise
+
+
+def load_partial_result(fname):
+    """
+    Load the partial result of a shard, saved by save_partial_result.
+    """
+    with np.load(fname) as partial_file:
+        content = dict((k, partial_file[k]) for k in partial_file.files)
+
+    sizes = content['voxels_sizes']
+    offsets = np.concatenate(([0], np.cumsum(np.maximum(sizes, 0))))
+    vbs_voxels = [None if size < 0 else content['voxels'][start:end]
+                  for size, start, end in zip(sizes, offsets[:-1],
+                                              offsets[1:])]
+
+    return {'key': str(content['key']),
+            'shard_bounds': tuple(int(b) for b in content['shard_bounds']),
+            'chunk_size': int(content['chunk_size']),
+            'labels': content['labels'],
+            'vbs_voxels': vbs_voxels}
@@ -1,51 +1,192 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from multiprocessing.pool import ThreadPool
 import os
 
 import nibabel as nb
+from nibabel.streamlines import ArraySequence, TckFile, TrkFile
+from nibabel.streamlines.header import Field
+from nibabel.streamlines.tractogram_file import DataError, HeaderError
 import numpy as np
 from numpy import linalg
 from numpy.lib.index_tricks import c_
 import tractconverter as tc
-from tractconverter.formats.tck import TCK
 
 
-def format_needs_orientation(tract_fname):
-    tracts_format = tc.detect_format(tract_fname)
-    tracts_file = tracts_format(tract_fname)
+# Number of streamlines transformed and written at once when saving.
+TCK_WRITE_BLOCK_SIZE = 10000
 
-    if isinstance(tracts_file, tc.formats.vtk.VTK):
-        return True
+# Marker written at the end of the data of a TCK file.
+EOF_DELIMITER = np.full(3, np.inf, dtype='<f4').tobytes()
 
-    return False
+# Formats of tractograms supported by the loaders.
+TCK_FORMAT = 'tck'
+TRK_FORMAT = 'trk'
+VTK_FORMAT = 'vtk'
 
 
-def guess_orientation(tract_fname):
-    tracts_format = tc.detect_format(tract_fname)
-    tracts_file = tracts_format(tract_fname)
+def detect_tracts_format(tract_fname):
+    """
+    Detect the format of a tractogram, from its header or its extension.
 
-    if isinstance(tracts_file, tc.formats.tck.TCK):
+    Returns
+    ---------
+    tracts_format : string
+        one of TCK_FORMAT, TRK_FORMAT or VTK_FORMAT, or None if the format is
+        not supported.
+    """
+    nib_format = nb.streamlines.detect_format(tract_fname)
+    if nib_format is TckFile:
+        return TCK_FORMAT
+    elif nib_format is TrkFile:
+        return TRK_FORMAT
+
+    # VTK is not supported by nibabel.
+    tc_format = tc.detect_format(tract_fname)
+    if tc_format is not None and issubclass(tc_format, tc.formats.vtk.VTK):
+        return VTK_FORMAT
+
+    return None
+
+
+def _get_tracts_format(tract_fname, tract_attributes):
+    # The format is detected once by get_tracts_attributes, and kept in the
+    # attributes.
+    tracts_format = tract_attributes.get('format')
+    if tracts_format is None:
+        tracts_format = detect_tracts_format(tract_fname)
+    return tracts_format
+
+
+def format_needs_orientation(tract_fname, tracts_format=None):
+    if tracts_format is None:
+        tracts_format = detect_tracts_format(tract_fname)
+
+    return tracts_format == VTK_FORMAT
+
+
+def guess_orientation(tract_fname, tracts_format=None):
+    if tracts_format is None:
+        tracts_format = detect_tracts_format(tract_fname)
+
+    if tracts_format == TCK_FORMAT:
         return 'RAS'
 
     return 'Unknown'
 
 
-def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
-                           start_at_corner=True):
+def _raise_malformed_header(format_name, error):
+    raise ValueError("\n------ ERROR ------\n\n" +
+                     "{0} header is malformed or incomplete.\n".format(
+                         format_name) +
+                     "Please make sure all fields are correctly set.\n\n" +
+                     "The error message reported by Nibabel was:\n" +
+                     str(error))
+
+
+def _iter_tck_blocks(tract_fname, block_size):
+    # Reads the points by large blocks, and splits them on the NaN
+    # delimiters, instead of reading the streamlines one by one.
+    with open(tract_fname, 'rb') as tck_file:
+        try:
+            header = TckFile._read_header(tck_file)
+        except (HeaderError, DataError) as er:
+            _raise_malformed_header('TCK', er)
+
+        dtype = header['_dtype']
+        tck_file.seek(header['_offset_data'], os.SEEK_SET)
+
+        leftover = np.empty((0, 3), dtype='<f4')
+        eof = False
+        while not eof:
+            values = np.fromfile(tck_file, dtype=dtype, count=3 * block_size)
+            eof = len(values) < 3 * block_size
+            values = values[:len(values) - len(values) % 3]
+            coords = values.astype('<f4', copy=False).reshape((-1, 3))
+            if len(leftover):
+                coords = np.concatenate((leftover, coords))
+
+            # Points after the end of file marker (inf, inf, inf) are ignored.
+            end = np.flatnonzero(np.isinf(coords[:, 0]))
+            if len(end):
+                coords = coords[:end[0]]
+                eof = True
+
+            delims = np.flatnonzero(np.isnan(coords[:, 0]))
+            if eof:
+                # The last streamline may not be followed by a delimiter.
+                delims = np.append(delims, len(coords))
+                leftover = coords[:0]
+            elif len(delims):
+                leftover = coords[delims[-1] + 1:]
+                coords = coords[:delims[-1] + 1]
+            else:
+                leftover = coords
+                continue
+
+            lengths = np.diff(np.concatenate(([-1], delims))) - 1
+            yield coords[~np.isnan(coords[:, 0])], lengths[lengths > 0]
+
+
+def _group_in_blocks(streamlines, block_size):
+    # Groups the streamlines of an iterator in blocks of about block_size
+    # points.
+    block = []
+    nb_points = 0
+    for s in streamlines:
+        block.append(s)
+        nb_points += len(s)
+
+        if nb_points >= block_size:
+            yield np.concatenate(block).astype('<f4', copy=False), \
+                np.array([len(b) for b in block])
+            block = []
+            nb_points = 0
+
+    if len(block):
+        yield np.concatenate(block).astype('<f4', copy=False), \
+            np.array([len(b) for b in block])
+
+
+def _iter_trk_blocks(tract_fname, block_size):
+    try:
+        trk_file = nb.streamlines.load(tract_fname, lazy_load=True)
+    except (HeaderError, DataError) as er:
+        _raise_malformed_header('TrackVis', er)
+
+    # nibabel considers that (0, 0, 0) is the center of a TRK voxel, while
+    # the previous loader (nb.trackvis in 'rasmm') considered it to be the
+    # corner. The difference is half a voxel of the TRK grid, which is
+    # moved to world space to keep the previous alignment.
+    voxel_to_rasmm = trk_file.header[Field.VOXEL_TO_RASMM]
+    half_voxel = np.dot(voxel_to_rasmm[:3, :3],
+                        [0.5, 0.5, 0.5]).astype('<f4')
+
+    for points, lengths in _group_in_blocks(trk_file.streamlines,
+                                            block_size):
+        points += half_voxel
+        yield points, lengths
+
+
+def _open_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
+                           start_at_corner=True, block_size=2**20):
     # TODO move to only get the attribute
     # Tract_attributes is a dictionary containing various information
     # about a dataset. Currently using:
     # - "orientation" (should be LPS or RAS)
-    tracts_format = tc.detect_format(tract_fname)
-    tracts_file = tracts_format(tract_fname)
+    # - "format" (optional, detected if missing)
+    # Returns an iterator over blocks of (points in world space, lengths of
+    # the streamlines), the transposed world to index affine and the shift
+    # to apply after the affine.
+    tracts_format = _get_tracts_format(tract_fname, tract_attributes)
 
     # Get information on the supporting anatomy
     ref_img = nb.load(ref_anat_fname)
 
     index_to_world_affine = ref_img.get_header().get_best_affine()
 
-    if isinstance(tracts_file, tc.formats.vtk.VTK):
+    if tracts_format == VTK_FORMAT:
         # For VTK files, we need to check the orientation.
         # Considered to be in world space. Use the orientation to correct the
         # affine to bring back to voxel.
@@ -65,45 +206,121 @@ def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
     world_to_index_affine = linalg.inv(index_to_world_affine)
 
     # Load tracts
-    if isinstance(tracts_file, tc.formats.tck.TCK)\
-        or isinstance(tracts_file, tc.formats.vtk.VTK):
+    if tracts_format == TCK_FORMAT or tracts_format == VTK_FORMAT:
         if start_at_corner:
             shift = 0.5
         else:
             shift = 0.0
 
-        for s in tracts_file:
-            transformed_s = np.dot(c_[s, np.ones([s.shape[0], 1], dtype='<f4')],
-                                   world_to_index_affine)[:, :-1] + shift
-            yield transformed_s
-    elif isinstance(tracts_file, tc.formats.trk.TRK):
-         # Use nb.trackvis to read directly in correct space
-         # TODO this should be made more robust, using
-         # all fields in header.
-         # Currently, load in rasmm space, and then bring back to LPS vox
-        try:
-            streamlines, _ = nb.trackvis.read(tract_fname,
-                                              as_generator=True,
-                                              points_space='rasmm')
-        except nb.trackvis.HeaderError as er:
-            print(er)
-            raise ValueError("\n------ ERROR ------\n\n" +\
-                  "TrackVis header is malformed or incomplete.\n" +\
-                  "Please make sure all fields are correctly set.\n\n" +\
-                  "The error message reported by Nibabel was:\n" +\
-                  str(er))
+        if tracts_format == TCK_FORMAT:
+            blocks = _iter_tck_blocks(tract_fname, block_size)
+        else:
+            blocks = _group_in_blocks(iter(tc.formats.vtk.VTK(tract_fname)),
+                                      block_size)
 
+        return blocks, world_to_index_affine, shift
+    elif tracts_format == TRK_FORMAT:
+        # The TRK blocks are already aligned as by the previous loader, see
+        # _iter_trk_blocks, which used these shifts.
         if start_at_corner:
             shift = 0.0
         else:
             shift = 0.5
 
-        for s in streamlines:
-            transformed_s = np.dot(c_[s[0], np.ones([s[0].shape[0], 1], dtype='<f4')],
-                                   world_to_index_affine)[:, :-1] + shift
+        return _iter_trk_blocks(tract_fname, block_size), \
+            world_to_index_affine, shift
+
+    return iter([]), world_to_index_affine, 0.0
+
+
+def _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
+                           start_at_corner=True):
+    blocks, world_to_index_affine, shift = _open_tracts_over_grid(
+        tract_fname, ref_anat_fname, tract_attributes, start_at_corner)
+
+    for points, lengths in blocks:
+        for s in np.split(points, np.cumsum(lengths)[:-1]):
+            transformed_s = np.dot(
+                c_[s, np.ones([s.shape[0], 1], dtype='<f4')],
+                world_to_index_affine)[:, :-1] + shift
             yield transformed_s
 
 
+def _create_array_sequence(points, lengths):
+    # Wraps already contiguous points in an ArraySequence, without copy.
+    seq = ArraySequence()
+    seq._data = points
+    seq._lengths = np.asarray(lengths, dtype=np.intp)
+    seq._offsets = np.zeros(len(lengths), dtype=np.intp)
+    if len(lengths) > 1:
+        np.cumsum(seq._lengths[:-1], out=seq._offsets[1:])
+    return seq
+
+
+def _iter_tracts_blocks_over_grid(tract_fname, ref_anat_fname,
+                                  tract_attributes, start_at_corner=True,
+                                  block_size=2**20):
+    blocks, world_to_index_affine, shift = _open_tracts_over_grid(
+        tract_fname, ref_anat_fname, tract_attributes, start_at_corner,
+        block_size)
+
+    # Affine split in its linear part and its translation, to avoid adding
+    # a homogeneous coordinate to each point.
+    linear = np.ascontiguousarray(world_to_index_affine[:3, :3], dtype='<f4')
+    translation = world_to_index_affine[3, :3].astype('<f4')
+
+    # The points stay in float32, and are transformed in place after the
+    # product.
+    for points, lengths in blocks:
+        points = np.dot(points, linear)
+        points += translation
+        if shift:
+            points += shift
+        yield _create_array_sequence(points, lengths)
+
+
+def _load_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
+                           start_at_corner=True, block_size=2**20,
+                           streamlines_range=None):
+    points = np.empty((block_size, 3), dtype='<f4')
+    lengths = []
+    nb_points = 0
+    nb_streamlines = 0
+
+    for block in _iter_tracts_blocks_over_grid(tract_fname, ref_anat_fname,
+                                               tract_attributes,
+                                               start_at_corner, block_size):
+        block_start = nb_streamlines
+        nb_streamlines += len(block)
+
+        if streamlines_range is not None:
+            # Only the streamlines of the range are kept. The whole block is
+            # transformed, so that they are identical to a full load.
+            first = max(streamlines_range[0] - block_start, 0)
+            last = min(streamlines_range[1] - block_start, len(block))
+            if first >= last:
+                continue
+
+            block = _create_array_sequence(
+                block._data[block._offsets[first]:
+                            block._offsets[last - 1] +
+                            block._lengths[last - 1]],
+                block._lengths[first:last])
+
+        block_len = len(block._data)
+        if nb_points + block_len > len(points):
+            points.resize((max(2 * len(points), nb_points + block_len), 3),
+                          refcheck=False)
+        points[nb_points:nb_points + block_len] = block._data
+        nb_points += block_len
+        lengths.append(block._lengths)
+
+    points.resize((nb_points, 3), refcheck=False)
+    lengths = np.concatenate(lengths) if len(lengths) else []
+
+    return _create_array_sequence(points, lengths)
+
+
 def get_tracts_voxel_space(tract_fname, ref_anat_fname, tract_attributes):
     return _get_tracts_over_grid(tract_fname, ref_anat_fname, tract_attributes,
                                  True)
@@ -114,90 +331,278 @@ def get_tracts_voxel_space_for_dipy(tract_fname, ref_anat_fname, tract_attribute
                                  False)
 
 
-def save_tracts_tck_from_dipy_voxel_space(tract_outobj, ref_anat_fname,
-                                          tracts):
-    # TODO validate that tract_outobj is a TCK file.
-    # Get information on the supporting anatomy
+def iter_tracts_blocks_voxel_space_for_dipy(tract_fname, ref_anat_fname,
+                                            tract_attributes,
+                                            block_size=2**20):
+    """
+    Iterate over the streamlines of a tractogram in voxel space, aligned as
+    expected by dipy, by blocks.
+
+    The file is read lazily, so that only one block is kept in memory.
+
+    Parameters
+    ------------
+    block_size : int
+        number of points of each block. Blocks only contain complete
+        streamlines, so their size is approximate.
+
+    Returns
+    ---------
+    blocks : generator
+        ArraySequence of the streamlines of each block.
+    """
+    return _iter_tracts_blocks_over_grid(tract_fname, ref_anat_fname,
+                                         tract_attributes, False, block_size)
+
+
+def load_tracts_voxel_space_for_dipy(tract_fname, ref_anat_fname,
+                                     tract_attributes):
+    """
+    Load all streamlines of a tractogram in voxel space, aligned as
+    expected by dipy.
+
+    The streamlines are read and transformed by large blocks of points
+    instead of one by one.
+
+    Returns
+    ---------
+    streamlines : ArraySequence
+        all streamlines, stored in a single contiguous buffer of points.
+        The offset and length of each streamline in this buffer are kept in
+        the ArraySequence.
+    """
+    return _load_tracts_over_grid(tract_fname, ref_anat_fname,
+                                  tract_attributes, False)
+
+
+def load_tracts_range_voxel_space_for_dipy(tract_fname, ref_anat_fname,
+                                           tract_attributes, start, end):
+    """
+    Load the streamlines [start, end[ of a tractogram in voxel space, aligned
+    as expected by dipy.
+
+    The whole file is read by blocks, but only the streamlines of the range
+    are kept in memory. They are identical to the same streamlines loaded
+    by load_tracts_voxel_space_for_dipy.
+
+    Returns
+    ---------
+    streamlines : ArraySequence
+        streamlines of the range, stored in a single contiguous buffer of
+        points.
+    """
+    return _load_tracts_over_grid(tract_fname, ref_anat_fname,
+                                  tract_attributes, False,
+                                  streamlines_range=(start, end))
+
+
+def count_tracts(tract_fname, ref_anat_fname, tract_attributes):
+    """
+    Count the streamlines of a tractogram.
+
+    The file is read by blocks, without transforming the streamlines.
+    """
+    blocks, _, _ = _open_tracts_over_grid(tract_fname, ref_anat_fname,
+                                          tract_attributes)
+
+    return sum(len(lengths) for _, lengths in blocks)
+
+
+def _get_tck_header(count):
+    # The offset of the data depends on the length of the header, which
+    # depends on the number of digits of the offset.
+    header = 'mrtrix tracks\ncount: {0:010d}\ndatatype: Float32LE\n' \
+             'file: . {{0}}\nEND\n'.format(count)
+    offset = len(header.format(0))
+    while len(header.format(offset)) != offset:
+        offset = len(header.format(offset))
+
+    return header.format(offset).encode('ascii')
+
+
+def _get_tck_data_size(streamlines, indices):
+    # Each point, and the delimiter following each streamline, takes 12
+    # bytes.
+    return 12 * (int(streamlines._lengths[indices].sum()) + len(indices))
+
+
+def _get_voxel_to_world_for_dipy(ref_anat_fname):
+    # Returns the linear part and the translation of the transposed affine
+    # bringing the streamlines from the dipy voxel space back to world.
     ref_img = nb.load(ref_anat_fname)
 
     index_to_world_affine = ref_img.get_header().get_best_affine()
 
     # Transposed for efficient computations later on.
-    index_to_world_affine = index_to_world_affine.T.astype('<f4')
-
     # Do not shift, because we save as TCK, and dipy expect shifted tracts.
-    transformed = [np.dot(c_[s, np.ones([s.shape[0], 1], dtype='<f4')],
-                          index_to_world_affine)[:, :-1] for s in tracts]
+    index_to_world_affine = index_to_world_affine.T.astype('<f4')
 
-    tract_outobj += transformed
+    return np.ascontiguousarray(index_to_world_affine[:3, :3]), \
+        index_to_world_affine[3, :3].copy()
+
+
+def _iter_tck_data_blocks(streamlines, indices, linear, translation,
+                          block_size=TCK_WRITE_BLOCK_SIZE):
+    # Yields the TCK data of the selected streamlines, transformed to world
+    # space, by blocks of block_size streamlines. The points are gathered
+    # from the shared buffer, without building a list of streamlines.
+    for start in range(0, len(indices), block_size):
+        block_indices = indices[start:start + block_size]
+        lengths = streamlines._lengths[block_indices]
+        offsets = streamlines._offsets[block_indices]
+        nb_points = int(lengths.sum())
+
+        # Position of each point in the block, and in the buffer.
+        block_starts = np.cumsum(lengths) - lengths
+        points_indices = np.arange(nb_points) + \
+            np.repeat(offsets - block_starts, lengths)
+        points = np.dot(streamlines._data[points_indices], linear) + \
+            translation
+
+        # Each streamline is followed by a delimiter of NaNs.
+        data = np.full((nb_points + len(block_indices), 3), np.nan,
+                       dtype='<f4')
+        data[np.arange(nb_points) +
+             np.repeat(np.arange(len(block_indices)), lengths)] = points
+
+        yield data.tobytes()
+
+
+def save_tracts_tck_by_indices(out_fname, ref_anat_fname, streamlines,
+                               indices):
+    """
+    Save streamlines in voxel space, aligned as expected by dipy, to a TCK
+    file.
+
+    The streamlines are selected by index, then transformed and written by
+    blocks.
+
+    Parameters
+    ------------
+    out_fname : string
+        path of the TCK file to create.
+    ref_anat_fname : string
+        path of the reference anatomy.
+    streamlines : ArraySequence
+        streamlines in voxel space.
+    indices : array-like
+        indices of the streamlines to save, in the order in which they are
+        saved.
+    """
+    _save_groups_tck([(out_fname, indices)], None, ref_anat_fname,
+                     streamlines)
+
+
+def _save_groups_tck(groups, full_fname, ref_anat_fname, streamlines,
+                     nb_threads=1):
+    # Saves groups of streamlines, given as a list of (TCK filename or None,
+    # indices of the streamlines), and the concatenation of all groups to
+    # full_fname, if not None. Each streamline is only transformed once,
+    # and each group is written by its own thread. Since the size of each
+    # group is known, the groups are written directly at their position in
+    # the full file.
+    linear, translation = _get_voxel_to_world_for_dipy(ref_anat_fname)
+    groups = [(fname, np.fromiter(indices, dtype=np.int64, count=len(indices)))
+              for fname, indices in groups]
+
+    full_offsets = []
+    if full_fname is not None:
+        header = _get_tck_header(sum(len(indices) for _, indices in groups))
+        offset = len(header)
+        for _, indices in groups:
+            full_offsets.append(offset)
+            offset += _get_tck_data_size(streamlines, indices)
+
+        with open(full_fname, 'wb') as full_file:
+            full_file.write(header)
+            full_file.seek(offset)
+            full_file.write(EOF_DELIMITER)
+
+    def save_group(group_idx):
+        fname, indices = groups[group_idx]
+        out_files = []
+        try:
+            if fname is not None:
+                out_files.append(open(fname, 'wb'))
+                out_files[-1].write(_get_tck_header(len(indices)))
+            if full_fname is not None:
+                out_files.append(open(full_fname, 'r+b'))
+                out_files[-1].seek(full_offsets[group_idx])
+
+            for data in _iter_tck_data_blocks(streamlines, indices,
+                                              linear, translation):
+                for out_file in out_files:
+                    out_file.write(data)
+
+            if fname is not None:
+                out_files[0].write(EOF_DELIMITER)
+        finally:
+            for out_file in out_files:
+                out_file.close()
+
+    if nb_threads > 1 and len(groups) > 1:
+        pool = ThreadPool(min(nb_threads, len(groups)))
+        try:
+            pool.map(save_group, range(len(groups)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for group_idx in range(len(groups)):
+            save_group(group_idx)
 
 
 def save_valid_connections(extracted_vb_info, streamlines,
                            segmented_out_dir, basename, ref_anat_fname,
-                           save_vbs=False, save_full_vc=False):
+                           save_vbs=False, save_full_vc=False, nb_threads=1):
 
     if not save_vbs and not save_full_vc:
         return
 
-    full_vcs = []
+    groups = []
     for bundle_name, bundle_info in extracted_vb_info.iteritems():
         if bundle_info['nb_streamlines'] > 0:
-            out_fname = os.path.join(segmented_out_dir, basename +
-                                     '_VB_{0}.tck'.format(bundle_name))
-
-            vc_strl = [streamlines[idx]
-                       for idx in bundle_info['streamlines_indices']]
-
-            if save_full_vc:
-                full_vcs.extend(vc_strl)
-
+            out_fname = None
             if save_vbs:
-                vb_f = TCK.create(out_fname)
-                save_tracts_tck_from_dipy_voxel_space(vb_f, ref_anat_fname, vc_strl)
+                out_fname = os.path.join(segmented_out_dir, basename +
+                                         '_VB_{0}.tck'.format(bundle_name))
 
-    if save_full_vc and len(full_vcs):
-        out_name = os.path.join(segmented_out_dir, basename + '_VC.tck')
-        tract_file = TCK.create(out_name)
+            groups.append((out_fname, bundle_info['streamlines_indices']))
 
-        save_tracts_tck_from_dipy_voxel_space(tract_file,
-                                              ref_anat_fname,
-                                              full_vcs)
+    full_fname = None
+    if save_full_vc and len(groups):
+        full_fname = os.path.join(segmented_out_dir, basename + '_VC.tck')
+
+    _save_groups_tck(groups, full_fname, ref_anat_fname, streamlines,
+                     nb_threads)
 
 
 def save_invalid_connections(ib_info, streamlines, ic_clusters,
                              out_segmented_dir, base_name,
                              ref_anat_fname,
-                             save_full_ic=False, save_ibs=False):
+                             save_full_ic=False, save_ibs=False,
+                             nb_threads=1):
     # ib_info is a dictionary containing all the pairs of ROIs that were
     # assigned to some IB. The value of each element is a list containing the
     # clusters indices of clusters that were assigned to that ROI pair.
     if not save_full_ic and not save_ibs:
         return
 
-    full_ic = []
-
+    groups = []
     for k, v in ib_info.iteritems():
-        out_strl = []
-        for c_idx in v:
-            out_strl.extend([s for s in np.array(streamlines)[
-                ic_clusters[c_idx]['indices']]])
-
+        out_fname = None
         if save_ibs:
             out_fname = os.path.join(out_segmented_dir,
                                      base_name +
                                      '_IB_{0}_{1}.tck'.format(k[0], k[1]))
 
-            ib_f = TCK.create(out_fname)
-            save_tracts_tck_from_dipy_voxel_space(ib_f, ref_anat_fname,
-                                                  out_strl)
-
-        if save_full_ic:
-            full_ic.extend(out_strl)
+        groups.append((out_fname, np.concatenate(
+            [np.asarray(ic_clusters[c_idx]['indices'], dtype=np.int64)
+             for c_idx in v])))
 
-    if save_full_ic and len(full_ic):
-        out_name = os.path.join(out_segmented_dir, base_name + '_IC.tck')
-        tract_file = TCK.create(out_name)
+    full_fname = None
+    if save_full_ic and len(groups):
+        full_fname = os.path.join(out_segmented_dir, base_name + '_IC.tck')
 
-        save_tracts_tck_from_dipy_voxel_space(tract_file,
-                                              ref_anat_fname,
-                                              full_ic)
\ No newline at end of file
+    _save_groups_tck(groups, full_fname, ref_anat_fname, streamlines,
+                     nb_threads)
@@ -5,8 +5,10 @@ from __future__ import division
 import numpy as np
 
 
+from nibabel.streamlines import Tractogram
+
 from challenge_scoring.tractanalysis.robust_streamlines_metrics \
-    import compute_robust_tract_counts_map
+    import compute_groups_voxels
 
 
 def _compute_f1_score(overlap, overreach):
@@ -17,40 +19,32 @@ def _compute_f1_score(overlap, overreach):
     return f1_score
 
 
-def _compute_overlap(gt_data, candidate_data):
-    basic_non_zero = np.count_nonzero(gt_data)
-    overlap = np.logical_and(gt_data, candidate_data)
-    overlap_count = np.float32(np.count_nonzero(overlap))
-    return overlap_count / basic_non_zero
-
-
-def _compute_overreach(gt_data, candidate_data):
-    diff = candidate_data - gt_data
-    diff[diff < 0] = 0
-    overreach_count = np.count_nonzero(diff)
-    if np.count_nonzero(candidate_data) == 0:
-        return 0
+def get_mask_indices(mask_img):
+    """ Get the voxels of a mask, as sorted linear indices.
 
-    return overreach_count / np.count_nonzero(candidate_data)
+    Bundle masks only cover a small fraction of the volume, so they are
+    kept as the linear indices (in C order) of their non-zero voxels instead
+    of full volumes.
 
+    Parameters
+    ----------
+    mask_img : `:class:Nifti1Image` object
+        Mask to convert.
 
-def _compute_overreach_normalize_gt(gt_data, candidate_data):
-    diff = candidate_data - gt_data
-    diff[diff < 0] = 0
-    overreach_count = np.count_nonzero(diff)
-    return overreach_count / np.count_nonzero(gt_data)
+    Returns
+    -------
+    indices : numpy array of int64
+        sorted linear indices of the non-zero voxels of the mask.
+    """
+    return np.flatnonzero(np.asanyarray(mask_img.dataobj)).astype(np.int64)
 
 
-def _create_binary_map(tractogram, ref_img):
-    tractogram.to_world().apply_affine(np.linalg.inv(ref_img.affine))  # Send to voxel space.
+def _move_to_corner_voxel_space(tractogram, affine):
+    tractogram.to_world().apply_affine(np.linalg.inv(affine))  # Send to voxel space.
     translation = np.eye(4)
     translation[:-1,-1] = 0.5
     tractogram.apply_affine(translation) # Shift of half a voxel.
 
-    sl_map = compute_robust_tract_counts_map(tractogram.streamlines,
-                                             ref_img.shape)
-    return (sl_map > 0).astype(np.int16)
-
 
 def compute_bundle_coverage_scores(tractogram, ground_truth_mask):
     """ Computes scores related to bundle coverage.
@@ -66,14 +60,171 @@ def compute_bundle_coverage_scores(tractogram, ground_truth_mask):
     ground_truth_mask : `:class:Nifti1Image` object
         Mask of the ground truth bundle.
     """
-    gt_data = ground_truth_mask.get_data()
-    candidate_data = _create_binary_map(tractogram, ground_truth_mask)
-    overlap = _compute_overlap(gt_data, candidate_data)
-    overreach = _compute_overreach(gt_data, candidate_data)
-    overreach_norm = _compute_overreach_normalize_gt(gt_data, candidate_data)
-    f1_score = _compute_f1_score(overlap, overreach)
+    _move_to_corner_voxel_space(tractogram, ground_truth_mask.affine)
+
+    candidate_voxels = compute_groups_voxels(
+        tractogram.streamlines, np.array([0, len(tractogram.streamlines)]),
+        ground_truth_mask.shape)[0]
+
+    return _compute_sparse_scores(get_mask_indices(ground_truth_mask),
+                                  candidate_voxels)
+
+
+def _compute_sparse_scores(gt_voxels, candidate_voxels):
+    # Both are sorted linear indices of unique voxels.
+    basic_non_zero = len(gt_voxels)
+    candidate_non_zero = len(candidate_voxels)
+
+    overlap_count = len(np.intersect1d(gt_voxels, candidate_voxels,
+                                       assume_unique=True))
+    overreach_count = candidate_non_zero - overlap_count
+
+    overlap = np.float32(overlap_count) / basic_non_zero
+
+    if candidate_non_zero == 0:
+        overreach = 0
+    else:
+        overreach = overreach_count / candidate_non_zero
+
+    overreach_norm = overreach_count / basic_non_zero
 
     return {'OL': overlap,
             'OR': overreach,
             'ORn': overreach_norm,
-            'F1': f1_score}
+            'F1': _compute_f1_score(overlap, overreach)}
+
+
+def compute_bundles_voxels(streamlines, labels, nb_bundles, vol_shape,
+                           affine):
+    """ Computes the voxels touched by the streamlines of many bundles at once.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        Streamlines to score, in voxel space, in the space of the masks.
+    labels : numpy array of ints
+        index of the bundle of each streamline. Streamlines with a negative
+        label are ignored.
+    nb_bundles : int
+        number of bundles.
+    vol_shape : tuple
+        shape of the grid of the masks.
+    affine : numpy array of shape (4, 4)
+        affine of the grid of the masks.
+
+    Returns
+    -------
+    bundles_voxels : list
+        sorted linear indices (in C order) of the voxels touched by each
+        bundle, as numpy arrays of int64, or None for the bundles without
+        any streamline.
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='mergesort')
+    order = order[labels[order] >= 0]
+    if not len(order):
+        return [None] * nb_bundles
+
+    groups_bounds = np.searchsorted(labels[order], np.arange(nb_bundles + 1))
+
+    # Copy, since the streamlines are moved in place.
+    tractogram = Tractogram(streamlines=streamlines[order].copy(),
+                            affine_to_rasmm=affine)
+    _move_to_corner_voxel_space(tractogram, affine)
+
+    groups_voxels = compute_groups_voxels(tractogram.streamlines,
+                                          groups_bounds, vol_shape)
+
+    return [groups_voxels[bundle_idx]
+            if groups_bounds[bundle_idx] < groups_bounds[bundle_idx + 1]
+            else None
+            for bundle_idx in range(nb_bundles)]
+
+
+def merge_bundles_voxels(bundles_voxels_list):
+    """ Merges the voxels touched by the same bundles in distinct sets of
+    streamlines.
+
+    Parameters
+    ----------
+    bundles_voxels_list : list
+        voxels touched by each bundle in each set of streamlines, as
+        returned by compute_bundles_voxels.
+
+    Returns
+    -------
+    bundles_voxels : list
+        voxels touched by each bundle in all sets of streamlines, as
+        returned by compute_bundles_voxels on all streamlines.
+    """
+    bundles_voxels = []
+    for voxels in zip(*bundles_voxels_list):
+        voxels = [v for v in voxels if v is not None]
+        if not len(voxels):
+            bundles_voxels.append(None)
+        else:
+            bundles_voxels.append(np.unique(np.concatenate(voxels)))
+
+    return bundles_voxels
+
+
+def compute_voxels_coverage_scores(bundles_voxels, gt_masks_indices):
+    """ Computes scores related to bundle coverage, from the voxels touched
+    by each bundle.
+
+    Parameters
+    ----------
+    bundles_voxels : list
+        voxels touched by each bundle, as returned by compute_bundles_voxels.
+    gt_masks_indices : list of numpy arrays
+        Masks of the ground truth bundles, as returned by get_mask_indices.
+
+    Returns
+    -------
+    scores : list of dict
+        scores of each bundle. Bundles without any streamline get an
+        empty dict.
+    """
+    return [_compute_sparse_scores(gt_voxels, candidate_voxels)
+            if candidate_voxels is not None else {}
+            for gt_voxels, candidate_voxels in zip(gt_masks_indices,
+                                                   bundles_voxels)]
+
+
+def compute_bundles_coverage_scores(streamlines, labels, gt_masks_indices,
+                                    vol_shape, affine):
+    """ Computes scores related to bundle coverage, for many bundles at once.
+
+    This function computes, for each bundle, the bundle overlap (OL),
+    bundle overreach (OR) bundle overreach normalized (ORn) and the
+    f1-score (F1), using a single traversal of all streamlines. Ground
+    truth masks and candidate maps are kept as sorted linear indices of
+    their voxels instead of full volumes, and the scores are computed from
+    their intersections.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        Streamlines to score, in voxel space, in the space of the masks.
+    labels : numpy array of ints
+        index of the bundle of each streamline, in gt_masks_indices.
+        Streamlines with a negative label are ignored.
+    gt_masks_indices : list of numpy arrays
+        Masks of the ground truth bundles, as returned by get_mask_indices.
+        All masks must be defined on the same grid.
+    vol_shape : tuple
+        shape of the grid of the masks.
+    affine : numpy array of shape (4, 4)
+        affine of the grid of the masks.
+
+    Returns
+    -------
+    scores : list of dict
+        scores of each bundle. Bundles without any streamline get an
+        empty dict.
+    """
+    bundles_voxels = compute_bundles_voxels(streamlines, labels,
+                                            len(gt_masks_indices),
+                                            vol_shape, affine)
+
+    return compute_voxels_coverage_scores(bundles_voxels, gt_masks_indices)
@@ -8,133 +8,265 @@ import logging
 import os
 import random
 
-import dipy.segment.quickbundles as qb
+from dipy.tracking.streamline import set_number_of_points
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
 
 from challenge_scoring.io.streamlines import save_invalid_connections
+from challenge_scoring.tractanalysis.quickbundles import StreamingQuickBundles
 from challenge_scoring.utils.filenames import get_root_image_name
+from challenge_scoring.utils.profiling import profile_stage
 
 
-def find_closest_distance_points_to_region(points, roi_volume):
-    roi_coords = roi_volume
-    dists = cdist(points, roi_coords, 'euclidean')
+# Number of candidate IC resampled and clustered at once.
+IC_CLUSTERING_BATCH_SIZE = 10000
 
-    return np.min(dists, axis=1)
 
+def build_rois_index(rois_info):
+    """
+    Build an index used to find the closest region of any point.
 
-def find_closest_region(points, rois):
-    # points is a 2D array, each row being 1 point.
-    # We expect 2 rows (start and end points)
-    # rois is a list of (region name, region_data)
-
-    min_global_dists = [100000, 100000]
-    closest_region_names = ["", ""]
+    Parameters
+    ------------
+    rois_info : list
+        list of (region name, coordinates of the region voxels).
 
-    for region_name, region_data in rois:
-        closest_dists = find_closest_distance_points_to_region(points,
-                                                               region_data)
+    Returns
+    ---------
+    rois_index : list
+        list of (region name, KD-tree over the region voxels).
+    """
+    return [(name, cKDTree(coords)) for name, coords in rois_info]
 
-        if closest_dists[0] < min_global_dists[0]:
-            min_global_dists[0] = closest_dists[0]
-            closest_region_names[0] = region_name
-        if closest_dists[1] < min_global_dists[1]:
-            min_global_dists[1] = closest_dists[1]
-            closest_region_names[1] = region_name
 
-    return (closest_region_names, min_global_dists)
+def find_closest_regions(points, rois_index, block_size=100000):
+    """
+    Find the closest region of each point.
+
+    The closest region is the region containing the closest voxel. On
+    equality, the first region of rois_index is kept, as done by
+    find_closest_region.
+
+    Parameters
+    ------------
+    points : numpy array of shape (N, 3)
+        points, in voxel space.
+    rois_index : list
+        list of (region name, KD-tree), as returned by build_rois_index.
+    block_size : int
+        number of points processed at once, to bound memory usage.
+
+    Returns
+    ---------
+    closest_regions : numpy array of shape (N,)
+        index in rois_index of the closest region of each point.
+    """
+    closest_regions = np.zeros((len(points),), dtype=np.int32)
 
+    for start in range(0, len(points), block_size):
+        block = np.asarray(points[start:start + block_size], dtype=np.float64)
+        min_dists = np.full((len(block),), 100000.)
+        block_closest = closest_regions[start:start + block_size]
 
-def get_closest_roi_pairs_for_bundle(streamlines, rois):
-    start_point = np.reshape(streamlines[0][0], (-1, 3)) # Needs to be 2D for cdist
+        for roi_idx, (_, roi_tree) in enumerate(rois_index):
+            dists, _ = roi_tree.query(block)
+            closer = dists < min_dists
+            min_dists[closer] = dists[closer]
+            block_closest[closer] = roi_idx
 
-    closest_rois_pairs = []
+    return closest_regions
 
-    for s in streamlines:
-        endpoints = np.vstack([s[0], s[-1]])
-        endpoints_dists = cdist(start_point, endpoints).flatten()
 
-        # Make sure we all start from the same "orientation" for streamlines,
-        # to try to get the same region as the first region
-        if endpoints_dists[0] > endpoints_dists[1]:
-            endpoints = np.vstack([s[-1], s[0]])
+def get_closest_rois_for_all_streamlines(streamlines, rois_index,
+                                         start_point=None):
+    """
+    Find the closest ROI of both endpoints of each provided streamline.
+
+    All streamlines are oriented to start from the endpoint closest to
+    start_point, to try to get the same region as the first region of each
+    pair.
+
+    Parameters
+    ------------
+    streamlines : sequence of arrays
+        streamlines, in voxel space.
+    rois_index : list
+        list of (region name, KD-tree), as returned by build_rois_index.
+    start_point : numpy array of shape (3,)
+        reference point used to orient the streamlines. If None, the start
+        point of the first streamline is used.
+
+    Returns
+    ---------
+    first_regions : numpy array of shape (N,)
+        index in rois_index of the closest region of the first endpoint of
+        each streamline.
+    last_regions : numpy array of shape (N,)
+        index in rois_index of the closest region of the last endpoint of
+        each streamline.
+    """
+    heads = np.array([s[0] for s in streamlines], dtype=np.float64)
+    tails = np.array([s[-1] for s in streamlines], dtype=np.float64)
+    if start_point is None:
+        start_point = heads[0]
 
-        closest_region_names, min_dists = find_closest_region(endpoints, rois)
-        closest_rois_pairs.append(tuple(closest_region_names))
+    # Make sure we all start from the same "orientation" for streamlines,
+    # to try to get the same region as the first region
+    heads_dists = np.sqrt(np.sum((heads - start_point) ** 2, axis=1))
+    tails_dists = np.sqrt(np.sum((tails - start_point) ** 2, axis=1))
+    flip = heads_dists > tails_dists
 
-    occurences = Counter(closest_rois_pairs)
+    first_points = np.where(flip[:, None], tails, heads)
+    last_points = np.where(flip[:, None], heads, tails)
 
-    return occurences.most_common(1)[0][0]
+    return find_closest_regions(first_points, rois_index), \
+        find_closest_regions(last_points, rois_index)
 
 
-def get_closest_roi_pairs_for_all_streamlines(streamlines, rois):
+def get_closest_roi_pairs_for_all_streamlines(streamlines, rois_index):
     """
     Find the closest pair of ROIs from the endpoints of each provided
     streamline.
-    
-    # TODO params
-    :param streamlines: 
-    :param rois: 
-    :return: 
+
+    All streamlines are oriented to start from the endpoint closest to the
+    start point of the first streamline, to try to get the same region as
+    the first region of each pair.
+
+    Parameters
+    ------------
+    streamlines : sequence of arrays
+        streamlines, in voxel space.
+    rois_index : list
+        list of (region name, KD-tree), as returned by build_rois_index.
+
+    Returns
+    ---------
+    closest_rois_pairs : list
+        list of (first region name, second region name) for each streamline.
     """
+    names = [name for name, _ in rois_index]
+    first_regions, last_regions = get_closest_rois_for_all_streamlines(
+        streamlines, rois_index)
 
-    # Needs to be 2D for cdist
-    start_point = np.reshape(streamlines[0][0], (-1, 3))
+    return [(names[f], names[l]) for f, l in zip(first_regions, last_regions)]
 
-    closest_rois_pairs = []
 
-    for s in streamlines:
-        endpoints = np.vstack([s[0], s[-1]])
-        endpoints_dists = cdist(start_point, endpoints).flatten()
+def prepare_rois_info(ROIs):
+    """
+    Prefetch information about the bundles endpoints regions of interest.
 
-        # Make sure we all start from the same "orientation" for streamlines,
-        # to try to get the same region as the first region
-        if endpoints_dists[0] > endpoints_dists[1]:
-            endpoints = np.vstack([s[-1], s[0]])
+    Parameters
+    ------------
+    ROIs : list of `:class:Nifti1Image` objects
+        the regions of interest.
 
-        closest_region_names, min_dists = find_closest_region(endpoints, rois)
-        closest_rois_pairs.append(tuple(closest_region_names))
+    Returns
+    ---------
+    rois_info : list
+        list of (region name, coordinates of the region voxels).
+    """
+    rois_info = []
+    for roi in ROIs:
+        rois_info.append((get_root_image_name(os.path.basename(roi.get_filename())),
+                          np.array(np.where(roi.get_data())).T))
 
-    return closest_rois_pairs
+    return rois_info
 
 
-def group_and_assign_ibs(candidate_streamlines, ROIs,
-                         save_ibs, save_full_ic,
-                         out_segmented_dir, base_name, ref_anat_fname):
+def cluster_and_assign_ibs(candidate_streamlines, rois_index, profiler=None,
+                           batch_size=IC_CLUSTERING_BATCH_SIZE):
+    """
+    Cluster the candidate IC and assign each cluster to an IB, without
+    saving anything.
+
+    rois_index is the list of (region name, KD-tree) returned by
+    build_rois_index.
+
+    The candidate streamlines are resampled and clustered by batches of
+    batch_size streamlines, so that only one batch of resampled streamlines
+    is kept in memory. The clusters are the same as the ones of the legacy
+    QuickBundles of dipy run on all the shuffled streamlines at once.
+
+    If profiler is set, the clustering and the assignment are measured as
+    the 'ic_clustering' and 'roi_assignment' stages.
+
+    Returns
+    ---------
+    shuffled_order : numpy array
+        indices in candidate_streamlines of the streamlines, in the order
+        used for the clustering.
+    clusters : dict
+        clusters of the shuffled streamlines. Indices of the streamlines in
+        the clusters are indices in shuffled_order.
+    ib_pairs : dict
+        for each pair of ROIs assigned to some IB, the list of indices of the
+        clusters assigned to that pair.
+    rejected_indices : numpy array
+        indices in candidate_streamlines of the rejected streamlines, in the
+        order in which they were rejected.
+    ic_counts : int
+        number of streamlines classified as IC.
+    """
     ic_counts = 0
     ib_pairs = {}
 
-    rejected_streamlines = []
+    rejected_indices = []
 
     # Start by clustering all the remaining potentiel IC using QB.
 
     # Fix seed to always generate the same output
-    # Shuffle to try to reduce the ordering dependency for QB
+    # Shuffle to try to reduce the ordering dependency for QB.
+    # The permutation is shuffled instead of the streamlines, which only
+    # produces a view on them. The permutation is the same as when shuffling
+    # the streamlines list directly.
+    shuffled_order = list(range(len(candidate_streamlines)))
     random.seed(0.2)
-    random.shuffle(candidate_streamlines)
+    random.shuffle(shuffled_order)
+    shuffled_order = np.array(shuffled_order, dtype=np.int64)
+
+    def iter_batches():
+        for start in range(0, len(shuffled_order), batch_size):
+            yield candidate_streamlines[
+                shuffled_order[start:start + batch_size]]
 
-    # TODO threshold on distance as arg for other datasets
-    out_data = qb.QuickBundles(candidate_streamlines,
-                               dist_thr=20.,
-                               pts=12)
-    clusters = out_data.clusters()
+    with profile_stage(profiler, 'ic_clustering',
+                       nb_streamlines=len(shuffled_order)) as stage:
+        # TODO threshold on distance as arg for other datasets
+        quickbundles = StreamingQuickBundles(20., 12)
+        for batch in iter_batches():
+            quickbundles.add(np.array(set_number_of_points(batch, 12),
+                                      dtype=np.float32))
+
+        clusters = quickbundles.get_clusters()
+        stage['nb_clusters'] = len(clusters)
 
     logging.debug("Found {} potential IB clusters".format(len(clusters)))
 
-    # Prefetch information about the bundles endpoints regions of interest.
-    # Is used in the get_closest_roi_pairs... function.
-    rois_info = []
-    for roi in ROIs:
-        rois_info.append((get_root_image_name(os.path.basename(roi.get_filename())),
-                          np.array(np.where(roi.get_data())).T))
+    with profile_stage(profiler, 'roi_assignment',
+                       nb_streamlines=len(shuffled_order)):
+        names = [name for name, _ in rois_index]
 
-    all_ics_closest_pairs = get_closest_roi_pairs_for_all_streamlines(candidate_streamlines, rois_info)
+        # Closest region of both endpoints of each shuffled streamline.
+        first_regions = np.zeros((len(shuffled_order),), dtype=np.int32)
+        last_regions = np.zeros((len(shuffled_order),), dtype=np.int32)
+        start_point = None
+        for batch_idx, batch in enumerate(iter_batches()):
+            if start_point is None:
+                start_point = np.asarray(batch[0][0], dtype=np.float64)
 
-    for c_idx, c in enumerate(clusters):
-        closest_for_cluster = [all_ics_closest_pairs[i] for i in clusters[c]['indices']]
+            batch_slice = slice(batch_idx * batch_size,
+                                batch_idx * batch_size + len(batch))
+            first_regions[batch_slice], last_regions[batch_slice] = \
+                get_closest_rois_for_all_streamlines(batch, rois_index,
+                                                     start_point)
 
+    for c_idx, c in enumerate(clusters):
         # Clusters containing only a single streamlines are rejected.
         if len(clusters[c]['indices']) > 1:
+            closest_for_cluster = [(names[first_regions[i]],
+                                    names[last_regions[i]])
+                                   for i in clusters[c]['indices']]
+
             ic_counts += len(clusters[c]['indices'])
             occurences = Counter(closest_for_cluster)
 
@@ -152,14 +284,43 @@ def group_and_assign_ibs(candidate_streamlines, ROIs,
             else:
                 val.append(c_idx)
         else:
-            rejected_streamlines.append(candidate_streamlines[clusters[c]['indices'][0]])
+            rejected_indices.append(shuffled_order[clusters[c]['indices'][0]])
+
+    return shuffled_order, clusters, ib_pairs, \
+        np.array(rejected_indices, dtype=np.int64), ic_counts
+
+
+def group_and_assign_ibs(candidate_streamlines, rois_index,
+                         save_ibs, save_full_ic,
+                         out_segmented_dir, base_name, ref_anat_fname,
+                         profiler=None):
+    """
+    Cluster the candidate IC and assign each cluster to an IB.
+
+    If profiler is set, the saving is also measured as the 'save_ics'
+    stage. See cluster_and_assign_ibs.
+
+    Returns
+    ---------
+    rejected_indices : numpy array
+        indices in candidate_streamlines of the rejected streamlines, in the
+        order in which they were rejected.
+    ic_counts : int
+        number of streamlines classified as IC.
+    nb_ib : int
+        number of IB.
+    """
+    shuffled_order, clusters, ib_pairs, rejected_indices, ic_counts = \
+        cluster_and_assign_ibs(candidate_streamlines, rois_index, profiler)
 
     if save_ibs or save_full_ic:
-        save_invalid_connections(ib_pairs, candidate_streamlines,
-                                 clusters, out_segmented_dir,
-                                 base_name,
-                                 ref_anat_fname,
-                                 save_full_ic=save_full_ic,
-                                 save_ibs=save_ibs)
-
-    return rejected_streamlines, ic_counts, len(ib_pairs.keys())
+        with profile_stage(profiler, 'save_ics', nb_streamlines=ic_counts):
+            save_invalid_connections(ib_pairs,
+                                     candidate_streamlines[shuffled_order],
+                                     clusters, out_segmented_dir,
+                                     base_name,
+                                     ref_anat_fname,
+                                     save_full_ic=save_full_ic,
+                                     save_ibs=save_ibs)
+
+    return rejected_indices, ic_counts, len(ib_pairs.keys())
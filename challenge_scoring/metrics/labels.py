@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+
+# The classification of the streamlines of a submission is kept as a single
+# array holding a label for each streamline. Streamlines of a valid bundle
+# are labeled with the index of the bundle in ref_bundles. The other labels
+# are negative.
+LABELS_DTYPE = np.int16
+
+# Not classified yet. After the VC extraction, all streamlines that are not
+# VC.
+UNCLASSIFIED_LABEL = -1
+
+# Invalid Connections, assigned to an invalid bundle.
+IC_LABEL = -2
+
+# No Connection, rejected by the IC clustering.
+NC_LABEL = -3
+
+# No Connection, too short to be a candidate IC.
+TOO_SHORT_LABEL = -4
+
+
+def create_labels(nb_streamlines):
+    """
+    Create the labels of nb_streamlines unclassified streamlines.
+    """
+    return np.full((nb_streamlines,), UNCLASSIFIED_LABEL, dtype=LABELS_DTYPE)
+
+
+def count_labels(labels, label):
+    """
+    Number of streamlines with the given label.
+    """
+    return int(np.count_nonzero(labels == label))
+
+
+def get_vc_mask(labels):
+    """
+    Boolean mask of the streamlines that are VC.
+    """
+    return labels >= 0
+
+
+def get_nc_mask(labels):
+    """
+    Boolean mask of the streamlines that are NC, either rejected by the IC
+    clustering or too short.
+    """
+    return (labels == NC_LABEL) | (labels == TOO_SHORT_LABEL)
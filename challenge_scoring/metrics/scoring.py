@@ -12,16 +12,40 @@ import numpy as np
 from dipy.tracking.streamline import set_number_of_points
 from dipy.segment.clustering import QuickBundles
 from dipy.segment.metric import AveragePointwiseEuclideanMetric
-from dipy.tracking.metrics import length as slength
-
-from tractconverter.formats.tck import TCK
 
 from challenge_scoring import NB_POINTS_RESAMPLE
-from challenge_scoring.io.streamlines import get_tracts_voxel_space_for_dipy, \
-                                       save_tracts_tck_from_dipy_voxel_space, \
+from challenge_scoring.io.checkpoint import ScoringCheckpoint
+from challenge_scoring.io.gt_cache import compute_gt_hash, \
+                                          get_gt_cache_filename, \
+                                          load_gt_cache, save_gt_cache
+from challenge_scoring.io.partial_results import get_partial_result_key
+from challenge_scoring.io.streamlines import count_tracts, \
+                                       get_tracts_voxel_space_for_dipy, \
+                                       load_tracts_range_voxel_space_for_dipy, \
+                                       load_tracts_voxel_space_for_dipy, \
+                                       save_invalid_connections, \
+                                       save_tracts_tck_by_indices, \
                                        save_valid_connections
-from challenge_scoring.metrics.invalid_connections import group_and_assign_ibs
-from challenge_scoring.metrics.valid_connections import auto_extract_VCs
+from challenge_scoring.metrics.bundle_coverage import get_mask_indices, \
+                                                 merge_bundles_voxels
+from challenge_scoring.metrics.invalid_connections import build_rois_index, \
+                                                     cluster_and_assign_ibs, \
+                                                     prepare_rois_info
+from challenge_scoring.metrics.labels import IC_LABEL, NC_LABEL, \
+    TOO_SHORT_LABEL, UNCLASSIFIED_LABEL, count_labels, get_nc_mask, \
+    get_vc_mask
+from challenge_scoring.metrics.valid_connections import \
+    DEFAULT_CHUNK_SIZE, auto_extract_VCs, compute_vbs_voxels, \
+    get_found_vbs_info, get_shards_bounds, plan_vc_extraction, \
+    set_vbs_coverage_scores
+from challenge_scoring.utils.profiling import profile_stage
+
+
+# Minimal length of the candidate IC. Chosen from GT dataset.
+MIN_IC_LENGTH = 35.
+
+# Number of streamlines whose length is computed at once.
+LENGTH_BLOCK_SIZE = 100000
 
 
 def _prepare_gt_bundles_info(bundles_dir, bundles_masks_dir,
@@ -48,10 +72,14 @@ def _prepare_gt_bundles_info(bundles_dir, bundles_masks_dir,
                         os.path.join(bundles_dir, bundle_f),
                         ref_anat_fname, dummy_attribs)]
 
-        resamp_bundle = set_number_of_points(orig_strl, NB_POINTS_RESAMPLE)
-        resamp_bundle = [s.astype('f4') for s in resamp_bundle]
+        # Kept as a single float32 array, as needed by the distance
+        # computations.
+        resamp_bundle = np.array(set_number_of_points(orig_strl,
+                                                      NB_POINTS_RESAMPLE),
+                                 dtype='f4').reshape(
+                                     (-1, NB_POINTS_RESAMPLE, 3))
 
-        bundle_cluster_map = qb.cluster(resamp_bundle)
+        bundle_cluster_map = qb.cluster(list(resamp_bundle))
         bundle_cluster_map.refdata = resamp_bundle
 
         bundle_mask = nib.load(os.path.join(bundles_masks_dir,
@@ -60,11 +88,156 @@ def _prepare_gt_bundles_info(bundles_dir, bundles_masks_dir,
         ref_bundles.append({'name': bundle_name,
                             'threshold': bundle_attribs['cluster_threshold'],
                             'cluster_map': bundle_cluster_map,
-                            'mask': bundle_mask})
+                            'mask_indices': get_mask_indices(bundle_mask),
+                            'mask_shape': bundle_mask.shape,
+                            'mask_affine': bundle_mask.affine})
 
     return ref_bundles
 
 
+def prepare_gt_data(base_data_dir, basic_bundles_attribs, cache_dir=None,
+                    profiler=None):
+    """
+    Load and prepare the ground truth data needed to score submissions.
+
+    Parameters
+    ------------
+    base_data_dir : string
+        path to the directory containing the scoring data.
+    basic_bundles_attribs : dictionary
+        contains the attributes of the basic bundles (name, list of streamlines,
+        segmentation threshold)
+    cache_dir : string
+        if set, path to the directory where the prepared GT data is cached.
+        The cache is keyed by a hash of the content of the scoring data, and
+        is rebuilt automatically when the scoring data changes.
+    profiler : Profiler
+        if set, used to measure the preparation of the ROIs and GT bundles.
+
+    Returns
+    ---------
+    ref_bundles : list
+        information about each GT bundle (name, threshold, cluster map, mask).
+    rois_index : list
+        list of (region name, KD-tree over the region voxels), see
+        challenge_scoring.metrics.invalid_connections.build_rois_index.
+    gt_hash : string
+        hash of the content of the scoring data, see
+        challenge_scoring.io.gt_cache.compute_gt_hash. Identifies the GT
+        data in the checkpoints, without hashing the scoring data again for
+        each submission.
+    """
+    masks_dir = os.path.join(base_data_dir, "masks")
+    rois_dir = os.path.join(masks_dir, "rois")
+    bundles_dir = os.path.join(base_data_dir, "bundles")
+    bundles_masks_dir = os.path.join(masks_dir, "bundles")
+    ref_anat_fname = os.path.join(masks_dir, "wm.nii.gz")
+
+    gt_hash = compute_gt_hash(base_data_dir, basic_bundles_attribs)
+
+    cache_fname = None
+    if cache_dir is not None:
+        cache_fname = get_gt_cache_filename(cache_dir, gt_hash)
+        cached = load_gt_cache(cache_fname)
+        if cached is not None:
+            logging.debug('Loaded GT data from cache {}'.format(cache_fname))
+            ref_bundles, rois_info = cached
+            return ref_bundles, build_rois_index(rois_info), gt_hash
+
+    with profile_stage(profiler, 'prepare_rois'):
+        ROIs = [nib.load(os.path.join(rois_dir, f))
+                for f in sorted(os.listdir(rois_dir))]
+        rois_info = prepare_rois_info(ROIs)
+
+    with profile_stage(profiler, 'prepare_gt_bundles'):
+        ref_bundles = _prepare_gt_bundles_info(bundles_dir,
+                                               bundles_masks_dir,
+                                               basic_bundles_attribs,
+                                               ref_anat_fname)
+
+    if cache_fname is not None:
+        logging.debug('Saving GT data to cache {}'.format(cache_fname))
+        save_gt_cache(cache_fname, ref_bundles, rois_info)
+
+    # The KD-trees of the ROIs are built once, and used for all submissions.
+    return ref_bundles, build_rois_index(rois_info), gt_hash
+
+
+def compute_streamlines_lengths(streamlines,
+                                block_size=LENGTH_BLOCK_SIZE):
+    """
+    Compute the length of all streamlines at once.
+
+    The norms of all segments are computed on the points buffer of the
+    streamlines, and summed per streamline with np.add.reduceat. The
+    streamlines are processed by blocks of block_size streamlines, to bound
+    the memory used by the segments.
+
+    Parameters
+    ------------
+    streamlines : ArraySequence
+        streamlines whose length is computed.
+    block_size : int
+        number of streamlines processed at once.
+
+    Returns
+    ---------
+    lengths : numpy array of float64
+        length of each streamline. Streamlines with less than two points
+        have a null length.
+    """
+    lengths = np.zeros((len(streamlines),), dtype=np.float64)
+
+    for start in range(0, len(streamlines), block_size):
+        block = streamlines[start:start + block_size]
+        block_lengths = block._lengths
+        if not block_lengths.sum():
+            continue
+
+        # Streamlines must be consecutive in the points buffer.
+        if not np.array_equal(block._offsets[1:] - block._offsets[:-1],
+                              block_lengths[:-1]):
+            block = block.copy()
+
+        points = block._data[block._offsets[0]:
+                             block._offsets[0] + block_lengths.sum()]
+        offsets = block._offsets - block._offsets[0]
+
+        # The last norm of each streamline is the distance to the next one.
+        # Norms are computed in the precision of the points, as done by
+        # dipy, but summed in float64.
+        norms = np.zeros((len(points),), dtype=points.dtype)
+        norms[:-1] = np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1))
+        norms[np.minimum(offsets + block_lengths, len(points)) - 1] = 0
+
+        sums = np.add.reduceat(norms, np.minimum(offsets, len(points) - 1),
+                               dtype=np.float64)
+        sums[block_lengths < 2] = 0
+        lengths[start:start + len(block)] = sums
+
+    return lengths
+
+
+def filter_short_streamlines(streamlines, indices,
+                             length_thres=MIN_IC_LENGTH):
+    """
+    Split streamlines between those long enough to be candidate IC and those
+    that are too short.
+
+    Returns
+    ---------
+    candidate_indices : numpy array of int64
+        indices of the streamlines at least length_thres long.
+    rejected_indices : numpy array of int64
+        indices of the streamlines shorter than length_thres.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    is_long = compute_streamlines_lengths(streamlines[indices]) >= \
+        length_thres
+
+    return indices[is_long], indices[~is_long]
+
+
 def score_submission(streamlines_fname,
                      tracts_attribs,
                      base_data_dir,
@@ -76,7 +249,17 @@ def score_submission(streamlines_fname,
                      save_VBs=False,
                      segmented_out_dir='',
                      segmented_base_name='',
-                     verbose=False):
+                     verbose=False,
+                     gt_cache_dir=None,
+                     gt_data=None,
+                     nb_processes=1,
+                     nb_threads=1,
+                     profiler=None,
+                     checkpoint_dir=None,
+                     resume=False,
+                     max_memory=None,
+                     nb_bundle_threads=1,
+                     allow_smaller_chunks=False):
     """
     Score a submission, using the following algorithm:
         1: extract all streamlines that are valid, which are classified as
@@ -120,6 +303,39 @@ def score_submission(streamlines_fname,
         the base name to use for saving segmented files.
     verbose : bool
         indicates if the algorithm needs to be verbose when logging messages.
+    gt_cache_dir : string
+        if set, path to the directory where the prepared GT data is cached.
+    gt_data : tuple
+        already prepared GT data, as returned by prepare_gt_data. Used to
+        avoid preparing the GT data for each scored submission.
+    nb_processes : int
+        number of processes used to extract the VCs.
+    nb_threads : int
+        number of threads used by each process to compute distances between
+        streamlines when extracting the VCs.
+    profiler : Profiler
+        if set, used to measure the wall time, CPU time, peak memory and
+        number of processed streamlines of each step of the algorithm. See
+        challenge_scoring.utils.profiling.
+    checkpoint_dir : string
+        if set, path to the directory where checkpoints are saved after
+        each chunk of the VC extraction and after the IC clustering.
+    resume : bool
+        if True, reuse the checkpoints found in checkpoint_dir instead of
+        computing the checkpointed steps again.
+    max_memory : int
+        if set, memory budget of the scoring in bytes, used to choose the
+        number of processes of the VC extraction. A ValueError is raised if
+        a single chunk does not fit. See
+        challenge_scoring.metrics.valid_connections.plan_vc_extraction.
+    nb_bundle_threads : int
+        number of threads used by each process to extract the GT bundles of
+        a chunk at the same time. See auto_extract_VCs.
+    allow_smaller_chunks : bool
+        if True, the chunks of the VC extraction are made smaller when a
+        single chunk does not fit in max_memory, which changes the results.
+        Cannot be used with resume, since the chunks could differ from the
+        ones of the interrupted scoring.
 
     Returns
     ---------
@@ -130,85 +346,133 @@ def score_submission(streamlines_fname,
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
 
+    if resume and allow_smaller_chunks:
+        raise ValueError('Smaller chunks cannot be allowed when resuming a '
+                         'scoring.')
+
     # Prepare needed scoring data
     logging.debug('Preparing GT data')
-    masks_dir = os.path.join(base_data_dir, "masks")
-    rois_dir = os.path.join(masks_dir, "rois")
-    bundles_dir = os.path.join(base_data_dir, "bundles")
-    bundles_masks_dir = os.path.join(masks_dir, "bundles")
-    ref_anat_fname = os.path.join(masks_dir, "wm.nii.gz")
-
-    ROIs = [nib.load(os.path.join(rois_dir, f))
-            for f in sorted(os.listdir(rois_dir))]
-
-    ref_bundles = _prepare_gt_bundles_info(bundles_dir,
-                                           bundles_masks_dir,
-                                           basic_bundles_attribs,
-                                           ref_anat_fname)
-
-    streamlines_gen = get_tracts_voxel_space_for_dipy(streamlines_fname,
-                                                      ref_anat_fname,
-                                                      tracts_attribs)
-
-    # Load all streamlines, since streamlines is a generator.
-    full_strl = [s for s in streamlines_gen]
+    ref_anat_fname = os.path.join(base_data_dir, "masks", "wm.nii.gz")
+
+    if gt_data is None:
+        with profile_stage(profiler, 'gt_preparation'):
+            gt_data = prepare_gt_data(base_data_dir, basic_bundles_attribs,
+                                      gt_cache_dir, profiler)
+    ref_bundles, rois_index, gt_hash = gt_data
+
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = ScoringCheckpoint(checkpoint_dir, streamlines_fname,
+                                       tracts_attribs, gt_hash, resume)
+
+    # Load all streamlines in a single contiguous buffer. Later stages only
+    # work on views or indices of this buffer.
+    with profile_stage(profiler, 'load') as stage:
+        full_strl = load_tracts_voxel_space_for_dipy(streamlines_fname,
+                                                     ref_anat_fname,
+                                                     tracts_attribs)
+        stage['nb_streamlines'] = len(full_strl)
 
     # Extract VCs and VBs
-    VC_indices, found_vbs_info = auto_extract_VCs(full_strl, ref_bundles)
-    VC = len(VC_indices)
+    # The classification of each streamline is kept in labels.
+    labels, found_vbs_info = auto_extract_VCs(full_strl, ref_bundles,
+                                              nb_processes, nb_threads,
+                                              profiler=profiler,
+                                              checkpoint=checkpoint,
+                                              max_memory=max_memory,
+                                              nb_bundle_threads=nb_bundle_threads,
+                                              allow_smaller_chunks=allow_smaller_chunks)
+
+    return _score_from_vc_labels(full_strl, labels, found_vbs_info, rois_index,
+                                 ref_anat_fname, save_full_vc, save_full_ic,
+                                 save_full_nc, save_IBs, save_VBs,
+                                 segmented_out_dir, segmented_base_name,
+                                 nb_threads, profiler, checkpoint)
+
+
+def _score_from_vc_labels(full_strl, labels, found_vbs_info, rois_index,
+                          ref_anat_fname, save_full_vc, save_full_ic,
+                          save_full_nc, save_IBs, save_VBs,
+                          segmented_out_dir, segmented_base_name,
+                          nb_threads=1, profiler=None, checkpoint=None):
+    # Classifies the streamlines that are not VC as IC or NC, saves the
+    # segmented files and computes the scores. labels are updated in place.
+    VC = int(np.count_nonzero(get_vc_mask(labels)))
 
     if save_VBs or save_full_vc:
-        save_valid_connections(found_vbs_info, full_strl, segmented_out_dir,
-                               segmented_base_name, ref_anat_fname,
-                               save_vbs=save_VBs, save_full_vc=save_full_vc)
+        with profile_stage(profiler, 'save_vcs', nb_streamlines=VC):
+            save_valid_connections(found_vbs_info, full_strl,
+                                   segmented_out_dir, segmented_base_name,
+                                   ref_anat_fname, save_vbs=save_VBs,
+                                   save_full_vc=save_full_vc,
+                                   nb_threads=nb_threads)
 
     logging.debug("Starting IC, IB scoring")
 
     total_strl_count = len(full_strl)
-    candidate_ic_strl_indices = sorted(set(range(total_strl_count)) - VC_indices)
-
-    candidate_ic_streamlines = []
-    rejected_streamlines = []
-
-    # Chosen from GT dataset
-    length_thres = 35.
+    candidate_ic_strl_indices = np.flatnonzero(labels == UNCLASSIFIED_LABEL)
 
     # Filter streamlines that are too short, consider them as NC
-    for idx in candidate_ic_strl_indices:
-        if slength(full_strl[idx]) >= length_thres:
-            candidate_ic_streamlines.append(full_strl[idx].astype('f4'))
-        else:
-            rejected_streamlines.append(full_strl[idx].astype('f4'))
+    with profile_stage(profiler, 'length_filter',
+                       nb_streamlines=len(candidate_ic_strl_indices)):
+        candidate_ic_indices, too_short_indices = filter_short_streamlines(
+            full_strl, candidate_ic_strl_indices)
+        labels[too_short_indices] = TOO_SHORT_LABEL
 
-    logging.debug('Found {} candidate IC'.format(len(candidate_ic_streamlines)))
-    logging.debug('Found {} streamlines that were too short'.format(len(rejected_streamlines)))
+    logging.debug('Found {} candidate IC'.format(len(candidate_ic_indices)))
+    logging.debug('Found {} streamlines that were too short'.format(len(too_short_indices)))
 
     ic_counts = 0
     nb_ib = 0
 
-    if len(candidate_ic_streamlines):
-        additional_rejected, ic_counts, nb_ib = group_and_assign_ibs(
-                                                   candidate_ic_streamlines,
-                                                   ROIs, save_IBs, save_full_ic,
-                                                   segmented_out_dir,
-                                                   segmented_base_name,
-                                                   ref_anat_fname)
-
-        rejected_streamlines.extend(additional_rejected)
-
-    if ic_counts != len(candidate_ic_strl_indices) - len(rejected_streamlines):
+    if len(candidate_ic_indices):
+        ic_results = None
+        if checkpoint is not None:
+            ic_results = checkpoint.load_ic_clustering(candidate_ic_indices)
+
+        if ic_results is None:
+            ic_results = cluster_and_assign_ibs(full_strl[candidate_ic_indices],
+                                                rois_index, profiler)
+            if checkpoint is not None:
+                checkpoint.save_ic_clustering(candidate_ic_indices,
+                                              *ic_results)
+
+        shuffled_order, ic_clusters, ib_pairs, additional_rejected, \
+            ic_counts = ic_results
+        nb_ib = len(ib_pairs.keys())
+
+        if save_IBs or save_full_ic:
+            with profile_stage(profiler, 'save_ics', nb_streamlines=ic_counts):
+                save_invalid_connections(ib_pairs,
+                                         full_strl[candidate_ic_indices[shuffled_order]],
+                                         ic_clusters, segmented_out_dir,
+                                         segmented_base_name,
+                                         ref_anat_fname,
+                                         save_full_ic=save_full_ic,
+                                         save_ibs=save_IBs,
+                                         nb_threads=nb_threads)
+
+        # Rejected indices are relative to the candidate streamlines.
+        labels[candidate_ic_indices] = IC_LABEL
+        labels[candidate_ic_indices[additional_rejected]] = NC_LABEL
+
+    if ic_counts != count_labels(labels, IC_LABEL) or \
+            count_labels(labels, UNCLASSIFIED_LABEL):
         raise ValueError("Some streamlines were not correctly assigned to NC")
 
-    if len(rejected_streamlines) > 0 and save_full_nc:
-        out_nc_fname = os.path.join(segmented_out_dir,
-                                    '{}_NC.tck'.format(segmented_base_name))
-        out_file = TCK.create(out_nc_fname)
-        save_tracts_tck_from_dipy_voxel_space(out_file, ref_anat_fname,
-                                              rejected_streamlines)
+    nc_indices = np.flatnonzero(get_nc_mask(labels))
+
+    if len(nc_indices) > 0 and save_full_nc:
+        with profile_stage(profiler, 'save_ncs',
+                           nb_streamlines=len(nc_indices)):
+            out_nc_fname = os.path.join(segmented_out_dir,
+                                        '{}_NC.tck'.format(segmented_base_name))
+            save_tracts_tck_by_indices(out_nc_fname, ref_anat_fname,
+                                       full_strl, nc_indices)
 
     VC /= total_strl_count
-    IC = (len(candidate_ic_strl_indices) - len(rejected_streamlines)) / total_strl_count
-    NC = len(rejected_streamlines) / total_strl_count
+    IC = ic_counts / total_strl_count
+    NC = len(nc_indices) / total_strl_count
     VCWP = 0
 
     nb_VB_found = [v['nb_streamlines'] > 0 for k, v in found_vbs_info.iteritems()].count(True)
@@ -239,3 +503,237 @@ def score_submission(streamlines_fname,
     scores['mean_F1'] = np.mean(list(scores['f1_score_per_bundle'].values()))
 
     return scores
+
+
+def score_submission_shard(streamlines_fname,
+                           tracts_attribs,
+                           base_data_dir,
+                           basic_bundles_attribs,
+                           shard_index,
+                           nb_shards,
+                           verbose=False,
+                           gt_cache_dir=None,
+                           gt_data=None,
+                           nb_processes=1,
+                           nb_threads=1,
+                           profiler=None,
+                           max_memory=None,
+                           nb_bundle_threads=1,
+                           chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Extract the Valid Connections (VC) of a shard of a submission.
+
+    The streamlines of the submission are split in nb_shards ranges of
+    consecutive chunks, see get_shards_bounds. The VCs of each shard can be
+    extracted on a different machine, and the partial results of all shards
+    are then merged by merge_submission_shards, which produces the same
+    scores as score_submission.
+
+    Only the streamlines of the shard are kept in memory. All shards must
+    use the same chunks, so the chunks are never made smaller to fit in
+    max_memory: a ValueError is raised instead.
+
+    Parameters
+    ------------
+    streamlines_fname : string
+        path to the file containing the streamlines.
+    tracts_attribs : dictionary
+        contains the attributes of the submission, see score_submission.
+    base_data_dir : string
+        path to the direction containing the scoring data.
+    basic_bundles_attribs : dictionary
+        contains the attributes of the basic bundles.
+    shard_index : int
+        index of the shard, from 0 to nb_shards - 1.
+    nb_shards : int
+        number of shards of the submission.
+    verbose, gt_cache_dir, gt_data, nb_processes, nb_threads, profiler,
+    max_memory, nb_bundle_threads
+        see score_submission.
+    chunk_size : int
+        number of streamlines of each chunk of the VC extraction. Must be the
+        same for all shards.
+
+    Returns
+    ---------
+    partial : dict
+        partial result of the shard, containing:
+        'key': identifies the submission and GT data, see
+            challenge_scoring.io.partial_results.get_partial_result_key.
+        'shard_bounds': (start, end) of the streamlines of the shard.
+        'chunk_size': chunk size of the VC extraction.
+        'labels': label of each streamline of the shard, either the index
+            of its valid bundle or UNCLASSIFIED_LABEL.
+        'vbs_voxels': voxels touched by each valid bundle in the shard, see
+            challenge_scoring.metrics.valid_connections.compute_vbs_voxels.
+    """
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if not 0 <= shard_index < nb_shards:
+        raise ValueError('Invalid shard {0} of {1} shards.'.format(
+            shard_index, nb_shards))
+
+    ref_anat_fname = os.path.join(base_data_dir, "masks", "wm.nii.gz")
+
+    if gt_data is None:
+        with profile_stage(profiler, 'gt_preparation'):
+            gt_data = prepare_gt_data(base_data_dir, basic_bundles_attribs,
+                                      gt_cache_dir, profiler)
+    ref_bundles, _, _ = gt_data
+
+    with profile_stage(profiler, 'load') as stage:
+        nb_streamlines = count_tracts(streamlines_fname, ref_anat_fname,
+                                      tracts_attribs)
+        shard_bounds = get_shards_bounds(nb_streamlines, nb_shards,
+                                         chunk_size)[shard_index]
+        shard_strl = load_tracts_range_voxel_space_for_dipy(
+            streamlines_fname, ref_anat_fname, tracts_attribs, *shard_bounds)
+        stage['nb_streamlines'] = len(shard_strl)
+
+    nb_processes, _ = plan_vc_extraction(ref_bundles, nb_processes,
+                                         max_memory, chunk_size,
+                                         nb_bundle_threads)
+
+    logging.debug('Extracting the VCs of streamlines [{0}, {1}['.format(
+        *shard_bounds))
+
+    # Indices in labels and found_vbs_info are relative to the shard.
+    labels, found_vbs_info = auto_extract_VCs(shard_strl, ref_bundles,
+                                              nb_processes, nb_threads,
+                                              compute_coverage=False,
+                                              profiler=profiler,
+                                              chunk_size=chunk_size,
+                                              nb_bundle_threads=nb_bundle_threads)
+
+    # The coverage scores need the voxels of the whole valid bundles, so
+    # only the voxels of the shard are kept.
+    with profile_stage(profiler, 'coverage',
+                       nb_streamlines=int(np.count_nonzero(
+                           get_vc_mask(labels)))):
+        vbs_voxels = compute_vbs_voxels(shard_strl, ref_bundles,
+                                        found_vbs_info)
+
+    return {'key': get_partial_result_key(streamlines_fname, nb_streamlines,
+                                          ref_bundles),
+            'shard_bounds': shard_bounds,
+            'chunk_size': chunk_size,
+            'labels': labels,
+            'vbs_voxels': vbs_voxels}
+
+
+def _merge_partial_results(partials, key, nb_streamlines):
+    # Checks that the partial results cover all streamlines once, with the
+    # same chunks, and merges their labels and the voxels of their valid
+    # bundles.
+    if not len(partials):
+        raise ValueError('No partial results to merge.')
+
+    for partial in partials:
+        if partial['key'] != key:
+            raise ValueError('The partial result of streamlines [{0}, {1}[ '
+                             'was produced for another tractogram or '
+                             'GT.'.format(*partial['shard_bounds']))
+
+    chunk_size = partials[0]['chunk_size']
+    if any(p['chunk_size'] != chunk_size for p in partials):
+        raise ValueError('All shards must be extracted with the same chunk '
+                         'size.')
+
+    partials = sorted(partials, key=lambda p: p['shard_bounds'])
+
+    end = 0
+    for partial in partials:
+        shard_start, shard_end = partial['shard_bounds']
+        if shard_start != end:
+            raise ValueError('Missing or overlapping shards around streamline '
+                             '{0}.'.format(min(shard_start, end)))
+        if shard_start % chunk_size:
+            raise ValueError('Shard [{0}, {1}[ does not start at a '
+                             'chunk.'.format(shard_start, shard_end))
+        if len(partial['labels']) != shard_end - shard_start:
+            raise ValueError('Shard [{0}, {1}[ has {2} labels.'.format(
+                shard_start, shard_end, len(partial['labels'])))
+        end = shard_end
+
+    if end != nb_streamlines:
+        raise ValueError('Missing shards after streamline {0}.'.format(end))
+
+    labels = np.concatenate([p['labels'] for p in partials])
+    vbs_voxels = merge_bundles_voxels([p['vbs_voxels'] for p in partials])
+
+    return labels, vbs_voxels
+
+
+def merge_submission_shards(streamlines_fname,
+                            tracts_attribs,
+                            base_data_dir,
+                            basic_bundles_attribs,
+                            partials,
+                            save_full_vc=False,
+                            save_full_ic=False,
+                            save_full_nc=False,
+                            save_IBs=False,
+                            save_VBs=False,
+                            segmented_out_dir='',
+                            segmented_base_name='',
+                            verbose=False,
+                            gt_cache_dir=None,
+                            gt_data=None,
+                            nb_threads=1,
+                            profiler=None):
+    """
+    Score a submission from the partial results of all its shards.
+
+    The labels of the shards are concatenated, and the voxels of each valid
+    bundle are the union of its voxels in each shard, so the VCs, VBs and
+    their coverage scores are the same as with score_submission. The
+    remaining steps, from the removal of short streamlines to the NC, need
+    all streamlines at once, and are run on the whole submission.
+
+    Parameters
+    ------------
+    partials : list
+        partial results of all shards, as returned by score_submission_shard
+        or challenge_scoring.io.partial_results.load_partial_result, in any
+        order.
+    Other parameters
+        see score_submission.
+
+    Returns
+    ---------
+    scores : dict
+        dictionnary containing a score for each metric, as returned by
+        score_submission.
+    """
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    ref_anat_fname = os.path.join(base_data_dir, "masks", "wm.nii.gz")
+
+    if gt_data is None:
+        with profile_stage(profiler, 'gt_preparation'):
+            gt_data = prepare_gt_data(base_data_dir, basic_bundles_attribs,
+                                      gt_cache_dir, profiler)
+    ref_bundles, rois_index, _ = gt_data
+
+    with profile_stage(profiler, 'load') as stage:
+        full_strl = load_tracts_voxel_space_for_dipy(streamlines_fname,
+                                                     ref_anat_fname,
+                                                     tracts_attribs)
+        stage['nb_streamlines'] = len(full_strl)
+
+    with profile_stage(profiler, 'merge_shards',
+                       nb_shards=len(partials)) as stage:
+        labels, vbs_voxels = _merge_partial_results(
+            partials, get_partial_result_key(streamlines_fname,
+                                             len(full_strl), ref_bundles),
+            len(full_strl))
+        found_vbs_info = get_found_vbs_info(labels, ref_bundles)
+        set_vbs_coverage_scores(ref_bundles, found_vbs_info, vbs_voxels)
+
+    return _score_from_vc_labels(full_strl, labels, found_vbs_info, rois_index,
+                                 ref_anat_fname, save_full_vc, save_full_ic,
+                                 save_full_nc, save_IBs, save_VBs,
+                                 segmented_out_dir, segmented_base_name,
+                                 nb_threads, profiler)
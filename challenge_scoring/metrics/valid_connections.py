@@ -5,23 +5,53 @@ from __future__ import division
 
 import logging
 from itertools import chain
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from dipy.segment.clustering import QuickBundles
 from dipy.segment.metric import AveragePointwiseEuclideanMetric
 from dipy.tracking.distances import bundles_distances_mdf
 from dipy.tracking.streamline import set_number_of_points
-from nibabel.streamlines import Tractogram
+from nibabel.streamlines import ArraySequence
 import numpy as np
 
 from challenge_scoring import NB_POINTS_RESAMPLE
-from challenge_scoring.metrics.bundle_coverage import compute_bundle_coverage_scores
+from challenge_scoring.metrics.bundle_coverage import \
+    compute_bundles_voxels, compute_voxels_coverage_scores
+from challenge_scoring.metrics.labels import UNCLASSIFIED_LABEL, \
+    create_labels, get_vc_mask
+from challenge_scoring.tractanalysis.streamlines_distances import \
+    streamlines_within_mdf_threshold
+from challenge_scoring.utils.profiling import Profiler, get_current_rss, \
+    profile_stage
+
+
+# Number of streamlines of each chunk of the VC extraction. The streamlines
+# are clustered chunk by chunk, so the results depend on the chunks.
+DEFAULT_CHUNK_SIZE = 5000
+
+# Smallest chunk size used when the memory budget is too small for a chunk.
+MIN_CHUNK_SIZE = 100
+
+# Approximate memory used by each numpy array object, besides its data, and
+# by each worker process, besides its chunk.
+_ARRAY_OVERHEAD = 100
+_WORKER_OVERHEAD = 32 * 2**20
 
 
 def auto_extract(model_cluster_map, submission_cluster_map,
                  number_pts_per_str=NB_POINTS_RESAMPLE,
                  close_centroids_thr=20,
-                 clean_thr=7.):
-
+                 clean_thr=7.,
+                 nb_threads=1):
+    """
+    Select the streamlines of a submission that belong to a model bundle.
+
+    The refdata of submission_cluster_map must be the submission streamlines
+    already resampled to number_pts_per_str points, as a single float32
+    array of shape (N, number_pts_per_str, 3). It is shared by the calls
+    for all model bundles, so that the streamlines are only resampled once.
+    """
     model_centroids = model_cluster_map.centroids
 
     centroid_matrix = bundles_distances_mdf(model_centroids,
@@ -29,130 +59,565 @@ def auto_extract(model_cluster_map, submission_cluster_map,
 
     centroid_matrix[centroid_matrix > close_centroids_thr] = np.inf
     mins = np.min(centroid_matrix, axis=0)
-    close_clusters = [submission_cluster_map[i]
-                      for i in np.where(mins != np.inf)[0]]
     close_indices_inter = [submission_cluster_map[i].indices
                            for i in np.where(mins != np.inf)[0]]
-    close_indices = list(chain.from_iterable(close_indices_inter))
+    close_indices = np.array(list(chain.from_iterable(close_indices_inter)),
+                             dtype=np.int64)
 
-    close_streamlines = list(chain(*close_clusters))
-    closer_streamlines = close_streamlines
+    rcloser_streamlines = submission_cluster_map.refdata[close_indices]
 
-    rcloser_streamlines = set_number_of_points(closer_streamlines,
-                                               number_pts_per_str)
+    # Only keep the streamlines within clean_thr of any model streamline,
+    # without computing the full distance matrix.
+    is_clean = streamlines_within_mdf_threshold(
+        np.asarray(model_cluster_map.refdata, dtype=np.float32),
+        np.asarray(rcloser_streamlines, dtype=np.float32).reshape(
+            (-1, number_pts_per_str, 3)),
+        clean_thr, nb_threads)
 
-    clean_matrix = bundles_distances_mdf(model_cluster_map.refdata,
-                                         rcloser_streamlines)
-
-    clean_matrix[clean_matrix > clean_thr] = np.inf
-
-    mins = np.min(clean_matrix, axis=0)
-
-    clean_indices = [i for i in np.where(mins != np.inf)[0]]
-
-    # Clean indices refer to the streamlines in closer_streamlines,
-    # which are the same as the close_streamlines. Each close_streamline
-    # has a related element in close_indices, for which the value
-    # is the index of the original streamline in the moved_streamlines.
-    final_selected_indices = [close_indices[idx] for idx in clean_indices]
+    # Clean indices refer to the streamlines in rcloser_streamlines. Each
+    # of them has a related element in close_indices, for which the value
+    # is the index of the original streamline in the chunk.
+    final_selected_indices = close_indices[is_clean]
 
     return final_selected_indices
 
 
-def auto_extract_VCs(streamlines, ref_bundles):
-    # Streamlines = list of all streamlines
-
-    VC = 0
-    VC_idx = set()
-
-    found_vbs_info = {}
-    for bundle in ref_bundles:
-        found_vbs_info[bundle['name']] = {'nb_streamlines': 0,
-                                          'streamlines_indices': set()}
-
-    # Need to bookkeep because we chunk for big datasets
-    processed_strl_count = 0
-    chunk_size = 5000
-    chunk_it = 0
-
-    nb_bundles = len(ref_bundles)
-    bundles_found = [False] * nb_bundles
-
-    logging.debug("Starting scoring VCs")
-
+def _extract_vcs_from_chunk(strl_chunk, ref_bundles, nb_threads=1,
+                            profiler=None, nb_bundle_threads=1):
+    # Returns the labels of the streamlines of the chunk: the index of the
+    # ref bundle of each streamline, or UNCLASSIFIED_LABEL.
     qb = QuickBundles(threshold=20, metric=AveragePointwiseEuclideanMetric())
 
-    # Start loop here for big datasets
-    while processed_strl_count < len(streamlines):
-        logging.debug("Starting chunk: {0}".format(chunk_it))
-
-        strl_chunk = streamlines[chunk_it * chunk_size:
-                                 (chunk_it + 1) * chunk_size]
-
-        processed_strl_count += len(strl_chunk)
-        cur_chunk_VC_idx, cur_chunk_IC_idx, cur_chunk_VCWP_idx = set(), set(), set()
-
+    with profile_stage(profiler, 'vc_chunk_clustering',
+                       nb_streamlines=len(strl_chunk)) as stage:
         # Already resample and run quickbundles on the submission chunk,
-        # to avoid doing it at every call of auto_extract
-        rstreamlines = set_number_of_points(strl_chunk, NB_POINTS_RESAMPLE)
-
-        # qb.cluster had problem with f8
-        rstreamlines = [s.astype('f4') for s in rstreamlines]
-
-        chunk_cluster_map = qb.cluster(rstreamlines)
-        chunk_cluster_map.refdata = strl_chunk
-
-        logging.debug("Starting VC identification through auto_extract")
+        # to avoid doing it at every call of auto_extract. The resampled
+        # streamlines are kept as the refdata shared by all calls. The
+        # streamlines are already float32, so they are resampled in float32.
+        rstreamlines = np.array(set_number_of_points(strl_chunk,
+                                                     NB_POINTS_RESAMPLE),
+                                dtype='f4').reshape(
+                                    (-1, NB_POINTS_RESAMPLE, 3))
+
+        chunk_cluster_map = qb.cluster(list(rstreamlines))
+        chunk_cluster_map.refdata = rstreamlines
+        stage['nb_clusters'] = len(chunk_cluster_map)
+
+    logging.debug("Starting VC identification through auto_extract")
+
+    # When the bundles are extracted by many threads, each distance
+    # computation uses a single thread.
+    if nb_bundle_threads > 1:
+        nb_threads = 1
+
+    def extract_bundle(ref_bundle):
+        # The selected indices are from [0, len(strl_chunk)]
+        return auto_extract(ref_bundle['cluster_map'],
+                            chunk_cluster_map,
+                            clean_thr=ref_bundle['threshold'],
+                            nb_threads=nb_threads)
+
+    if nb_bundle_threads > 1 and len(ref_bundles) > 1:
+        # The CPU time and peak memory are measured for the whole process,
+        # so the bundles extracted by concurrent threads are measured as a
+        # single stage.
+        nb_pool_threads = min(nb_bundle_threads, len(ref_bundles))
+        with profile_stage(profiler, 'auto_extract_bundles',
+                           nb_bundles=len(ref_bundles),
+                           nb_bundle_threads=nb_pool_threads,
+                           nb_streamlines=len(strl_chunk)) as stage:
+            pool = ThreadPool(nb_pool_threads)
+            try:
+                bundles_selected_indices = pool.map(extract_bundle,
+                                                    ref_bundles, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            stage['nb_selected'] = sum(len(indices) for indices in
+                                       bundles_selected_indices)
+    else:
+        bundles_selected_indices = []
+        for ref_bundle in ref_bundles:
+            with profile_stage(profiler, 'auto_extract',
+                               bundle=ref_bundle['name'],
+                               nb_streamlines=len(strl_chunk)) as stage:
+                bundles_selected_indices.append(extract_bundle(ref_bundle))
+                stage['nb_selected'] = len(bundles_selected_indices[-1])
+
+    # Streamlines assigned to multiple VBs are kept in the first one, as
+    # when the bundles are extracted one after the other.
+    chunk_labels = create_labels(len(strl_chunk))
+    for bundle_idx, selected_streamlines_indices in \
+            enumerate(bundles_selected_indices):
+        selected_streamlines_indices = selected_streamlines_indices[
+            chunk_labels[selected_streamlines_indices] == UNCLASSIFIED_LABEL]
+        chunk_labels[selected_streamlines_indices] = bundle_idx
+
+    return chunk_labels
+
+
+# Data shared by the worker processes extracting VCs. Set before forking the
+# pool to avoid sending the whole tractogram to each worker.
+_WORKER_STREAMLINES = None
+_WORKER_REF_BUNDLES = None
+_WORKER_NB_THREADS = 1
+_WORKER_PROFILE = False
+_WORKER_ORDER = None
+_WORKER_NB_BUNDLE_THREADS = 1
+
+
+def _init_chunk_worker(streamlines, ref_bundles, nb_threads=1,
+                       profile=False, order=None, nb_bundle_threads=1):
+    global _WORKER_STREAMLINES, _WORKER_REF_BUNDLES, _WORKER_NB_THREADS, \
+        _WORKER_PROFILE, _WORKER_ORDER, _WORKER_NB_BUNDLE_THREADS
+    _WORKER_STREAMLINES = streamlines
+    _WORKER_REF_BUNDLES = ref_bundles
+    _WORKER_NB_THREADS = nb_threads
+    _WORKER_PROFILE = profile
+    _WORKER_ORDER = order
+    _WORKER_NB_BUNDLE_THREADS = nb_bundle_threads
+
+
+def _extract_vcs_from_chunk_worker(chunk_bounds):
+    # Returns the labels of the streamlines of the chunk, and the profiling
+    # records of the chunk, which are sent back to the main process.
+    start, end = chunk_bounds
+    logging.debug("Starting chunk: [{0}, {1}[".format(start, end))
+
+    if _WORKER_ORDER is None:
+        strl_chunk = _WORKER_STREAMLINES[start:end]
+    else:
+        strl_chunk = _WORKER_STREAMLINES[_WORKER_ORDER[start:end]]
+
+    profiler = Profiler() if _WORKER_PROFILE else None
+    with profile_stage(profiler, 'vc_chunk', chunk_start=start,
+                       nb_streamlines=end - start):
+        chunk_labels = _extract_vcs_from_chunk(
+            strl_chunk, _WORKER_REF_BUNDLES, _WORKER_NB_THREADS, profiler,
+            _WORKER_NB_BUNDLE_THREADS)
+
+    return chunk_labels, \
+        profiler.records if profiler is not None else []
+
+
+def _get_masks_grid(ref_bundles):
+    # Returns the shape and affine of the grid of the GT masks, which must
+    # be the same for all bundles.
+    mask_shape = ref_bundles[0]['mask_shape']
+    mask_affine = ref_bundles[0]['mask_affine']
+    for ref_bundle in ref_bundles[1:]:
+        if tuple(ref_bundle['mask_shape']) != tuple(mask_shape) or \
+                not np.allclose(ref_bundle['mask_affine'], mask_affine):
+            raise ValueError('All ground truth masks must be defined on the '
+                             'same grid.')
+
+    return mask_shape, mask_affine
+
+
+def compute_vbs_voxels(streamlines, ref_bundles, found_vbs_info):
+    """
+    Compute the voxels touched by each valid bundle.
+
+    Parameters
+    ------------
+    streamlines : ArraySequence
+        all streamlines of the submission, in voxel space.
+    ref_bundles : list
+        information about each GT bundle, see _prepare_gt_bundles_info.
+    found_vbs_info : dict
+        information about each valid bundle, as returned by auto_extract_VCs.
+
+    Returns
+    ---------
+    vbs_voxels : list
+        voxels touched by each valid bundle, in the order of ref_bundles.
+        See challenge_scoring.metrics.bundle_coverage.compute_bundles_voxels.
+    """
+    # Streamlines are in voxel space since that's how they were
+    # loaded in the scoring function.
+    mask_shape, mask_affine = _get_masks_grid(ref_bundles)
+
+    # All bundles are computed at once, using the bundle of each VC as label.
+    vbs_indices = [found_vbs_info[ref_bundle["name"]]['streamlines_indices']
+                   for ref_bundle in ref_bundles]
+    vc_indices = np.concatenate([np.zeros((0,), dtype=np.int64)] +
+                                vbs_indices)
+    vc_labels = np.repeat(np.arange(len(ref_bundles)),
+                          [len(i) for i in vbs_indices])
+
+    return compute_bundles_voxels(streamlines[vc_indices], vc_labels,
+                                  len(ref_bundles), mask_shape, mask_affine)
+
+
+def set_vbs_coverage_scores(ref_bundles, found_vbs_info, vbs_voxels):
+    """
+    Compute the overlap, overreach and f1_score of each valid bundle from
+    the voxels it touches, and update found_vbs_info with them.
+
+    Parameters
+    ------------
+    ref_bundles : list
+        information about each GT bundle, see _prepare_gt_bundles_info.
+    found_vbs_info : dict
+        information about each valid bundle, as returned by auto_extract_VCs.
+    vbs_voxels : list
+        voxels touched by each valid bundle, see compute_vbs_voxels.
+    """
+    bundles_scores = compute_voxels_coverage_scores(
+        vbs_voxels, [ref_bundle['mask_indices'] for ref_bundle in ref_bundles])
+
+    for ref_bundle, scores in zip(ref_bundles, bundles_scores):
+        vb_info = found_vbs_info[ref_bundle["name"]]
+        vb_info['overlap'] = scores.get("OL", 0)
+        vb_info['overreach'] = scores.get("OR", 0)
+        vb_info['overreach_norm'] = scores.get("ORn", 0)
+        vb_info['f1_score'] = scores.get("F1", 0)
 
-        for bundle_idx, ref_bundle in enumerate(ref_bundles):
-            # The selected indices are from [0, len(strl_chunk)]
-            selected_streamlines_indices = auto_extract(ref_bundle['cluster_map'],
-                                                        chunk_cluster_map,
-                                                        clean_thr=ref_bundle['threshold'])
 
-            # Remove duplicates, when streamlines are assigned to multiple VBs.
-            selected_streamlines_indices = set(selected_streamlines_indices) - \
-                                           cur_chunk_VC_idx
-            cur_chunk_VC_idx |= selected_streamlines_indices
+def compute_vbs_coverage_scores(streamlines, ref_bundles, found_vbs_info):
+    """
+    Compute the overlap, overreach and f1_score of each valid bundle, and
+    update found_vbs_info with them.
+
+    Parameters
+    ------------
+    streamlines : ArraySequence
+        all streamlines of the submission, in voxel space.
+    ref_bundles : list
+        information about each GT bundle, see _prepare_gt_bundles_info.
+    found_vbs_info : dict
+        information about each valid bundle, as returned by auto_extract_VCs.
+    """
+    set_vbs_coverage_scores(ref_bundles, found_vbs_info,
+                            compute_vbs_voxels(streamlines, ref_bundles,
+                                               found_vbs_info))
+
+
+def get_found_vbs_info(labels, ref_bundles):
+    """
+    Derive the information about each valid bundle from the labels of the
+    streamlines.
+
+    Parameters
+    ------------
+    labels : numpy array
+        label of each streamline, see challenge_scoring.metrics.labels.
+    ref_bundles : list
+        information about each GT bundle, see _prepare_gt_bundles_info.
+
+    Returns
+    ---------
+    found_vbs_info : dict
+        for the name of each GT bundle, the 'nb_streamlines' of the valid
+        bundle and their sorted 'streamlines_indices'.
+    """
+    vc_indices = np.flatnonzero(get_vc_mask(labels))
+    vc_labels = labels[vc_indices]
+
+    # The sort is stable, so the indices stay sorted in each bundle.
+    vc_indices = vc_indices[np.argsort(vc_labels, kind='mergesort')]
+    counts = np.bincount(vc_labels, minlength=len(ref_bundles))
+    vbs_indices = np.split(vc_indices, np.cumsum(counts)[:-1])
 
-            nb_selected_streamlines = len(selected_streamlines_indices)
+    found_vbs_info = {}
+    for ref_bundle, count, vb_indices in zip(ref_bundles, counts,
+                                             vbs_indices):
+        found_vbs_info[ref_bundle['name']] = {
+            'nb_streamlines': int(count),
+            'streamlines_indices': vb_indices.astype(np.int64)}
+
+    return found_vbs_info
+
+
+def get_consecutive_chunks(streamlines, chunk_size):
+    """
+    Split the streamlines in chunks of chunk_size consecutive streamlines.
+
+    This is the default chunking strategy of auto_extract_VCs. A chunking
+    strategy is a function with the same arguments and return values, which
+    can reorder the streamlines before splitting them, for example to group
+    streamlines that are spatially close.
+
+    Returns
+    ---------
+    order : numpy array
+        indices of the streamlines in the order in which they are chunked,
+        or None to keep their order.
+    chunks_bounds : list
+        (start, end) of each chunk in order.
+    """
+    return None, [(start, min(start + chunk_size, len(streamlines)))
+                  for start in range(0, len(streamlines), chunk_size)]
+
+
+def get_shards_bounds(nb_streamlines, nb_shards,
+                      chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split the streamlines in nb_shards ranges of consecutive chunks, whose
+    VCs can be extracted separately.
+
+    Each shard starts at the start of a chunk, so that extracting the VCs of
+    each shard with the same chunk_size produces the same chunks, and the
+    same VCs, as extracting the VCs of all streamlines at once.
+
+    Returns
+    ---------
+    shards_bounds : list
+        (start, end) of each shard in order. Shards can be empty when there
+        are more shards than chunks.
+    """
+    nb_chunks = (nb_streamlines + chunk_size - 1) // chunk_size
+    shards_chunks = np.concatenate(
+        ([0], np.cumsum([len(c) for c in np.array_split(np.arange(nb_chunks),
+                                                        nb_shards)])))
+
+    return [(min(int(first) * chunk_size, nb_streamlines),
+             min(int(last) * chunk_size, nb_streamlines))
+            for first, last in zip(shards_chunks[:-1], shards_chunks[1:])]
+
+
+def estimate_chunk_memory(ref_bundles, chunk_size, nb_bundle_threads=1):
+    """
+    Estimate the peak memory used to extract the VCs of a chunk, in bytes.
+
+    The chunk itself is a view on the streamlines and is not counted. Each
+    streamline of the chunk is resampled once (in a list of arrays, then in a
+    single float32 array) and can start a cluster, whose centroid is compared
+    to each centroid of a GT bundle. The resampled streamlines of the close
+    clusters are then gathered for each GT bundle, by nb_bundle_threads
+    bundles at the same time.
+    """
+    resampled = NB_POINTS_RESAMPLE * 3 * 4
+    centroid = NB_POINTS_RESAMPLE * 3 * 4 + _ARRAY_OVERHEAD
+    nb_model_centroids = max([len(b['cluster_map']) for b in ref_bundles] +
+                             [1])
+
+    nb_bundle_threads = max(1, min(nb_bundle_threads, len(ref_bundles)))
+
+    return chunk_size * ((2 + nb_bundle_threads) * resampled +
+                         _ARRAY_OVERHEAD + centroid +
+                         (8 + 8 * nb_model_centroids) * nb_bundle_threads + 8)
+
+
+def plan_vc_extraction(ref_bundles, nb_processes=1, max_memory=None,
+                       chunk_size=DEFAULT_CHUNK_SIZE, nb_bundle_threads=1,
+                       allow_smaller_chunks=False):
+    """
+    Choose the number of processes and the chunk size of the VC extraction,
+    to stay under a memory budget.
+
+    The budget only limits the number of chunks extracted at the same time,
+    which does not change the results. If a single chunk does not fit in
+    the budget, a ValueError is raised, unless allow_smaller_chunks is True.
+    Smaller chunks change the results, and since the budget left depends on
+    the memory currently used, the same scoring can then produce different
+    results from one run to the other.
+
+    Parameters
+    ------------
+    ref_bundles : list
+        information about each GT bundle, see _prepare_gt_bundles_info.
+    nb_processes : int
+        maximal number of processes.
+    max_memory : int
+        memory budget of the whole scoring, in bytes, including the memory
+        already used by the current process. If None, there is no budget.
+    chunk_size : int
+        number of streamlines of each chunk, when it fits in the budget.
+    nb_bundle_threads : int
+        number of threads extracting GT bundles at the same time in each
+        process.
+    allow_smaller_chunks : bool
+        if True, the chunks are made smaller when a single chunk does not
+        fit in the budget, and a warning is logged.
+
+    Returns
+    ---------
+    nb_processes : int
+        number of processes to use.
+    chunk_size : int
+        number of streamlines of each chunk.
+    """
+    if max_memory is None:
+        return nb_processes, chunk_size
+
+    available = max_memory - (get_current_rss() or 0)
+    chunk_memory = estimate_chunk_memory(ref_bundles, chunk_size,
+                                         nb_bundle_threads)
+
+    if available >= chunk_memory:
+        # With a single process, the current process extracts the chunks
+        # itself. Otherwise, each worker process needs its own memory.
+        planned_processes = max(1, min(nb_processes, int(
+            available // (chunk_memory + _WORKER_OVERHEAD))))
+        if planned_processes < nb_processes:
+            logging.info('Using {0} processes instead of {1} to extract the '
+                         'VCs, to stay under {2} MB.'.format(
+                             planned_processes, nb_processes,
+                             max_memory // 2**20))
+        return planned_processes, chunk_size
+
+    if not allow_smaller_chunks:
+        raise ValueError('Chunks of {0} streamlines do not fit in {1} MB. '
+                         'Increase the memory budget, or allow smaller '
+                         'chunks, which changes the results.'.format(
+                             chunk_size, max_memory // 2**20))
+
+    per_streamline = estimate_chunk_memory(ref_bundles, 1, nb_bundle_threads)
+    planned_chunk_size = max(MIN_CHUNK_SIZE,
+                             int(max(available, 0) // per_streamline))
+    logging.warning('Chunks of {0} streamlines do not fit in {1} MB. Using '
+                    'chunks of {2} streamlines, which changes the '
+                    'results.'.format(chunk_size, max_memory // 2**20,
+                                      planned_chunk_size))
+    return 1, min(chunk_size, planned_chunk_size)
+
+
+def auto_extract_VCs(streamlines, ref_bundles, nb_processes=1, nb_threads=1,
+                     compute_coverage=True, profiler=None, checkpoint=None,
+                     max_memory=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                     chunking=get_consecutive_chunks, nb_bundle_threads=1,
+                     allow_smaller_chunks=False):
+    """
+    Extract the Valid Connections (VC) of a submission.
+
+    Parameters
+    ------------
+    streamlines : ArraySequence
+        all streamlines of the submission, in voxel space.
+    ref_bundles : list
+        information about each GT bundle, see _prepare_gt_bundles_info.
+    nb_processes : int
+        number of processes used to extract the VCs. Chunks of streamlines
+        are independent and are dispatched to a pool of processes when
+        larger than 1. Results are merged in chunk order, and are identical
+        to the results of a single process.
+    nb_threads : int
+        number of threads used by each process to compute distances between
+        streamlines. Ignored when nb_bundle_threads is larger than 1.
+    compute_coverage : bool
+        if True, also compute the coverage scores of each valid bundle. See
+        compute_vbs_coverage_scores.
+    profiler : Profiler
+        if set, used to measure the extraction, each chunk and each call to
+        auto_extract. When nb_bundle_threads is larger than 1, the calls to
+        auto_extract of a chunk run concurrently, and are measured together
+        as a single 'auto_extract_bundles' stage, since the CPU time and
+        peak memory are measured for the whole process. The chunks processed
+        by worker processes are measured in the workers, and their records
+        are added to profiler.
+    checkpoint : ScoringCheckpoint
+        if set, the results of each chunk are saved to a checkpoint as soon
+        as they are merged, and chunks found in the checkpoint are not
+        extracted again. Only used with chunks of consecutive streamlines.
+    max_memory : int
+        if set, memory budget in bytes, used to choose the number of
+        processes. See plan_vc_extraction.
+    chunk_size : int
+        number of streamlines of each chunk.
+    chunking : callable
+        chunking strategy, see get_consecutive_chunks.
+    nb_bundle_threads : int
+        number of threads used by each process to extract the GT bundles of
+        a chunk at the same time. If larger than 1, each distance
+        computation uses a single thread. Duplicates between bundles are
+        then removed in bundle order, so the results are identical.
+    allow_smaller_chunks : bool
+        if True, the chunks are made smaller when a single chunk does not
+        fit in max_memory, which changes the results. See
+        plan_vc_extraction.
+
+    Returns
+    ---------
+    labels : numpy array of int16
+        label of each streamline: the index in ref_bundles of its valid
+        bundle, or UNCLASSIFIED_LABEL for the streamlines that are not VC.
+        See challenge_scoring.metrics.labels.
+    found_vbs_info : dict
+        information about each valid bundle, see get_found_vbs_info.
+    """
+    if not isinstance(streamlines, ArraySequence):
+        streamlines = ArraySequence(streamlines)
+
+    labels = create_labels(len(streamlines))
 
-            if nb_selected_streamlines:
-                bundles_found[bundle_idx] = True
-                VC += nb_selected_streamlines
+    # Need to bookkeep because we chunk for big datasets
+    nb_processes, chunk_size = plan_vc_extraction(ref_bundles, nb_processes,
+                                                  max_memory, chunk_size,
+                                                  nb_bundle_threads,
+                                                  allow_smaller_chunks)
+    order, chunks_bounds = chunking(streamlines, chunk_size)
 
-                # Shift indices to match the real number of streamlines
-                global_select_strl_indices = set([v + chunk_it * chunk_size
-                                                 for v in selected_streamlines_indices])
-                vb_info = found_vbs_info.get(ref_bundle['name'])
-                vb_info['nb_streamlines'] += nb_selected_streamlines
-                vb_info['streamlines_indices'] |= global_select_strl_indices
+    if order is not None and checkpoint is not None:
+        logging.debug('Chunks are not checkpointed when the streamlines are '
+                      'reordered.')
+        checkpoint = None
 
-                VC_idx |= global_select_strl_indices
-            else:
-                global_select_strl_indices = set()
+    logging.debug("Starting scoring VCs")
 
-        chunk_it += 1
+    profile = profiler is not None
+
+    # Chunks already extracted by an interrupted run.
+    checkpointed_results = {}
+    if checkpoint is not None:
+        for chunk_bounds in chunks_bounds:
+            chunk_labels = checkpoint.load_vc_chunk(chunk_bounds)
+            if chunk_labels is not None:
+                checkpointed_results[chunk_bounds] = chunk_labels
+    pending_bounds = [b for b in chunks_bounds
+                      if b not in checkpointed_results]
+
+    # The pool is created and joined in the stage, to measure the CPU time of
+    # the worker processes.
+    with profile_stage(profiler, 'vc_extraction',
+                       nb_streamlines=len(streamlines)) as stage:
+        pool = None
+        if nb_processes > 1 and len(pending_bounds) > 1:
+            pool = multiprocessing.Pool(min(nb_processes, len(pending_bounds)),
+                                        initializer=_init_chunk_worker,
+                                        initargs=(streamlines, ref_bundles,
+                                                  nb_threads, profile, order,
+                                                  nb_bundle_threads))
+            pending_results = pool.imap(_extract_vcs_from_chunk_worker,
+                                        pending_bounds)
+        else:
+            _init_chunk_worker(streamlines, ref_bundles, nb_threads, profile,
+                               order, nb_bundle_threads)
+            pending_results = (_extract_vcs_from_chunk_worker(b)
+                               for b in pending_bounds)
+
+        try:
+            # Merge in chunk order, to always get the same results.
+            for chunk_bounds in chunks_bounds:
+                chunk_start, chunk_end = chunk_bounds
+                chunk_labels = checkpointed_results.get(chunk_bounds)
+
+                if chunk_labels is None:
+                    chunk_labels, chunk_records = next(pending_results)
+                    if profiler is not None:
+                        profiler.add_records(chunk_records)
+                    if checkpoint is not None:
+                        checkpoint.save_vc_chunk(chunk_bounds, chunk_labels)
+
+                # Chunks are disjoint, so their labels are simply copied.
+                if order is None:
+                    labels[chunk_start:chunk_end] = chunk_labels
+                else:
+                    labels[order[chunk_start:chunk_end]] = chunk_labels
+        finally:
+            _init_chunk_worker(None, None)
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        found_vbs_info = get_found_vbs_info(labels, ref_bundles)
+        stage['nb_vc'] = int(np.count_nonzero(get_vc_mask(labels)))
 
     # Compute bundle overlap, overreach and f1_scores and update found_vbs_info
-    for bundle_idx, ref_bundle in enumerate(ref_bundles):
-        bundle_name = ref_bundle["name"]
-        bundle_mask = ref_bundle["mask"]
-
-        vb_info = found_vbs_info[bundle_name]
-
-        # Streamlines are in voxel space since that's how they were
-        # loaded in the scoring function.
-        tractogram = Tractogram(streamlines=(streamlines[i] for i in vb_info['streamlines_indices']),
-                                affine_to_rasmm=bundle_mask.affine)
-
-        scores = {}
-        if len(tractogram) > 0:
-            scores = compute_bundle_coverage_scores(tractogram, bundle_mask)
-
-        vb_info['overlap'] = scores.get("OL", 0)
-        vb_info['overreach'] = scores.get("OR", 0)
-        vb_info['overreach_norm'] = scores.get("ORn", 0)
-        vb_info['f1_score'] = scores.get("F1", 0)
+    if compute_coverage:
+        with profile_stage(profiler, 'coverage',
+                           nb_streamlines=stage['nb_vc']):
+            compute_vbs_coverage_scores(streamlines, ref_bundles,
+                                        found_vbs_info)
 
-    return VC_idx, found_vbs_info
+    return labels, found_vbs_info
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from challenge_scoring.io.checkpoint import ScoringCheckpoint
+
+
+def _get_checkpoint(tmp_dir, resume):
+    tractogram_fname = os.path.join(tmp_dir, 'tracts.tck')
+    if not os.path.isfile(tractogram_fname):
+        open(tractogram_fname, 'w').close()
+
+    return ScoringCheckpoint(os.path.join(tmp_dir, 'checkpoints'),
+                             tractogram_fname,
+                             {'orientation': 'RAS', 'format': 'tck'},
+                             'gt_hash', resume)
+
+
+def _get_ic_results():
+    shuffled_order = np.array([2, 0, 1], dtype=np.int64)
+    clusters = {0: {'indices': [0, 1]}, 1: {'indices': [2]}}
+    ib_pairs = {('roi_0', 'roi_1'): [0]}
+    rejected_indices = np.array([1], dtype=np.int64)
+
+    return shuffled_order, clusters, ib_pairs, rejected_indices, 2
+
+
+def test_resume_with_other_chunks():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # First run, with chunks of 5 streamlines.
+        checkpoint = _get_checkpoint(tmp_dir, resume=False)
+        checkpoint.save_vc_chunk((0, 5), np.zeros((5,), dtype=np.int16))
+        checkpoint.save_vc_chunk((5, 10), np.zeros((5,), dtype=np.int16))
+        candidates = np.array([3, 6, 8], dtype=np.int64)
+        checkpoint.save_ic_clustering(candidates, *_get_ic_results())
+
+        # The resumed run uses chunks of 4 streamlines, which produce other
+        # candidate IC.
+        checkpoint = _get_checkpoint(tmp_dir, resume=True)
+        assert checkpoint.load_vc_chunk((0, 4)) is None
+        assert checkpoint.load_vc_chunk((4, 8)) is None
+        assert checkpoint.load_ic_clustering(
+            np.array([3, 7, 8], dtype=np.int64)) is None
+
+        # The same candidates reuse the clustering.
+        shuffled_order, clusters, ib_pairs, rejected_indices, ic_counts = \
+            checkpoint.load_ic_clustering(candidates)
+        expected = _get_ic_results()
+        assert_array_equal(shuffled_order, expected[0])
+        assert_array_equal(clusters[0]['indices'], [0, 1])
+        assert_array_equal(clusters[1]['indices'], [2])
+        assert ib_pairs == expected[2]
+        assert_array_equal(rejected_indices, expected[3])
+        assert ic_counts == expected[4]
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import nibabel as nb
+from nibabel.streamlines import Tractogram, TrkFile
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+from challenge_scoring.io.streamlines import get_tracts_voxel_space, \
+    load_tracts_voxel_space_for_dipy
+
+
+# TRK grid of 2 mm voxels, with a flipped x axis. It differs from the
+# reference grid, which has 1 mm voxels and the RAS orientation.
+TRK_VOXEL_TO_RASMM = np.array([[-2., 0., 0., 38.],
+                               [0., 2., 0., 0.],
+                               [0., 0., 2., 0.],
+                               [0., 0., 0., 1.]])
+
+# Points of the streamline, in the voxmm space of the TRK file.
+TRK_VOXMM = np.array([[4., 6., 8.],
+                      [10., 12., 14.]])
+
+# Same points in RAS mm, as read by nibabel.streamlines, which considers
+# that (0, 0, 0) is the center of a voxel: A . (voxmm / 2 - 0.5).
+TRK_RASMM = np.array([[35., 5., 7.],
+                      [29., 11., 13.]])
+
+# Same points as read by the previous loader, nb.trackvis in 'rasmm',
+# which considers that (0, 0, 0) is the corner of a voxel: A . (voxmm / 2).
+OLD_TRK_RASMM = np.array([[34., 6., 8.],
+                          [28., 12., 14.]])
+
+
+def _write_data(tmp_dir):
+    ref_anat_fname = os.path.join(tmp_dir, 'wm.nii.gz')
+    nb.save(nb.Nifti1Image(np.zeros((40, 40, 40), dtype=np.uint8),
+                           np.eye(4)), ref_anat_fname)
+
+    header = {'voxel_to_rasmm': TRK_VOXEL_TO_RASMM,
+              'voxel_sizes': np.array([2., 2., 2.], dtype='f4'),
+              'dimensions': np.array([20, 20, 20], dtype='i2'),
+              'voxel_order': ''.join(nb.aff2axcodes(TRK_VOXEL_TO_RASMM))}
+    trk_fname = os.path.join(tmp_dir, 'tracts.trk')
+    TrkFile(Tractogram([TRK_RASMM.astype('f4')], affine_to_rasmm=np.eye(4)),
+            header=header).save(trk_fname)
+
+    return trk_fname, ref_anat_fname
+
+
+def test_trk_alignment_on_other_grid():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        trk_fname, ref_anat_fname = _write_data(tmp_dir)
+        attribs = {'orientation': 'unknown', 'format': 'trk'}
+
+        # The reference grid is the identity, so the voxel coordinates are
+        # the previous RAS mm coordinates, plus the previous shifts.
+        streamlines = load_tracts_voxel_space_for_dipy(trk_fname,
+                                                       ref_anat_fname,
+                                                       attribs)
+        assert_array_almost_equal(streamlines[0], OLD_TRK_RASMM + 0.5)
+
+        streamlines = list(get_tracts_voxel_space(trk_fname, ref_anat_fname,
+                                                  attribs))
+        assert_array_almost_equal(streamlines[0], OLD_TRK_RASMM)
+    finally:
+        shutil.rmtree(tmp_dir)
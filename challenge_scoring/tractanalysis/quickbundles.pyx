@@ -0,0 +1,208 @@
+# encoding: utf-8
+#cython: profile=False
+
+from __future__ import division
+
+cimport cython
+import numpy as np
+cimport numpy as np
+
+from libc.math cimport sqrt
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int c_direct_flip_dist_below(float *a, float *b,
+                                         np.npy_intp rows, float bound,
+                                         float *out) nogil:
+    # Computes the direct and flipped average pointwise distances between a
+    # and b in out, and returns 1.
+    # Uses the same arithmetic as track_direct_flip_dist of dipy, used by
+    # the legacy QuickBundles, so that the distances are the same.
+    # Both sums can only grow, so the computation stops, returning 0, as
+    # soon as both distances are known to be at least bound.
+    cdef:
+        np.npy_intp i=0, j=0
+        float sub=0, subf=0, distf=0, dist=0, tmprow=0, tmprowf=0
+
+    for i in range(rows):
+        tmprow = 0
+        tmprowf = 0
+        for j in range(3):
+            sub = a[i * 3 + j] - b[i * 3 + j]
+            subf = a[i * 3 + j] - b[(rows - 1 - i) * 3 + j]
+            tmprow += sub * sub
+            tmprowf += subf * subf
+        dist += sqrt(tmprow)
+        distf += sqrt(tmprowf)
+
+        if dist / <float>rows >= bound and distf / <float>rows >= bound:
+            return 0
+
+    out[0] = dist / <float>rows
+    out[1] = distf / <float>rows
+    return 1
+
+
+cdef class StreamingQuickBundles:
+    """ QuickBundles clustering of streamlines added by batches.
+
+    Produces the same clusters as the legacy QuickBundles of dipy
+    (dipy.segment.quickbundles) run on all the streamlines at once, in the
+    order in which they are added. Only the sum of the streamlines of each
+    cluster, its centroid and the cluster of each streamline are kept, so
+    that the streamlines themselves can be discarded after each batch.
+
+    Parameters
+    ----------
+    threshold : double
+        a streamline is added to the closest cluster if its minimum
+        direct-flip distance to the centroid of the cluster is smaller than
+        threshold. Otherwise, it starts a new cluster.
+    nb_points : int
+        number of points of all the streamlines.
+    """
+    cdef readonly double threshold
+    cdef readonly np.npy_intp nb_points
+    cdef readonly np.npy_intp nb_clusters
+    cdef readonly np.npy_intp nb_streamlines
+    cdef object _sums
+    cdef object _centroids
+    cdef object _sizes
+    cdef object _assignments
+
+    def __init__(self, double threshold, int nb_points):
+        self.threshold = threshold
+        self.nb_points = nb_points
+        self.nb_clusters = 0
+        self.nb_streamlines = 0
+        self._sums = np.zeros((0, nb_points * 3), dtype=np.float32)
+        self._centroids = np.zeros((0, nb_points * 3), dtype=np.float32)
+        self._sizes = np.zeros((0,), dtype=np.int64)
+        self._assignments = np.zeros((0,), dtype=np.int32)
+
+    def _reserve(self, np.npy_intp nb_new_streamlines):
+        # Each new streamline can start a new cluster.
+        cdef np.npy_intp needed = self.nb_clusters + nb_new_streamlines
+        if needed > len(self._sizes):
+            capacity = max(needed, 2 * len(self._sizes))
+            self._sums = np.resize(self._sums, (capacity, self.nb_points * 3))
+            self._centroids = np.resize(self._centroids,
+                                        (capacity, self.nb_points * 3))
+            self._sizes = np.resize(self._sizes, (capacity,))
+
+        needed = self.nb_streamlines + nb_new_streamlines
+        if needed > len(self._assignments):
+            capacity = max(needed, 2 * len(self._assignments))
+            self._assignments = np.resize(self._assignments, (capacity,))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def add(self, streamlines):
+        """ Cluster a batch of streamlines.
+
+        Parameters
+        ----------
+        streamlines : numpy array of shape (N, nb_points, 3)
+            streamlines to add, after the streamlines of the previous
+            batches.
+        """
+        cdef float[:, :, ::1] strl = np.ascontiguousarray(streamlines,
+                                                          dtype=np.float32)
+        cdef np.npy_intp nb_strl = strl.shape[0]
+        cdef np.npy_intp rows = self.nb_points
+
+        if nb_strl == 0:
+            return
+
+        if strl.shape[1] != rows:
+            raise ValueError('All streamlines must have {0} points.'.format(
+                rows))
+
+        self._reserve(nb_strl)
+
+        cdef float[:, ::1] sums = self._sums
+        cdef float[:, ::1] centroids = self._centroids
+        cdef np.int64_t[::1] sizes = self._sizes
+        cdef np.int32_t[::1] assignments = self._assignments
+
+        cdef np.npy_intp nb_clusters = self.nb_clusters
+        cdef np.npy_intp first = self.nb_streamlines
+        cdef float threshold = self.threshold
+        cdef float d[2]
+        cdef float m_d
+        cdef float *ptr
+        cdef np.npy_intp s, k, i, j, i_k
+        cdef int flip, flip_k
+
+        with nogil:
+            for s in range(nb_strl):
+                ptr = &strl[s, 0, 0]
+
+                # Only clusters closer than threshold can be selected, so
+                # the search starts with the threshold as the bound.
+                m_d = threshold
+                i_k = -1
+                flip = 0
+                for k in range(nb_clusters):
+                    if not c_direct_flip_dist_below(ptr, &centroids[k, 0],
+                                                    rows, m_d, d):
+                        continue
+
+                    flip_k = 0
+                    if d[1] < d[0]:
+                        d[0] = d[1]
+                        flip_k = 1
+
+                    if d[0] < m_d:
+                        m_d = d[0]
+                        i_k = k
+                        flip = flip_k
+
+                if i_k >= 0:
+                    if flip:
+                        for i in range(rows):
+                            for j in range(3):
+                                sums[i_k, i * 3 + j] += ptr[(rows - 1 - i) * 3 + j]
+                    else:
+                        for i in range(rows * 3):
+                            sums[i_k, i] += ptr[i]
+                    sizes[i_k] += 1
+
+                    for i in range(rows * 3):
+                        centroids[i_k, i] = sums[i_k, i] / <float>sizes[i_k]
+                else:
+                    i_k = nb_clusters
+                    nb_clusters += 1
+                    for i in range(rows * 3):
+                        sums[i_k, i] = ptr[i]
+                        centroids[i_k, i] = ptr[i]
+                    sizes[i_k] = 1
+
+                assignments[first + s] = i_k
+
+        self.nb_clusters = nb_clusters
+        self.nb_streamlines += nb_strl
+
+    def get_clusters(self):
+        """ Return the clusters, in the format of the legacy QuickBundles.
+
+        Returns
+        -------
+        clusters : dict
+            for each cluster index, a dictionary whose 'indices' are the
+            indices of the streamlines of the cluster, in the order in which
+            they were added.
+        """
+        sizes = self._sizes[:self.nb_clusters]
+        order = np.argsort(self._assignments[:self.nb_streamlines],
+                           kind='mergesort').astype(np.int64)
+
+        if self.nb_clusters == 0:
+            return {}
+
+        return dict((c, {'indices': indices})
+                    for c, indices in enumerate(
+                        np.split(order, np.cumsum(sizes)[:-1])))
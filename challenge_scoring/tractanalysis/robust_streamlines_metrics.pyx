@@ -7,15 +7,30 @@
 
 from __future__ import division
 
+import multiprocessing
+
 cimport cython
+from cython cimport floating
+from cython.parallel import prange, threadid
+from nibabel.streamlines import ArraySequence
 import numpy as np
 cimport numpy as np
 
 from libc.math cimport sqrt, floor, ceil, fabs
+from libc.stdlib cimport malloc, realloc, free, qsort
 
 cdef extern from "c_math.h" nogil:
       double fmin(double x, double y)
 
+cdef extern from *:
+    """
+    static CYTHON_INLINE void atomic_increment(npy_uint32 *value) {
+        #pragma omp atomic
+        (*value)++;
+    }
+    """
+    void atomic_increment(np.uint32_t *value) nogil
+
 # Changing this to a memview was slower.
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -29,163 +44,548 @@ cdef inline double norm(double x, double y, double z) nogil:
 @cython.wraparound(False)
 cdef inline void c_get_closest_edge(double p_x, double p_y, double p_z,
                                     double d_x, double d_y, double d_z,
-                                    np.double_t[:] edge,
+                                    double *edge,
                                     double eps=1.) nogil:
      edge[0] = floor(p_x + eps) if d_x >= 0.0 else ceil(p_x - eps)
      edge[1] = floor(p_y + eps) if d_y >= 0.0 else ceil(p_y - eps)
      edge[2] = floor(p_z + eps) if d_z >= 0.0 else ceil(p_z - eps)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int c_tag_voxel(np.npy_intp el_no,
+                            np.int32_t *touched_tags,
+                            np.int32_t tag,
+                            np.int64_t *voxels,
+                            np.npy_intp *nb_voxels,
+                            np.npy_intp max_voxels) nogil:
+    # Returns -1 if the voxel could not be added to the voxels buffer.
+    if touched_tags != NULL:
+        if touched_tags[el_no] == tag:
+            return 0
+    elif nb_voxels[0] > 0 and voxels[nb_voxels[0] - 1] == el_no:
+        # Without touched tags, only consecutive duplicates are skipped.
+        return 0
+
+    if nb_voxels[0] >= max_voxels:
+        return -1
+    voxels[nb_voxels[0]] = el_no
+    nb_voxels[0] += 1
+
+    if touched_tags != NULL:
+        touched_tags[el_no] = tag
+
+    return 0
+
+
+cdef int c_compare_int64(const void *a, const void *b) nogil:
+    cdef np.int64_t va = (<np.int64_t *>a)[0]
+    cdef np.int64_t vb = (<np.int64_t *>b)[0]
+    return (va > vb) - (va < vb)
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-# IMPORTANT: Streamlines should be in voxel space, aligned to corner.
-def compute_robust_tract_counts_map(streamlines, vol_dims):
-    flags = np.seterr(divide="ignore", under="ignore")
+cdef int c_traverse_streamline(floating *t, np.npy_intp nb_points,
+                               int *vd, int *vo,
+                               np.int32_t *touched_tags,
+                               np.int32_t tag,
+                               np.int64_t *voxels,
+                               np.npy_intp *nb_voxels,
+                               np.npy_intp max_voxels) nogil:
+    # Tags all voxels traversed by the streamline t, of shape (nb_points, 3).
+    # The tags cover the box of dimensions vd starting at voxel vo, and the
+    # streamline must not leave this box.
+    # Tagged voxels are appended to voxels. A voxel is tagged only once per
+    # tag value, when its touched tag is not already set to tag. When
+    # touched_tags is NULL, only consecutive duplicates are skipped.
+    # Returns -1 if the voxels buffer is full.
+    # Points are converted to double, since the traversal needs the accuracy.
+    cdef double in_pt[3]
+    cdef double next_pt[3]
+    cdef double dir_vect[3]
+    cdef double cur_edge[3]
+    cdef np.npy_intp cur_voxel_coords[3]
+
+    cdef np.npy_intp pno
+    cdef int cno
+    cdef np.npy_intp el_no
 
-    # Inspired from Dipy track_counts
-    vol_dims = np.asarray(vol_dims).astype(np.int)
-    n_voxels = np.prod(vol_dims)
+    # x slice size (C array ordering)
+    cdef np.npy_intp x_slice_size = vd[1] * vd[2]
+
+    cdef double dir_vect_norm, remaining_dist, length_ratio
+
+    # This loop is time-critical
+    # Changed to -1 because we get the next point in the loop
+    for pno in range(nb_points - 1):
+        # Assign current and next point, find vector between both,
+        # and use the current point as nearest edge for testing.
+        for cno in range(3):
+            in_pt[cno] = <double>t[pno * 3 + cno]
+            next_pt[cno] = <double>t[(pno + 1) * 3 + cno]
+            dir_vect[cno] = next_pt[cno] - in_pt[cno]
+            cur_edge[cno] = in_pt[cno]
+
+        # Compute norm
+        dir_vect_norm = norm(dir_vect[0], dir_vect[1], dir_vect[2])
+
+        # If consecutive coordinates are the same, skip one.
+        if dir_vect_norm == 0:
+            continue
+
+        # Set the "dist" var to compute remaining length of vector to process
+        remaining_dist = dir_vect_norm
+
+        # Check if it's already a real edge. If not, find the closest edge.
+        # Reverted the condition to help with code prediction
+        if floor(cur_edge[0]) != cur_edge[0] and \
+           floor(cur_edge[1]) != cur_edge[1] and \
+           floor(cur_edge[2]) != cur_edge[2]:
+            # All coordinates are not "integers", and therefore, not on the
+            # edge. Fetch the closest edge.
+            c_get_closest_edge(in_pt[0], in_pt[1], in_pt[2],
+                               dir_vect[0], dir_vect[1], dir_vect[2],
+                               cur_edge)
+
+        # TODO Could condition be optimized?
+        while True:
+            # Compute the smallest ratio of dir_vect's length to get to an
+            # edge. This effectively means we find the first edge
+            # encountered
+            # Set large value for length_ratio
+            length_ratio = 10000
+            for cno in range(3):
+                # To avoid dividing by zero.
+                # Gain in performance, since we can use
+                # @cython.cdivision(True)
+                if dir_vect[cno] != 0:
+                    length_ratio = fmin(fabs((cur_edge[cno] - in_pt[cno]) /
+                                         dir_vect[cno]), length_ratio)
 
-    # This array counts the number of different tracks going through each voxel.
-    # Need to keep both the array and the memview on it to be able to
-    # reshape and return in the end.
-    traversal_tags = np.zeros((n_voxels,), dtype=np.int)
-    cdef np.int_t[:] traversal_tags_v = traversal_tags
+            remaining_dist -= length_ratio * dir_vect_norm
 
-    # This array keeps track of whether the current track has already been
-    # flagged in a specific voxel.
-    cdef np.int_t[:] touched_tags_v = np.zeros((n_voxels,), dtype=np.int)
+            # Check if last point is already on an edge
+            if remaining_dist < 0 and not fabs(remaining_dist) < 1e-8:
+                break
 
-    cdef int streamlines_len = len(streamlines)
+            # Find the coordinates of voxel containing current point, to
+            # tag it in the map
+            for cno in range(3):
+                cur_voxel_coords[cno] = <int>floor(in_pt[cno] +
+                                                   0.5 * length_ratio *
+                                                   dir_vect[cno]) - vo[cno]
 
-    if streamlines_len == 0:
-        np.seterr(**flags)
-        return traversal_tags.reshape(vol_dims)
+            el_no = cur_voxel_coords[0] * x_slice_size + \
+                    cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
+
+            if c_tag_voxel(el_no, touched_tags, tag, voxels, nb_voxels,
+                           max_voxels) < 0:
+                return -1
+
+            # NOTE: in_pt is moved to the closest edge
+            for cno in range(3):
+                in_pt[cno] = length_ratio * dir_vect[cno] + in_pt[cno]
 
-    # Memview to a streamline instance, which is a numpy array.
-    cdef np.double_t[:,:] t = streamlines[0].astype(np.double)
+                # Snap really small values to 0.
+                if fabs(in_pt[cno]) <= 1e-16:
+                    in_pt[cno] = 0.0
 
-    # Memviews for points and direction vectors.
-    cdef np.double_t[:] in_pt = np.zeros(3, dtype=np.double)
-    cdef np.double_t[:] next_pt = np.zeros(3, dtype=np.double)
-    cdef np.double_t[:] dir_vect = np.zeros(3, dtype=np.double)
+            c_get_closest_edge(in_pt[0], in_pt[1], in_pt[2],
+                               dir_vect[0], dir_vect[1], dir_vect[2],
+                               cur_edge)
 
-    # Memview for the current edge
-    cdef np.double_t[:] cur_edge = np.zeros(3, dtype=np.double)
+        # Add last point
+        for cno in range(3):
+            cur_voxel_coords[cno] = <int>floor(
+                in_pt[cno] + 0.5 * (next_pt[cno] - in_pt[cno])) - vo[cno]
+        el_no = cur_voxel_coords[0] * x_slice_size + \
+                cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
 
-    # Memview for the coordinates of the current voxel
-    cdef np.int_t[:] cur_voxel_coords = np.zeros(3, dtype=np.int)
+        if c_tag_voxel(el_no, touched_tags, tag, voxels, nb_voxels,
+                       max_voxels) < 0:
+            return -1
 
-    # various temporary loop and working variables
-    #cdef:
-    #    int track_idx   # Index of the track when iterating.
-    cdef int tno, pno, cno
-    cdef np.npy_intp el_no, v
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+# IMPORTANT: Streamlines should be in voxel space, aligned to corner.
+def compute_robust_tract_counts_map_flat(floating[:, ::1] points,
+                                         np.npy_intp[::1] offsets,
+                                         np.npy_intp[::1] lengths,
+                                         vol_dims, int nb_threads=1):
+    """ Computes the number of streamlines traversing each voxel.
+
+    Streamlines are given as a single buffer of points, along with the
+    offset and the number of points of each streamline in this buffer, as
+    stored in an ArraySequence.
+
+    Streamlines are processed in parallel without the GIL. Each thread
+    lists the voxels traversed by its current streamline in a small buffer,
+    and increments the shared counts of the unique ones atomically. The
+    result does not depend on the number of threads.
+
+    Parameters
+    ----------
+    points : numpy array of shape (N, 3), float32 or float64
+        points of all streamlines, in voxel space, aligned to corner.
+    offsets : numpy array of np.intp
+        index of the first point of each streamline in points.
+    lengths : numpy array of np.intp
+        number of points of each streamline.
+    vol_dims : tuple of 3 ints
+        dimensions of the volume.
+    nb_threads : int
+        number of threads. If smaller than 1, uses all available cores.
+
+    Returns
+    -------
+    traversal_tags : numpy array of np.uint32, of shape vol_dims
+        number of streamlines traversing each voxel.
+    """
+    vol_dims = np.asarray(vol_dims).astype(np.intp)
+    cdef np.npy_intp n_voxels = np.prod(vol_dims)
+    cdef np.npy_intp streamlines_len = offsets.shape[0]
+
+    if nb_threads < 1:
+        nb_threads = multiprocessing.cpu_count()
+    nb_threads = max(1, min(nb_threads, streamlines_len))
+
+    # Counts the number of different tracks going through each voxel, for
+    # all threads.
+    traversal_tags = np.zeros((n_voxels,), dtype=np.uint32)
+    cdef np.uint32_t[::1] traversal_tags_v = traversal_tags
 
     cdef int vd[3]
-    cdef double vxs[3]
+    cdef int vo[3]
+    cdef int cno
     for cno in range(3):
         vd[cno] = vol_dims[cno]
-    # x slice size (C array ordering)
-    cdef np.npy_intp x_slice_size = vd[1] * vd[2]
+        vo[cno] = 0
+
+    # Voxels buffer of each thread, grown when a streamline does not fit.
+    cdef np.int64_t **voxels = <np.int64_t **>malloc(
+        nb_threads * sizeof(np.int64_t *))
+    cdef np.npy_intp *max_voxels = <np.npy_intp *>malloc(
+        nb_threads * sizeof(np.npy_intp))
+    if voxels == NULL or max_voxels == NULL:
+        free(voxels)
+        free(max_voxels)
+        raise MemoryError()
+
+    cdef int tid
+    for tid in range(nb_threads):
+        max_voxels[tid] = 2**12
+        voxels[tid] = <np.int64_t *>malloc(
+            max_voxels[tid] * sizeof(np.int64_t))
+
+    cdef np.npy_intp track_idx, vno, nb_voxels
+    cdef np.int64_t *new_voxels
+
+    try:
+        for tid in range(nb_threads):
+            if voxels[tid] == NULL:
+                raise MemoryError()
+
+        with nogil:
+            for track_idx in prange(streamlines_len, num_threads=nb_threads,
+                                    schedule='dynamic', chunksize=64):
+                tid = threadid()
+                # The buffer of a thread is empty if it could not be grown.
+                if lengths[track_idx] < 2 or max_voxels[tid] == 0:
+                    continue
+
+                while True:
+                    nb_voxels = 0
+                    if c_traverse_streamline(&points[offsets[track_idx], 0],
+                                             lengths[track_idx], vd, vo,
+                                             NULL, 0, voxels[tid],
+                                             &nb_voxels,
+                                             max_voxels[tid]) == 0:
+                        break
+
+                    # Restart the streamline with a larger buffer.
+                    new_voxels = <np.int64_t *>realloc(
+                        voxels[tid], 2 * max_voxels[tid] * sizeof(np.int64_t))
+                    if new_voxels == NULL:
+                        max_voxels[tid] = 0
+                        nb_voxels = 0
+                        break
+                    voxels[tid] = new_voxels
+                    max_voxels[tid] = 2 * max_voxels[tid]
+
+                qsort(voxels[tid], nb_voxels, sizeof(np.int64_t),
+                      c_compare_int64)
+                for vno in range(nb_voxels):
+                    if vno == 0 or voxels[tid][vno] != voxels[tid][vno - 1]:
+                        atomic_increment(&traversal_tags_v[voxels[tid][vno]])
+
+        for tid in range(nb_threads):
+            if max_voxels[tid] == 0:
+                raise MemoryError()
+    finally:
+        for tid in range(nb_threads):
+            free(voxels[tid])
+        free(voxels)
+        free(max_voxels)
 
-    cdef np.double_t dir_vect_norm, remaining_dist, length_ratio
+    return traversal_tags.reshape(vol_dims)
 
-    for track_idx in range(streamlines_len):
-        t = streamlines[track_idx].astype(np.double)
 
-        # This loop is time-critical
-        # Changed to -1 because we get the next point in the loop
-        for pno in range(t.shape[0] - 1):
-            # Assign current and next point, find vector between both,
-            # and use the current point as nearest edge for testing.
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int c_get_box(floating[:, ::1] points,
+                   np.npy_intp[::1] offsets,
+                   np.npy_intp[::1] lengths,
+                   np.npy_intp start, np.npy_intp end,
+                   np.npy_intp *box_min,
+                   np.npy_intp *box_max) nogil:
+    # Computes the box of the voxels traversed by the streamlines start to
+    # end - 1, padded by a voxel on each side to be safe from rounding.
+    # box_max is exclusive. Returns 0 if no streamline is traversed.
+    cdef double pt_min[3]
+    cdef double pt_max[3]
+    cdef double v
+    cdef np.npy_intp track_idx, pno
+    cdef int cno
+    cdef int found = 0
+
+    for track_idx in range(start, end):
+        # Streamlines of a single point are not traversed.
+        if lengths[track_idx] < 2:
+            continue
+
+        for pno in range(offsets[track_idx],
+                         offsets[track_idx] + lengths[track_idx]):
             for cno in range(3):
-                in_pt[cno] = t[pno, cno]
-                next_pt[cno] = t[pno + 1, cno]
-                dir_vect[cno] = next_pt[cno] - in_pt[cno]
-                cur_edge[cno] = in_pt[cno]
+                v = points[pno, cno]
+                if not found or v < pt_min[cno]:
+                    pt_min[cno] = v
+                if not found or v > pt_max[cno]:
+                    pt_max[cno] = v
+            found = 1
+
+    if found:
+        for cno in range(3):
+            box_min[cno] = <np.npy_intp>floor(pt_min[cno]) - 1
+            box_max[cno] = <np.npy_intp>floor(pt_max[cno]) + 2
 
-            # Compute norm
-            dir_vect_norm = norm(dir_vect[0], dir_vect[1], dir_vect[2])
+    return found
 
-            # If consecutive coordinates are the same, skip one.
-            if dir_vect_norm == 0:
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+# IMPORTANT: Streamlines should be in voxel space, aligned to corner.
+def compute_groups_voxels_flat(floating[:, ::1] points,
+                               np.npy_intp[::1] offsets,
+                               np.npy_intp[::1] lengths,
+                               np.npy_intp[::1] groups_bounds,
+                               vol_dims, crop=True):
+    """ Finds the voxels traversed by each group of streamlines.
+
+    All groups are processed in a single traversal of the streamlines, and
+    only a single array is allocated to tag voxels.
+
+    When crop is True, the voxels of each group are tagged in the bounding
+    box of its streamlines only, so that the tags array is the size of the
+    largest box instead of the volume. Groups whose box is not inside the
+    volume are tagged over the whole volume, so the results are the same.
+
+    Parameters
+    ----------
+    points : numpy array of shape (N, 3), float32 or float64
+        points of all streamlines, in voxel space, aligned to corner.
+    offsets : numpy array of np.intp
+        index of the first point of each streamline in points.
+    lengths : numpy array of np.intp
+        number of points of each streamline.
+    groups_bounds : numpy array of np.intp
+        streamlines groups_bounds[i] to groups_bounds[i + 1] - 1 make up
+        group i.
+    vol_dims : tuple of 3 ints
+        dimensions of the volume.
+    crop : bool
+        if True, tag the voxels in the bounding box of each group.
+
+    Returns
+    -------
+    groups_voxels : list of numpy arrays of np.int64
+        sorted linear indices (C order) of the voxels traversed by at least
+        one streamline of each group.
+    """
+    vol_dims = np.asarray(vol_dims).astype(np.intp)
+    cdef np.npy_intp nb_groups = groups_bounds.shape[0] - 1
+
+    # Box of each group: origin and dimensions.
+    boxes_origin = np.zeros((nb_groups, 3), dtype=np.intp)
+    boxes_dims = np.zeros((nb_groups, 3), dtype=np.intp)
+    boxes_dims[:] = vol_dims
+
+    cdef np.npy_intp box_min[3]
+    cdef np.npy_intp box_max[3]
+    cdef np.npy_intp group_idx, track_idx, start, end
+    cdef int found
+
+    if crop:
+        for group_idx in range(nb_groups):
+            with nogil:
+                found = c_get_box(points, offsets, lengths,
+                                  groups_bounds[group_idx],
+                                  groups_bounds[group_idx + 1],
+                                  box_min, box_max)
+            if not found:
+                boxes_dims[group_idx] = 0
                 continue
 
-            # Set the "dist" var to compute remaining length of vector to process
-            remaining_dist = dir_vect_norm
-
-            # Check if it's already a real edge. If not, find the closest edge.
-            # Reverted the condition to help with code prediction
-            if floor(cur_edge[0]) != cur_edge[0] and \
-               floor(cur_edge[1]) != cur_edge[1] and \
-               floor(cur_edge[2]) != cur_edge[2]:
-                # All coordinates are not "integers", and therefore, not on the
-                # edge. Fetch the closest edge.
-                c_get_closest_edge(in_pt[0], in_pt[1], in_pt[2],
-                                   dir_vect[0], dir_vect[1], dir_vect[2],
-                                   cur_edge)
-
-            # TODO Could condition be optimized?
-            while True:
-                # Compute the smallest ratio of dir_vect's length to get to an
-                # edge. This effectively means we find the first edge
-                # encountered
-                # Set large value for length_ratio
-                length_ratio = 10000
-                for cno in range(3):
-                    # To avoid dividing by zero.
-                    # Gain in performance, since we can use
-                    # @cython.cdivision(True)
-                    if dir_vect[cno] != 0:
-                        length_ratio = fmin(fabs((cur_edge[cno] - in_pt[cno]) /
-                                             dir_vect[cno]), length_ratio)
-
-                remaining_dist -= length_ratio * dir_vect_norm
-
-                # Check if last point is already on an edge
-                if remaining_dist < 0 and not fabs(remaining_dist) < 1e-8:
-                    break
-
-                # Find the coordinates of voxel containing current point, to
-                # tag it in the map
-                for cno in range(3):
-                    cur_voxel_coords[cno] = <int>floor(in_pt[cno] +
-                                                       0.5 * length_ratio *
-                                                       dir_vect[cno])
-
-                el_no = cur_voxel_coords[0] * x_slice_size + \
-                        cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
-
-                # Use + 1 since the first track would be ignored
-                if touched_tags_v[el_no] != track_idx + 1:
-                    touched_tags_v[el_no] = track_idx + 1
-                    traversal_tags_v[el_no] += 1
-
-                # NOTE: in_pt is moved to the closest edge
-                for cno in range(3):
-                    in_pt[cno] = length_ratio * dir_vect[cno] + in_pt[cno]
-
-                    # Snap really small values to 0.
-                    if fabs(in_pt[cno]) <= 1e-16:
-                        in_pt[cno] = 0.0
-
-                c_get_closest_edge(in_pt[0], in_pt[1], in_pt[2],
-                                   dir_vect[0], dir_vect[1], dir_vect[2],
-                                   cur_edge)
-
-            # Add last point
-            for cno in range(3):
-                cur_voxel_coords[cno] = <int>floor(in_pt[cno] +
-                                                   0.5 * (next_pt[cno] - in_pt[cno]))
-            el_no = cur_voxel_coords[0] * x_slice_size + \
-                    cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
+            box_min_a = np.array([box_min[0], box_min[1], box_min[2]])
+            box_max_a = np.array([box_max[0], box_max[1], box_max[2]])
+            if np.all(box_min_a >= 0) and np.all(box_max_a <= vol_dims):
+                boxes_origin[group_idx] = box_min_a
+                boxes_dims[group_idx] = box_max_a - box_min_a
 
-            # Use + 1 since the first track would be ignored
-            if touched_tags_v[el_no] != track_idx + 1:
-                touched_tags_v[el_no] = track_idx + 1
-                traversal_tags_v[el_no] += 1
+    n_voxels = np.prod(boxes_dims, axis=1).max() if nb_groups else 0
+    touched_tags = np.zeros((max(n_voxels, 1),), dtype=np.int32)
+    cdef np.int32_t[::1] touched_tags_v = touched_tags
 
-    np.seterr(**flags)
-    return traversal_tags.reshape(vol_dims)
+    voxels = np.empty((2**16,), dtype=np.int64)
+    cdef np.int64_t[::1] voxels_v = voxels
+    cdef np.npy_intp nb_voxels
+    cdef np.npy_intp max_voxels
+
+    cdef int vd[3]
+    cdef int vo[3]
+    cdef int cno
+
+    cdef np.int32_t tag = 0
+    cdef int full
+
+    groups_voxels = []
+
+    for group_idx in range(nb_groups):
+        start = groups_bounds[group_idx]
+        end = groups_bounds[group_idx + 1]
+
+        for cno in range(3):
+            vd[cno] = boxes_dims[group_idx, cno]
+            vo[cno] = boxes_origin[group_idx, cno]
+
+        while True:
+            # A new tag is used for each try, and for each group, since the
+            # tags of previous groups and incomplete tries are left behind.
+            tag += 1
+            nb_voxels = 0
+            max_voxels = voxels_v.shape[0]
+            full = 0
+
+            with nogil:
+                for track_idx in range(start, end):
+                    if lengths[track_idx] < 2:
+                        continue
+
+                    if c_traverse_streamline(&points[offsets[track_idx], 0],
+                                             lengths[track_idx], vd, vo,
+                                             &touched_tags_v[0], tag,
+                                             &voxels_v[0], &nb_voxels,
+                                             max_voxels) < 0:
+                        full = 1
+                        break
+
+            if not full:
+                break
+
+            # Restart the group with a larger buffer.
+            voxels = np.empty((2 * max_voxels,), dtype=np.int64)
+            voxels_v = voxels
+
+        # Voxels are sorted in the box, which keeps the C order of the
+        # volume, and then moved to the volume.
+        group_voxels = np.sort(voxels[:nb_voxels])
+        if len(group_voxels) and np.any(boxes_dims[group_idx] != vol_dims):
+            group_voxels = np.ravel_multi_index(
+                np.array(np.unravel_index(group_voxels,
+                                          boxes_dims[group_idx])) +
+                boxes_origin[group_idx][:, None], vol_dims).astype(np.int64)
+        groups_voxels.append(group_voxels)
+
+    return groups_voxels
+
+
+def _get_flat_streamlines(streamlines):
+    # Returns the points buffer, offsets and lengths of the streamlines.
+    if isinstance(streamlines, ArraySequence):
+        # Use the buffer of the sequence directly, even for views.
+        points = streamlines._data
+        offsets = streamlines._offsets
+        lengths = streamlines._lengths
+    else:
+        lengths = np.array([len(s) for s in streamlines], dtype=np.intp)
+        offsets = np.zeros(len(lengths), dtype=np.intp)
+        if len(lengths) > 1:
+            np.cumsum(lengths[:-1], out=offsets[1:])
+        if len(lengths):
+            points = np.concatenate([np.asarray(s).reshape((-1, 3))
+                                     for s in streamlines])
+        else:
+            points = np.zeros((0, 3), dtype=np.float32)
+
+    if points.dtype != np.float32:
+        points = points.astype(np.float64)
+
+    return (np.ascontiguousarray(points).reshape((-1, 3)),
+            np.ascontiguousarray(offsets, dtype=np.intp),
+            np.ascontiguousarray(lengths, dtype=np.intp))
+
+
+def compute_groups_voxels(streamlines, groups_bounds, vol_dims, crop=True):
+    """ Finds the voxels traversed by each group of streamlines.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence or list of numpy arrays
+        streamlines in voxel space, aligned to corner, sorted by group.
+    groups_bounds : sequence of ints
+        streamlines groups_bounds[i] to groups_bounds[i + 1] - 1 make up
+        group i.
+    vol_dims : tuple of 3 ints
+        dimensions of the volume.
+    crop : bool
+        if True, tag the voxels in the bounding box of each group. See
+        compute_groups_voxels_flat.
+
+    Returns
+    -------
+    groups_voxels : list of numpy arrays of np.int64
+        sorted linear indices (C order) of the voxels traversed by at least
+        one streamline of each group.
+    """
+    points, offsets, lengths = _get_flat_streamlines(streamlines)
+
+    return compute_groups_voxels_flat(
+        points, offsets, lengths,
+        np.ascontiguousarray(groups_bounds, dtype=np.intp), vol_dims, crop)
+
+
+def compute_robust_tract_counts_map(streamlines, vol_dims, nb_threads=1):
+    """ Computes the number of streamlines traversing each voxel.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence or list of numpy arrays
+        streamlines in voxel space, aligned to corner.
+    vol_dims : tuple of 3 ints
+        dimensions of the volume.
+    nb_threads : int
+        number of threads. If smaller than 1, uses all available cores.
+
+    Returns
+    -------
+    traversal_tags : numpy array of np.uint32, of shape vol_dims
+        number of streamlines traversing each voxel.
+    """
+    points, offsets, lengths = _get_flat_streamlines(streamlines)
+
+    return compute_robust_tract_counts_map_flat(points, offsets, lengths,
+                                                vol_dims, nb_threads)
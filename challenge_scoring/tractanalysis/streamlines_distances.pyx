@@ -0,0 +1,111 @@
+# encoding: utf-8
+#cython: profile=False
+
+from __future__ import division
+
+import multiprocessing
+
+cimport cython
+from cython.parallel import prange
+import numpy as np
+cimport numpy as np
+
+from libc.math cimport sqrt
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline int c_within_mdf_threshold(float *a, float *b, np.npy_intp rows,
+                                       double threshold) nogil:
+    # Returns 1 if the minimum direct-flip distance (MDF) between a and b is
+    # at most threshold.
+    # Uses the same arithmetic as dipy's bundles_distances_mdf, so that the
+    # result is the same as thresholding its distance matrix.
+    # Both the direct and flipped sums can only grow, so the computation
+    # stops as soon as both are over the threshold.
+    cdef:
+        np.npy_intp i=0, j=0
+        float sub=0, subf=0, distf=0, dist=0, tmprow=0, tmprowf=0
+
+    for i in range(rows):
+        tmprow = 0
+        tmprowf = 0
+        for j in range(3):
+            sub = a[i * 3 + j] - b[i * 3 + j]
+            subf = a[i * 3 + j] - b[(rows - 1 - i) * 3 + j]
+            tmprow += sub * sub
+            tmprowf += subf * subf
+        dist += sqrt(tmprow)
+        distf += sqrt(tmprowf)
+
+        if <double>(dist / <float>rows) > threshold and \
+           <double>(distf / <float>rows) > threshold:
+            return 0
+
+    return 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def streamlines_within_mdf_threshold(model_streamlines, streamlines,
+                                     double threshold, int nb_threads=1):
+    """ Finds the streamlines close to any model streamline.
+
+    Equivalent to
+    np.min(bundles_distances_mdf(model_streamlines, streamlines), axis=0) <= threshold
+    without computing the full distance matrix. The computation stops for a
+    streamline as soon as a close model streamline is found, and for a pair
+    of streamlines as soon as the distance is over the threshold.
+
+    Parameters
+    ----------
+    model_streamlines : numpy array of shape (N, P, 3)
+        model streamlines, all with the same number of points.
+    streamlines : numpy array of shape (M, P, 3)
+        streamlines to test, with the same number of points as the model.
+    threshold : double
+        maximal MDF distance.
+    nb_threads : int
+        number of threads. If smaller than 1, uses all available cores.
+
+    Returns
+    -------
+    is_close : numpy array of bool, of shape (M,)
+        True for the streamlines closer than threshold to at least one model
+        streamline.
+    """
+    cdef float[:, :, ::1] model = np.ascontiguousarray(model_streamlines,
+                                                       dtype=np.float32)
+    cdef float[:, :, ::1] strl = np.ascontiguousarray(streamlines,
+                                                      dtype=np.float32)
+
+    cdef np.npy_intp nb_model = model.shape[0]
+    cdef np.npy_intp nb_strl = strl.shape[0]
+    cdef np.npy_intp rows = model.shape[1]
+
+    is_close = np.zeros((nb_strl,), dtype=np.uint8)
+    cdef np.uint8_t[::1] is_close_v = is_close
+
+    if nb_model == 0 or nb_strl == 0:
+        return is_close.astype(bool)
+
+    if strl.shape[1] != rows:
+        raise ValueError('All streamlines must have the same number of '
+                         'points as the model streamlines.')
+
+    if nb_threads < 1:
+        nb_threads = multiprocessing.cpu_count()
+
+    cdef np.npy_intp i, j
+
+    with nogil:
+        for j in prange(nb_strl, num_threads=nb_threads,
+                        schedule='dynamic', chunksize=16):
+            for i in range(nb_model):
+                if c_within_mdf_threshold(&model[i, 0, 0], &strl[j, 0, 0],
+                                          rows, threshold):
+                    is_close_v[j] = 1
+                    break
+
+    return is_close.astype(bool)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _read_proc_status_kb(field):
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process, when supported.
+
+    Returns
+    ---------
+    supported : bool
+        True if the peak was reset. If not, get_peak_rss returns the peak
+        since the start of the process.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of the current process, in bytes.
+    """
+    peak = _read_proc_status_kb('VmHWM')
+    if peak is not None:
+        return peak * 1024
+
+    if resource is None:
+        return 0
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname()[0] == 'Darwin':
+        return peak
+    return peak * 1024
+
+
+def get_current_rss():
+    """
+    Return the resident set size of the current process, in bytes, or None
+    if it is not available.
+    """
+    rss = _read_proc_status_kb('VmRSS')
+    if rss is not None:
+        return rss * 1024
+
+    return None
+
+
+def get_cpu_time():
+    """
+    Return the CPU time used by the current process and its terminated
+    children, in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class Profiler(object):
+    """
+    Collect the wall time, CPU time and peak memory of the stages of the
+    scoring.
+
+    Each stage produces a record, a dictionary containing its 'name',
+    'wall_time', 'cpu_time' (seconds), 'peak_rss' (bytes), the 'process' id
+    and any information added by the code of the stage, such as the number
+    of processed streamlines. Stages can be nested.
+
+    The CPU time and peak memory are measured for the whole process, so
+    stages must not run concurrently in several threads of a process:
+    code running in threads is measured by a single enclosing stage.
+
+    Parameters
+    ------------
+    callback : callable
+        if set, called with each record when its stage ends.
+    """
+
+    def __init__(self, callback=None):
+        self.records = []
+        self.callback = callback
+        self._local = threading.local()
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Measure a block of code as a stage. The record of the stage is
+        yielded, so that other information can be added to it.
+        """
+        record = {'name': name}
+        record.update(info)
+
+        # Resetting the peak memory hides the peak of the enclosing stage,
+        # which is kept aside.
+        stack = self._get_stack()
+        if len(stack):
+            stack[-1][0] = max(stack[-1][0], get_peak_rss())
+        children_peak = [0]
+        stack.append(children_peak)
+
+        reset_peak_rss()
+        record['start_time'] = time.time()
+        start_cpu = get_cpu_time()
+
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - record['start_time']
+            record['cpu_time'] = get_cpu_time() - start_cpu
+            record['peak_rss'] = max(get_peak_rss(), children_peak[0])
+            record['process'] = os.getpid()
+
+            stack.pop()
+            self.add_records([record])
+
+    def add_records(self, records):
+        """
+        Add records produced by this profiler or by another one, for example
+        in a worker process.
+        """
+        stack = self._get_stack()
+        pid = os.getpid()
+
+        for record in records:
+            # The peak memory of the stages of this process is also the peak
+            # memory of the enclosing stage.
+            if len(stack) and record['process'] == pid:
+                stack[-1][0] = max(stack[-1][0], record['peak_rss'])
+
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def get_summary(self):
+        """
+        Aggregate the records of each stage name.
+
+        Returns
+        ---------
+        summary : dict
+            for each stage name, the number of 'calls', the total
+            'wall_time', 'cpu_time' and 'nb_streamlines', and the maximal
+            'peak_rss'.
+        """
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record['name'],
+                                       {'calls': 0, 'wall_time': 0.,
+                                        'cpu_time': 0., 'peak_rss': 0})
+            stage['calls'] += 1
+            stage['wall_time'] += record['wall_time']
+            stage['cpu_time'] += record['cpu_time']
+            stage['peak_rss'] = max(stage['peak_rss'], record['peak_rss'])
+            if 'nb_streamlines' in record:
+                stage['nb_streamlines'] = stage.get('nb_streamlines', 0) + \
+                    record['nb_streamlines']
+
+        return summary
+
+    def get_profile(self):
+        """
+        Return the summary and the records, sorted by start time.
+        """
+        return {'summary': self.get_summary(),
+                'stages': sorted(self.records,
+                                 key=lambda r: r['start_time'])}
+
+
+@contextmanager
+def _ignored_stage():
+    yield {}
+
+
+def profile_stage(profiler, name, **info):
+    """
+    Measure a stage with profiler, or do nothing if profiler is None.
+    """
+    if profiler is None:
+        return _ignored_stage()
+
+    return profiler.stage(name, **info)
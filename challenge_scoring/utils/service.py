@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue
+    from multiprocessing.queues import SimpleQueue
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue
+    from multiprocessing import SimpleQueue
+
+from challenge_scoring.utils.json_formatter import NumpyEncoder, \
+    load_dict_from_json_file
+from challenge_scoring.utils.submission import _init_batch_worker, \
+    _score_batch_item
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+# Options of score_tractogram_file that can be set for each job.
+JOB_OPTIONS = ['orientation', 'save_full_vc', 'save_full_ic', 'save_full_nc',
+               'save_IBs', 'save_VBs']
+
+# Interval between two checks of the worker processes of running jobs, in
+# seconds.
+WORKERS_CHECK_INTERVAL = 1.
+
+# Queue where the workers send the (job id, process id) of the jobs they
+# start. Set before forking the pool.
+_WORKER_STARTED_QUEUE = None
+
+
+class ScoringService(object):
+    """
+    Score submitted tractograms with GT data prepared once.
+
+    Jobs are queued, and scored by a pool of worker processes which are
+    forked once the GT data is prepared, so that each job only pays for the
+    scoring itself. At most nb_processes jobs are scored at the same time.
+    Each job produces the same outputs as score_tractogram.py, in
+    OUT_DIR/<job id>. A job whose worker process dies, for example when it
+    runs out of memory, is marked as failed.
+
+    The service must be created before starting any thread, since forking
+    a process with running threads can leave locks held by those threads
+    locked in the worker processes.
+
+    Parameters
+    ------------
+    gt_data : tuple
+        prepared GT data, as returned by prepare_gt_data.
+    base_dir : string
+        path to the directory containing the scoring data.
+    basic_bundles_attribs : dictionary
+        attributes of the GT bundles.
+    out_dir : string
+        directory where the outputs of the jobs are saved.
+    nb_processes : int
+        number of jobs scored at the same time.
+    kwargs : dict
+        other arguments sent to score_tractogram_file for all jobs.
+    """
+
+    def __init__(self, gt_data, base_dir, basic_bundles_attribs, out_dir,
+                 nb_processes=1, **kwargs):
+        self.out_dir = out_dir
+        self.nb_processes = nb_processes
+        self.kwargs = dict(kwargs, base_dir=base_dir,
+                           basic_bundles_attribs=basic_bundles_attribs)
+
+        self._jobs = {}
+        self._job_ids = []
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._slots = threading.Semaphore(nb_processes)
+        self._workers_pids = {}
+        self._cancelled = False
+        self._closed = False
+
+        # The pool is forked before starting any thread. The workers send
+        # the process id of each job they start, to detect the jobs whose
+        # worker died.
+        self._started_queue = SimpleQueue()
+        self._pool = multiprocessing.Pool(nb_processes,
+                                          initializer=_init_service_worker,
+                                          initargs=(gt_data,
+                                                    self._started_queue))
+
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+        self._watcher = threading.Thread(target=self._watch_workers)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def submit(self, tractogram, **options):
+        """
+        Queue the scoring of a tractogram.
+
+        Parameters
+        ------------
+        tractogram : string
+            path of the tractogram to score.
+        options : dict
+            options of the job, among JOB_OPTIONS.
+
+        Returns
+        ---------
+        job : dict
+            status of the job, see get_job.
+        """
+        if not os.path.isfile(tractogram):
+            raise ValueError('"{0}" must be a file!'.format(tractogram))
+
+        unknown = set(options) - set(JOB_OPTIONS)
+        if len(unknown):
+            raise ValueError('Unknown job options: {0}'.format(
+                ', '.join(sorted(unknown))))
+
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id,
+               'tractogram': os.path.abspath(tractogram),
+               'options': options,
+               'status': JOB_QUEUED,
+               'submitted': time.time(),
+               'started': None,
+               'finished': None,
+               'scores_filename': None,
+               'error': None}
+
+        with self._lock:
+            self._jobs[job_id] = job
+            self._job_ids.append(job_id)
+            self._queue.put(job_id)
+
+        logging.info('Queued job {0} for {1}'.format(job_id, tractogram))
+        return self.get_job(job_id)
+
+    def get_job(self, job_id, with_scores=False):
+        """
+        Return the status of a job, or None if it does not exist.
+
+        The status is a dictionary with the 'id', 'tractogram' and 'options'
+        of the job, its 'status' (queued, running, done or failed), the
+        'submitted', 'started' and 'finished' times, the 'scores_filename'
+        and the 'error' message of a failed job. If with_scores is True, the
+        'scores' of a finished job are added.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+
+        if job['status'] == JOB_QUEUED:
+            job['position'] = self._get_queue_position(job_id)
+
+        if with_scores and job['scores_filename'] is not None:
+            job['scores'] = load_dict_from_json_file(job['scores_filename'])
+
+        return job
+
+    def get_jobs(self):
+        """
+        Return the status of all jobs, by submission time.
+        """
+        with self._lock:
+            job_ids = list(self._job_ids)
+
+        return [self.get_job(j) for j in job_ids]
+
+    def _get_queue_position(self, job_id):
+        # Number of jobs queued before job_id.
+        with self._lock:
+            queued = [j for j in self._job_ids
+                      if self._jobs[j]['status'] == JOB_QUEUED]
+
+        if job_id not in queued:
+            return None
+        return queued.index(job_id)
+
+    def _dispatch(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                break
+
+            # Wait for a free slot, so that queued jobs can be told from
+            # running ones.
+            self._slots.acquire()
+
+            # Jobs are never started once the pool is terminated.
+            with self._lock:
+                if self._cancelled:
+                    self._slots.release()
+                    break
+
+                job = self._jobs[job_id]
+                job['status'] = JOB_RUNNING
+                job['started'] = time.time()
+
+                kwargs = dict(self.kwargs,
+                              out_dir=os.path.join(self.out_dir, job_id),
+                              **job['options'])
+                self._pool.apply_async(
+                    _score_service_job, (job_id, job['tractogram'], kwargs),
+                    callback=lambda result, job_id=job_id:
+                        self._job_finished(job_id, result))
+
+    def _watch_workers(self):
+        # A job whose worker dies never returns its result, and is marked as
+        # failed once its worker process no longer exists. The pool replaces
+        # the dead worker.
+        while not self._closed:
+            time.sleep(WORKERS_CHECK_INTERVAL)
+
+            while not self._started_queue.empty():
+                job_id, pid = self._started_queue.get()
+                with self._lock:
+                    if self._jobs[job_id]['status'] == JOB_RUNNING:
+                        self._workers_pids[job_id] = pid
+
+            with self._lock:
+                workers_pids = list(self._workers_pids.items())
+
+            for job_id, pid in workers_pids:
+                if not _is_process_alive(pid):
+                    self._job_finished(job_id, None)
+
+    def _job_finished(self, job_id, result):
+        if result is None:
+            scores_filename = None
+            error = 'The worker process scoring the job died.'
+        else:
+            _, scores_filename, error = result
+
+        if error is not None:
+            status = JOB_FAILED
+        elif scores_filename is None:
+            status = JOB_FAILED
+            error = 'No scores were produced.'
+        else:
+            status = JOB_DONE
+
+        # A job can end only once, even if its worker dies right after
+        # returning its result.
+        with self._lock:
+            job = self._jobs[job_id]
+            if job['status'] != JOB_RUNNING:
+                return
+            job.update(status=status, finished=time.time(),
+                       scores_filename=scores_filename, error=error)
+            self._workers_pids.pop(job_id, None)
+        self._slots.release()
+
+        logging.info('Job {0} {1}'.format(job_id, status))
+
+    def close(self, wait=True):
+        """
+        Stop accepting jobs. If wait is True, wait for the queued and
+        running jobs to finish. Otherwise, queued jobs are never started and
+        running jobs are terminated, and marked as failed.
+        """
+        if wait:
+            self._queue.put(None)
+            self._dispatcher.join()
+
+            # All slots are free once the running jobs are done, or their
+            # worker died.
+            for _ in range(self.nb_processes):
+                self._slots.acquire()
+        else:
+            with self._lock:
+                self._cancelled = True
+            self._queue.put(None)
+            self._pool.terminate()
+
+            with self._lock:
+                running = [j for j in self._job_ids
+                           if self._jobs[j]['status'] == JOB_RUNNING]
+            for job_id in running:
+                self._job_finished(job_id, (None, None,
+                                            'The service was stopped.'))
+
+            self._dispatcher.join()
+
+        self._pool.terminate()
+        self._pool.join()
+
+        self._closed = True
+        self._watcher.join()
+
+
+def _init_service_worker(gt_data, started_queue):
+    global _WORKER_STARTED_QUEUE
+    _WORKER_STARTED_QUEUE = started_queue
+    _init_batch_worker(gt_data)
+
+
+def _score_service_job(job_id, tractogram, kwargs):
+    _WORKER_STARTED_QUEUE.put((job_id, os.getpid()))
+    return _score_batch_item((tractogram, kwargs))
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class _ScoringRequestHandler(BaseHTTPRequestHandler):
+    # The service is set on the server by serve_scoring_service.
+
+    def _send_json(self, code, content):
+        body = json.dumps(content, indent=4, separators=(',', ': '),
+                          cls=NumpyEncoder).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        self._send_json(code, {'error': message})
+
+    def _get_path_parts(self):
+        return [p for p in self.path.split('?')[0].split('/') if p]
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self._get_path_parts()
+
+        if parts == ['jobs']:
+            self._send_json(200, {'jobs': service.get_jobs()})
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = service.get_job(parts[1], with_scores=True)
+            if job is None:
+                self._send_error(404, 'Unknown job {0}'.format(parts[1]))
+            else:
+                self._send_json(200, job)
+        else:
+            self._send_error(404, 'Unknown path {0}'.format(self.path))
+
+    def do_POST(self):
+        service = self.server.service
+
+        if self._get_path_parts() != ['jobs']:
+            self._send_error(404, 'Unknown path {0}'.format(self.path))
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            tractogram = request.pop('tractogram')
+        except (ValueError, KeyError, AttributeError):
+            self._send_error(400, 'The request must be a JSON object with '
+                                  'a "tractogram" path.')
+            return
+
+        try:
+            job = service.submit(tractogram, **request)
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+
+        self._send_json(202, job)
+
+    def log_message(self, format, *args):
+        logging.debug('{0} - {1}'.format(self.address_string(),
+                                         format % args))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_scoring_service(service, host='127.0.0.1', port=8000):
+    """
+    Serve a ScoringService over HTTP, until interrupted.
+
+    The service accepts the following requests:
+        POST /jobs: queue a job. The body is a JSON object with the path of
+            the "tractogram" to score, and any of the JOB_OPTIONS.
+        GET /jobs: status of all jobs.
+        GET /jobs/<id>: status of a job, with its scores once it is done.
+    """
+    server = _ThreadingHTTPServer((host, port), _ScoringRequestHandler)
+    server.service = service
+
+    logging.info('Scoring service listening on {0}:{1}'.format(
+        *server.server_address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
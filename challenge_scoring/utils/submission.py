@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+import glob
+import logging
+import multiprocessing
+import os
+import shutil
+
+from challenge_scoring.io.results import save_results
+from challenge_scoring.io.streamlines import detect_tracts_format, \
+    format_needs_orientation, guess_orientation
+from challenge_scoring.metrics.scoring import score_submission
+from challenge_scoring.utils.filenames import mkdir
+from challenge_scoring.utils.json_formatter import save_dict_to_json_file
+from challenge_scoring.utils.profiling import Profiler
+
+
+TRACTOGRAM_EXTENSIONS = ['.tck', '.trk', '.vtk', '.fib']
+
+# GT data shared by the worker processes of a batch. Set before forking the
+# pool to avoid sending it to each worker.
+_WORKER_GT_DATA = None
+
+
+def expand_tractogram_inputs(inputs):
+    """
+    Expand a list of files, glob patterns and directories into a sorted
+    list of tractogram files.
+
+    The outputs of a tractogram are named after its file name without
+    extension, so a ValueError is raised if two tractograms have the same
+    name, such as team1/sub.tck and team2/sub.tck, or sub.tck and sub.trk.
+    """
+    tractograms = []
+
+    for inp in inputs:
+        if os.path.isdir(inp):
+            tractograms.extend(
+                [os.path.join(inp, f) for f in sorted(os.listdir(inp))
+                 if os.path.splitext(f)[1].lower() in TRACTOGRAM_EXTENSIONS])
+        elif glob.has_magic(inp):
+            tractograms.extend(sorted(glob.glob(inp)))
+        else:
+            tractograms.append(inp)
+
+    # Remove duplicates while keeping the order.
+    seen = set()
+    tractograms = [t for t in tractograms
+                   if not (os.path.abspath(t) in seen or
+                           seen.add(os.path.abspath(t)))]
+
+    names = {}
+    for tractogram in tractograms:
+        name = os.path.splitext(os.path.basename(tractogram))[0]
+        if name in names:
+            raise ValueError('"{0}" and "{1}" would save their outputs to '
+                             'the same files. Please rename one of '
+                             'them.'.format(names[name], tractogram))
+        names[name] = tractogram
+
+    return tractograms
+
+
+def parse_memory_size(size):
+    """
+    Parse a memory size, such as "512M" or "8G", to a number of bytes.
+
+    The K, M, G and T suffixes are powers of 1024. Without suffix, the size
+    is in bytes.
+    """
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    value = size.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+
+    factor = 1
+    if value and value[-1] in units:
+        factor = units[value[-1]]
+        value = value[:-1]
+
+    try:
+        nb_bytes = int(float(value) * factor)
+    except ValueError:
+        raise ValueError('Invalid memory size "{0}".'.format(size))
+
+    if nb_bytes <= 0:
+        raise ValueError('Memory size "{0}" must be positive.'.format(size))
+
+    return nb_bytes
+
+
+def get_tracts_attributes(tractogram, orientation=None):
+    """
+    Check and compute the orientation attribute for the submitted tractogram.
+
+    The format of the tractogram is detected once, and kept in the 'format'
+    attribute for the loaders.
+    """
+    tracts_format = detect_tracts_format(tractogram)
+    tract_attribute = {'orientation': 'unknown', 'format': tracts_format}
+    if format_needs_orientation(tractogram, tracts_format):
+        if not orientation:
+            raise ValueError('--orientation is needed for your tractogram '
+                             'format')
+        tract_attribute['orientation'] = orientation
+    else:
+        if orientation:
+            logging.warn('--orientation was provided but not needed. '
+                         'Will be discarded.')
+        tract_attribute['orientation'] = guess_orientation(tractogram,
+                                                            tracts_format)
+
+    return tract_attribute
+
+
+def get_scores_filename(tractogram, out_dir):
+    """
+    Path of the JSON file where the scores of a tractogram are saved.
+    """
+    return os.path.join(out_dir, "scores",
+                        os.path.splitext(os.path.basename(tractogram))[0]
+                        + ".json")
+
+
+def prepare_output_paths(tractogram, out_dir, save_segments, force=False):
+    """
+    Create the output directories and check for existing results.
+
+    Returns
+    ---------
+    scores_filename : string
+        path of the JSON file where the scores will be saved.
+    segments_dir : string
+        directory where segmented files are saved, or '' if not needed.
+    base_name : string
+        base name of the segmented files, or '' if not needed.
+    """
+    out_dir = mkdir(out_dir + "/").replace("//", "/")
+    mkdir(os.path.join(out_dir, "scores"))
+    scores_filename = get_scores_filename(tractogram, out_dir)
+
+    score_exists = os.path.isfile(scores_filename)
+    profile_filename = get_profile_filename(scores_filename)
+    segmented_files = []
+
+    segments_dir = ''
+    base_name = ''
+
+    if save_segments:
+        segments_dir = mkdir(os.path.join(out_dir, "segmented"))
+        base_name = os.path.splitext(os.path.basename(tractogram))[0]
+
+        segmented_files = glob.glob(os.path.join(segments_dir,
+                                                 base_name + '*.tck'))
+
+    if score_exists or len(segmented_files):
+        if not force:
+            raise ValueError('Scores file or segmented files already exist.'
+                             '\nPlease remove or use -f to overwrite.')
+        else:
+            if score_exists:
+                os.remove(scores_filename)
+            if os.path.isfile(profile_filename):
+                os.remove(profile_filename)
+            for f in segmented_files:
+                os.remove(f)
+
+    return scores_filename, segments_dir, base_name
+
+
+def get_checkpoint_dir(tractogram, out_dir):
+    """
+    Directory where the checkpoints of the scoring of a tractogram are saved.
+    """
+    return os.path.join(out_dir, "checkpoints",
+                        os.path.splitext(os.path.basename(tractogram))[0])
+
+
+def get_profile_filename(scores_filename):
+    """
+    Path of the profile saved next to the scores of a tractogram.
+    """
+    return os.path.splitext(scores_filename)[0] + '_profile.json'
+
+
+def save_profile(scores_filename, profiler):
+    save_dict_to_json_file(get_profile_filename(scores_filename),
+                           profiler.get_profile())
+
+
+def score_tractogram_file(tractogram, base_dir, out_dir,
+                          basic_bundles_attribs, orientation=None,
+                          save_full_vc=False, save_full_ic=False,
+                          save_full_nc=False, save_IBs=False, save_VBs=False,
+                          force=False, verbose=False, gt_data=None,
+                          gt_cache_dir=None, profile=False,
+                          checkpoint=False, resume=False, max_memory=None,
+                          allow_smaller_chunks=False):
+    """
+    Score a single tractogram and save its scores to
+    OUT_DIR/scores/<name>.json. Segmented files are saved to
+    OUT_DIR/segmented if requested. If profile is True, the profile of the
+    scoring is saved to OUT_DIR/scores/<name>_profile.json.
+
+    If checkpoint is True, checkpoints are saved to OUT_DIR/checkpoints/<name>
+    during the scoring, and removed once the scores are saved. If resume is
+    True, the scoring restarts from those checkpoints, and the tractogram is
+    skipped if its scores already exist.
+
+    If max_memory is set, it is the memory budget of the scoring, in bytes.
+    If a single chunk of the VC extraction does not fit, the scoring fails,
+    unless allow_smaller_chunks is True.
+
+    Returns
+    ---------
+    scores_filename : string
+        path of the saved scores.
+    """
+    save_segments = save_full_vc or save_full_ic or save_full_nc or \
+        save_IBs or save_VBs
+
+    if resume:
+        scores_filename = get_scores_filename(tractogram, out_dir)
+        if os.path.isfile(scores_filename):
+            logging.info('Scores of {0} already exist, skipping.'.format(
+                tractogram))
+            return scores_filename
+
+    # When resuming, segmented files of the interrupted run are overwritten.
+    scores_filename, segments_dir, base_name = \
+        prepare_output_paths(tractogram, out_dir, save_segments,
+                             force or resume)
+
+    checkpoint_dir = None
+    if checkpoint or resume:
+        checkpoint_dir = get_checkpoint_dir(tractogram, out_dir)
+
+    tract_attribute = get_tracts_attributes(tractogram, orientation)
+
+    profiler = Profiler() if profile else None
+
+    try:
+        scores = score_submission(tractogram, tract_attribute,
+                                  base_dir, basic_bundles_attribs,
+                                  save_full_vc, save_full_ic, save_full_nc,
+                                  save_IBs, save_VBs,
+                                  segments_dir, base_name, verbose,
+                                  gt_cache_dir=gt_cache_dir,
+                                  gt_data=gt_data,
+                                  profiler=profiler,
+                                  checkpoint_dir=checkpoint_dir,
+                                  resume=resume,
+                                  max_memory=max_memory,
+                                  allow_smaller_chunks=allow_smaller_chunks)
+    finally:
+        if profiler is not None:
+            save_profile(scores_filename, profiler)
+
+    save_results(scores_filename, scores)
+
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+    return scores_filename
+
+
+def _init_batch_worker(gt_data):
+    global _WORKER_GT_DATA
+    _WORKER_GT_DATA = gt_data
+
+
+def _score_batch_item(args):
+    tractogram, kwargs = args
+    try:
+        return tractogram, score_tractogram_file(tractogram,
+                                                 gt_data=_WORKER_GT_DATA,
+                                                 **kwargs), None
+    except Exception as e:
+        logging.exception('Failed to score {0}'.format(tractogram))
+        return tractogram, None, str(e)
+
+
+def score_tractograms(tractograms, gt_data, nb_processes=1, **kwargs):
+    """
+    Score many tractograms using the same prepared GT data.
+
+    Parameters
+    ------------
+    tractograms : list of strings
+        paths of the tractograms to score.
+    gt_data : tuple
+        prepared GT data, as returned by prepare_gt_data.
+    nb_processes : int
+        number of worker processes. If 1, everything is scored in the
+        current process.
+    kwargs : dict
+        other arguments sent to score_tractogram_file.
+
+    Returns
+    ---------
+    results : list
+        list of (tractogram, scores filename, error message) in the same
+        order as tractograms. The error message is None on success.
+    """
+    tasks = [(t, kwargs) for t in tractograms]
+
+    if nb_processes <= 1 or len(tractograms) <= 1:
+        _init_batch_worker(gt_data)
+        return [_score_batch_item(t) for t in tasks]
+
+    pool = multiprocessing.Pool(nb_processes,
+                                initializer=_init_batch_worker,
+                                initargs=(gt_data,))
+    try:
+        results = pool.map(_score_batch_item, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import logging
+import os
+
+from challenge_scoring.benchmark.phantom import PHANTOM_INFO_FNAME, \
+    generate_phantom, generate_submission, load_phantom_info
+from challenge_scoring.benchmark.runner import REPORT_VERSION, STAGES, \
+    compare_reports, get_environment_info, run_benchmark
+from challenge_scoring.utils.filenames import mkdir
+from challenge_scoring.utils.json_formatter import load_dict_from_json_file, \
+                                                   save_dict_to_json_file
+
+
+DESCRIPTION = """
+    Benchmark the scoring system on synthetic data.
+
+    A phantom is generated in WORK_DIR/phantom, with the same layout as the
+    scoring data: ROI masks, GT bundles, bundle masks and
+    gt_bundles_attributes.json. A synthetic submission is then generated for
+    each requested size, in WORK_DIR/submissions. Generated data is reused by
+    later runs with the same seed, unless -f is used.
+
+    Each stage of the scoring (loading, GT preparation, VC extraction, length
+    filtering, IC clustering, coverage scoring and saving) is run and timed
+    separately. The wall time, CPU time, peak memory and throughput of each
+    stage are saved to a JSON report, which can be compared to the report of
+    another commit using --compare.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('work_dir', action='store',
+                   metavar='WORK_DIR', type=str,
+                   help='directory where the synthetic data and outputs '
+                        'are saved')
+
+    p.add_argument('--sizes', action='store', type=int, nargs='+',
+                   default=[10000, 100000], metavar='N',
+                   help='number of streamlines of each benchmarked '
+                        'submission.\n[%(default)s]')
+
+    p.add_argument('--nb_bundles', action='store', type=int, default=10,
+                   metavar='N',
+                   help='number of GT bundles of the phantom. [%(default)s]')
+
+    p.add_argument('--seed', action='store', type=int, default=0,
+                   help='seed used to generate the synthetic data. '
+                        '[%(default)s]')
+
+    p.add_argument('--processes', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of processes used to extract the VCs. '
+                        '[%(default)s]')
+
+    p.add_argument('--threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used by each process to compute '
+                        'distances\nbetween streamlines. [%(default)s]')
+
+    p.add_argument('--bundle_threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used by each process to extract '
+                        'the GT bundles\nof a chunk at the same time. If '
+                        'larger than 1, --threads is ignored.\n'
+                        '[%(default)s]')
+
+    p.add_argument('--report', action='store', metavar='FILE',
+                   help='path of the JSON report.\n'
+                        '[WORK_DIR/benchmark_report.json]')
+
+    p.add_argument('--compare', action='store', metavar='FILE',
+                   help='report of a previous run to compare with.')
+
+    p.add_argument('-f', dest='force', action='store_true',
+                   required=False, help='regenerate the synthetic data and '
+                                        'overwrite the report')
+    p.add_argument('-v', dest='verbose', action='store_true',
+                   required=False, help='produce verbose output')
+
+    return p
+
+
+def _format_size(nb_bytes):
+    return '{0:.1f} MB'.format(nb_bytes / 2**20)
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if min(args.sizes) < 1:
+        parser.error('--sizes must all be at least 1.')
+
+    if args.processes < 1:
+        parser.error('--processes must be at least 1.')
+
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
+
+    if args.bundle_threads < 1:
+        parser.error('--bundle_threads must be at least 1.')
+
+    if args.compare is not None and not os.path.isfile(args.compare):
+        parser.error('"{0}" must be a file!'.format(args.compare))
+
+    report_fname = args.report or os.path.join(args.work_dir,
+                                               'benchmark_report.json')
+    if os.path.isfile(report_fname) and not args.force:
+        parser.error('Report "{0}" already exists.\nPlease remove or use '
+                     '-f to overwrite.'.format(report_fname))
+
+    phantom_dir = os.path.join(args.work_dir, 'phantom')
+    submissions_dir = mkdir(os.path.join(args.work_dir, 'submissions'))
+    segmented_dir = mkdir(os.path.join(args.work_dir, 'segmented'))
+
+    info = None
+    if os.path.isfile(os.path.join(phantom_dir, PHANTOM_INFO_FNAME)):
+        info = load_phantom_info(phantom_dir)
+
+    regenerate = args.force or info is None or info['seed'] != args.seed or \
+        len(info['bundles']) != args.nb_bundles
+    if regenerate:
+        logging.info('Generating the phantom in {0}'.format(phantom_dir))
+        info = generate_phantom(phantom_dir, nb_bundles=args.nb_bundles,
+                                seed=args.seed)
+
+    report = {'version': REPORT_VERSION,
+              'environment': get_environment_info(),
+              'config': {'nb_bundles': args.nb_bundles,
+                         'seed': args.seed,
+                         'nb_processes': args.processes,
+                         'nb_threads': args.threads,
+                         'nb_bundle_threads': args.bundle_threads},
+              'runs': []}
+
+    for nb_streamlines in sorted(args.sizes):
+        tractogram_fname = os.path.join(
+            submissions_dir,
+            'submission_{0}_{1}.tck'.format(args.seed, nb_streamlines))
+
+        if regenerate or not os.path.isfile(tractogram_fname):
+            logging.info('Generating {0}'.format(tractogram_fname))
+            generate_submission(tractogram_fname, info, nb_streamlines,
+                                seed=args.seed)
+
+        print('Benchmarking {0} streamlines'.format(nb_streamlines))
+        stages, counts, records = run_benchmark(
+            tractogram_fname, phantom_dir, segmented_dir,
+            nb_processes=args.processes, nb_threads=args.threads,
+            nb_bundle_threads=args.bundle_threads)
+
+        report['runs'].append({'nb_streamlines': nb_streamlines,
+                               'stages': stages,
+                               'counts': counts,
+                               'records': records})
+
+        for stage in STAGES + ['total']:
+            # Some stages are skipped, for example when there is no IC.
+            if stage not in stages:
+                continue
+            print('  {0:<22} {1:>10.3f} s  {2:>10.3f} s CPU  {3:>12}'.format(
+                stage, stages[stage]['wall_time'],
+                stages[stage]['cpu_time'],
+                _format_size(stages[stage]['peak_rss'])))
+
+        # Save after each run, to keep the results of the smaller sizes if a
+        # larger one fails.
+        save_dict_to_json_file(report_fname, report)
+
+    print('Report saved to {0}'.format(report_fname))
+
+    if args.compare is not None:
+        old_report = load_dict_from_json_file(args.compare)
+        print('\nComparison with {0} (commit {1})'.format(
+            args.compare, old_report['environment'].get('commit')))
+
+        old_counts = dict((r['nb_streamlines'], r['counts'])
+                          for r in old_report['runs'])
+        for run in report['runs']:
+            old = old_counts.get(run['nb_streamlines'])
+            if old is not None and old != run['counts']:
+                print('  Warning: classification differs for {0} '
+                      'streamlines: {1} != {2}'.format(run['nb_streamlines'],
+                                                       old, run['counts']))
+
+        for nb_streamlines, stage, old_time, new_time, speedup in \
+                compare_reports(old_report, report):
+            print('  {0:>10} {1:<22} {2:>10.3f} s {3:>10.3f} s '
+                  '{4:>7.2f}x'.format(nb_streamlines, stage, old_time,
+                                      new_time, speedup))
+
+
+if __name__ == "__main__":
+    main()
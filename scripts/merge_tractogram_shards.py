@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import logging
+import os
+
+from challenge_scoring.io.partial_results import load_partial_result
+from challenge_scoring.io.results import save_results
+from challenge_scoring.metrics.scoring import merge_submission_shards
+from challenge_scoring.utils.attributes import load_attribs
+from challenge_scoring.utils.profiling import Profiler
+from challenge_scoring.utils.submission import get_tracts_attributes, \
+    prepare_output_paths, save_profile
+
+
+DESCRIPTION = """
+    Score a submission for the ISMRM 2015 tractography challenge from the
+    partial results of its shards, produced by score_tractogram_shard.py.
+
+    The Valid Connections (VC) and Valid Bundles (VB) of all shards are
+    merged, and the remaining steps of the scoring, from the removal of
+    short streamlines to the No Connections (NC), are run on the whole
+    submission. The scores and the segmented files are the same as with
+    score_tractogram.py, and are saved in the same place.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('tractogram', action='store',
+                   metavar='TRACTS', type=str, help='Tractogram file')
+
+    p.add_argument('base_dir', action='store',
+                   metavar='BASE_DIR', type=str,
+                   help='base directory for scoring data.\n'
+                        'See www.tractometer.org/downloads/downloads/'
+                        'scoring_data_tractography_challenge.tar.gz')
+
+    p.add_argument('out_dir',    action='store',
+                   metavar='OUT_DIR',  type=str,
+                   help='directory where to send score files')
+
+    p.add_argument('partials', action='store', nargs='+',
+                   metavar='PARTIAL', type=str,
+                   help='partial results of all shards of the tractogram')
+
+    p.add_argument('--orientation', action='store',
+                   choices=['RAS', 'LPS'],
+                   help='Orientation of the streamlines file. Needed for VTK.')
+
+    p.add_argument('--gt_cache_dir', action='store', metavar='CACHE_DIR',
+                   help='directory where the prepared ground truth data is '
+                        'cached.\nThe cache is rebuilt automatically when '
+                        'the scoring data changes.')
+
+    p.add_argument('--threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used to save the segmented files. '
+                        '[%(default)s]')
+
+    p.add_argument('--profile', action='store_true',
+                   help='save the wall time, CPU time, peak memory and number '
+                        'of streamlines\nof each step of the merge to '
+                        'OUT_DIR/scores/<name>_profile.json')
+
+    p.add_argument('--save_full_vc', action='store_true',
+                   help='save one file containing all VCs')
+    p.add_argument('--save_full_ic', action='store_true',
+                   help='save one file containing all ICs')
+    p.add_argument('--save_full_nc', action='store_true',
+                   help='save one file containing all NCs')
+
+    p.add_argument('--save_ib', action='store_true',
+                   help='save IB independently.')
+    p.add_argument('--save_vb', action='store_true',
+                   help='save VB independently.')
+
+    p.add_argument('-f', dest='force', action='store_true',
+                   required=False, help='overwrite output files')
+    p.add_argument('-v', dest='verbose', action='store_true',
+                   required=False, help='produce verbose output')
+
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    tractogram = args.tractogram
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if not os.path.isfile(tractogram):
+        parser.error('"{0}" must be a file!'.format(tractogram))
+
+    if not os.path.isdir(args.base_dir):
+        parser.error('"{0}" must be a directory!'.format(args.base_dir))
+
+    for partial_fname in args.partials:
+        if not os.path.isfile(partial_fname):
+            parser.error('"{0}" must be a file!'.format(partial_fname))
+
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
+
+    save_segments = args.save_full_vc or args.save_full_ic or \
+        args.save_ib or args.save_vb or args.save_full_nc
+
+    try:
+        scores_filename, segments_dir, base_name = \
+            prepare_output_paths(tractogram, args.out_dir, save_segments,
+                                 args.force)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Basic bundle attributes should be stored in the scoring data directory.
+    gt_bundles_attribs_path = os.path.join(args.base_dir,
+                                           'gt_bundles_attributes.json')
+    if not os.path.isfile(gt_bundles_attribs_path):
+        parser.error('Missing the "gt_bundles_attributes.json" file in the '
+                     'provided base directory.')
+
+    basic_bundles_attribs = load_attribs(gt_bundles_attribs_path)
+
+    # Check and compute orientation attribute for the submitted tractogram
+    try:
+        tract_attribute = get_tracts_attributes(tractogram, args.orientation)
+    except ValueError as e:
+        parser.error(str(e))
+
+    partials = [load_partial_result(f) for f in args.partials]
+
+    profiler = Profiler() if args.profile else None
+
+    try:
+        scores = merge_submission_shards(tractogram, tract_attribute,
+                                         args.base_dir, basic_bundles_attribs,
+                                         partials,
+                                         args.save_full_vc,
+                                         args.save_full_ic,
+                                         args.save_full_nc,
+                                         args.save_ib, args.save_vb,
+                                         segments_dir, base_name,
+                                         args.verbose,
+                                         gt_cache_dir=args.gt_cache_dir,
+                                         nb_threads=args.threads,
+                                         profiler=profiler)
+    finally:
+        if profiler is not None:
+            save_profile(scores_filename, profiler)
+
+    if scores is not None:
+        save_results(scores_filename, scores)
+
+
+if __name__ == "__main__":
+    main()
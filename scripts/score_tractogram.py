@@ -3,16 +3,17 @@
 from __future__ import division
 
 import argparse
-import glob
 import logging
 import os
+import shutil
 
 from challenge_scoring.io.results import save_results
-from challenge_scoring.io.streamlines import format_needs_orientation, \
-    guess_orientation
 from challenge_scoring.metrics.scoring import score_submission
 from challenge_scoring.utils.attributes import load_attribs
-from challenge_scoring.utils.filenames import mkdir
+from challenge_scoring.utils.profiling import Profiler
+from challenge_scoring.utils.submission import get_checkpoint_dir, \
+    get_scores_filename, get_tracts_attributes, parse_memory_size, \
+    prepare_output_paths, save_profile
 
 
 DESCRIPTION = """
@@ -66,6 +67,54 @@ def buildArgsParser():
                    choices=['RAS', 'LPS'],
                    help='Orientation of the streamlines file. Needed for VTK.')
 
+    p.add_argument('--gt_cache_dir', action='store', metavar='CACHE_DIR',
+                   help='directory where the prepared ground truth data is '
+                        'cached.\nThe cache is rebuilt automatically when '
+                        'the scoring data changes.')
+
+    p.add_argument('--processes', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of processes used to extract the VCs. '
+                        '[%(default)s]')
+
+    p.add_argument('--threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used by each process to compute '
+                        'distances\nbetween streamlines. [%(default)s]')
+
+    p.add_argument('--bundle_threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used by each process to extract '
+                        'the GT bundles\nof a chunk at the same time. If '
+                        'larger than 1, --threads is ignored.\n'
+                        '[%(default)s]')
+
+    p.add_argument('--max-memory', action='store', dest='max_memory',
+                   metavar='SIZE',
+                   help='memory budget of the scoring, such as 512M or 8G. '
+                        'Limits the number\nof processes extracting the VCs. '
+                        'The scoring fails if a single chunk\ndoes not fit.')
+
+    p.add_argument('--allow-smaller-chunks', action='store_true',
+                   dest='allow_smaller_chunks',
+                   help='use smaller chunks when a single chunk does not fit '
+                        'in --max-memory,\ninstead of failing. This changes '
+                        'the results. Cannot be used with --resume.')
+
+    p.add_argument('--profile', action='store_true',
+                   help='save the wall time, CPU time, peak memory and number '
+                        'of streamlines\nof each step of the scoring to '
+                        'OUT_DIR/scores/<name>_profile.json')
+
+    p.add_argument('--checkpoint', action='store_true',
+                   help='save checkpoints to OUT_DIR/checkpoints/<name> '
+                        'during the scoring.\nThey are removed once the '
+                        'scores are saved.')
+    p.add_argument('--resume', action='store_true',
+                   help='resume an interrupted scoring from its '
+                        'checkpoints. Implies --checkpoint.\nSegmented '
+                        'files of the interrupted scoring are overwritten.')
+
     p.add_argument('--save_full_vc', action='store_true',
                    help='save one file containing all VCs')
     p.add_argument('--save_full_ic', action='store_true',
@@ -103,40 +152,44 @@ def main():
     if not os.path.isdir(base_dir):
         parser.error('"{0}" must be a directory!'.format(base_dir))
 
-    out_dir = mkdir(out_dir + "/").replace("//", "/")
-    scores_dir = mkdir(os.path.join(out_dir, "scores"))
-    scores_filename = os.path.join(scores_dir,
-                                   os.path.splitext(os.path.basename(tractogram))[0]
-                                   + ".json")
-
-    score_exists = False
-    segmented_files = []
-
-    # Check if some results already exist
-    if os.path.isfile(scores_filename):
-        score_exists = True
-
-    segments_dir = ''
-    base_name = ''
-
-    if args.save_full_vc or args.save_full_ic or args.save_ib or args.save_vb \
-        or args.save_full_nc:
-        segments_dir = mkdir(os.path.join(out_dir, "segmented"))
-        base_name = os.path.splitext(os.path.basename(tractogram))[0]
-
-        segmented_files = glob.glob(os.path.join(segments_dir,
-                                                 base_name + '*.tck'))
-
-    if score_exists or len(segmented_files):
-        if not args.force:
-            parser.error(
-                'Scores file or segmented files already exist.'
-                '\nPlease remove or use -f to overwrite.')
-        else:
-            if score_exists:
-                os.remove(scores_filename)
-            for f in segmented_files:
-                os.remove(f)
+    if args.processes < 1:
+        parser.error('--processes must be at least 1.')
+
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
+
+    if args.bundle_threads < 1:
+        parser.error('--bundle_threads must be at least 1.')
+
+    max_memory = None
+    if args.max_memory is not None:
+        try:
+            max_memory = parse_memory_size(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.allow_smaller_chunks and args.resume:
+        parser.error('--allow-smaller-chunks cannot be used with --resume.')
+
+    save_segments = args.save_full_vc or args.save_full_ic or \
+        args.save_ib or args.save_vb or args.save_full_nc
+
+    if args.resume and os.path.isfile(get_scores_filename(tractogram,
+                                                          out_dir)):
+        print('Scores already exist, nothing to resume.')
+        return
+
+    # When resuming, segmented files of the interrupted run are overwritten.
+    try:
+        scores_filename, segments_dir, base_name = \
+            prepare_output_paths(tractogram, out_dir, save_segments,
+                                 args.force or args.resume)
+    except ValueError as e:
+        parser.error(str(e))
+
+    checkpoint_dir = None
+    if args.checkpoint or args.resume:
+        checkpoint_dir = get_checkpoint_dir(tractogram, out_dir)
 
     # Basic bundle attributes should be stored in the scoring data directory.
     gt_bundles_attribs_path = os.path.join(args.base_dir,
@@ -148,28 +201,42 @@ def main():
     basic_bundles_attribs = load_attribs(gt_bundles_attribs_path)
 
     # Check and compute orientation attribute for the submitted tractogram
-    tract_attribute = {'orientation': 'unknown'}
-    if format_needs_orientation(tractogram):
-        if not args.orientation:
-            parser.error('--orientation is needed for your tractogram format')
-        tract_attribute['orientation'] = args.orientation
-    else:
-        if args.orientation:
-            logging.warn('--orientation was provided but not needed. '
-                         'Will be discarded.')
-        tract_attribute['orientation'] = guess_orientation(tractogram)
-
-    scores = score_submission(tractogram, tract_attribute,
-                              base_dir, basic_bundles_attribs,
-                              args.save_full_vc,
-                              args.save_full_ic,
-                              args.save_full_nc,
-                              args.save_ib, args.save_vb,
-                              segments_dir, base_name, args.verbose)
+    try:
+        tract_attribute = get_tracts_attributes(tractogram, args.orientation)
+    except ValueError as e:
+        parser.error(str(e))
+
+    profiler = Profiler() if args.profile else None
+
+    # The profile is also saved when the scoring fails, to find the step
+    # that failed.
+    try:
+        scores = score_submission(tractogram, tract_attribute,
+                                  base_dir, basic_bundles_attribs,
+                                  args.save_full_vc,
+                                  args.save_full_ic,
+                                  args.save_full_nc,
+                                  args.save_ib, args.save_vb,
+                                  segments_dir, base_name, args.verbose,
+                                  gt_cache_dir=args.gt_cache_dir,
+                                  nb_processes=args.processes,
+                                  nb_threads=args.threads,
+                                  profiler=profiler,
+                                  checkpoint_dir=checkpoint_dir,
+                                  resume=args.resume,
+                                  max_memory=max_memory,
+                                  nb_bundle_threads=args.bundle_threads,
+                                  allow_smaller_chunks=args.allow_smaller_chunks)
+    finally:
+        if profiler is not None:
+            save_profile(scores_filename, profiler)
 
     if scores is not None:
         save_results(scores_filename, scores)
 
+        if checkpoint_dir is not None:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import logging
+import os
+
+from challenge_scoring.io.partial_results import save_partial_result
+from challenge_scoring.metrics.scoring import score_submission_shard
+from challenge_scoring.utils.attributes import load_attribs
+from challenge_scoring.utils.submission import get_tracts_attributes, \
+    parse_memory_size
+
+
+DESCRIPTION = """
+    Extract the Valid Connections (VC) of a shard of a submission for the
+    ISMRM 2015 tractography challenge.
+
+    For very large tractograms, the streamlines are split in NB_SHARDS
+    ranges of consecutive streamlines, and the VCs of each range are
+    extracted separately, for example on different machines. Each shard
+    saves a partial result, and the partial results of all shards are then
+    merged by merge_tractogram_shards.py, which produces the same scores as
+    score_tractogram.py.
+
+    All shards must be run with the same tractogram, scoring data and
+    NB_SHARDS.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('tractogram', action='store',
+                   metavar='TRACTS', type=str, help='Tractogram file')
+
+    p.add_argument('base_dir', action='store',
+                   metavar='BASE_DIR', type=str,
+                   help='base directory for scoring data.\n'
+                        'See www.tractometer.org/downloads/downloads/'
+                        'scoring_data_tractography_challenge.tar.gz')
+
+    p.add_argument('out_file', action='store',
+                   metavar='OUT_FILE', type=str,
+                   help='npz file where the partial result of the shard is '
+                        'saved')
+
+    p.add_argument('--shard', action='store', type=int, nargs=2,
+                   required=True, metavar=('INDEX', 'NB_SHARDS'),
+                   help='index of the shard, from 0 to NB_SHARDS - 1, and '
+                        'number of shards')
+
+    p.add_argument('--orientation', action='store',
+                   choices=['RAS', 'LPS'],
+                   help='Orientation of the streamlines file. Needed for VTK.')
+
+    p.add_argument('--gt_cache_dir', action='store', metavar='CACHE_DIR',
+                   help='directory where the prepared ground truth data is '
+                        'cached.\nThe cache is rebuilt automatically when '
+                        'the scoring data changes.')
+
+    p.add_argument('--processes', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of processes used to extract the VCs. '
+                        '[%(default)s]')
+
+    p.add_argument('--threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used by each process to compute '
+                        'distances\nbetween streamlines. [%(default)s]')
+
+    p.add_argument('--bundle_threads', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of threads used by each process to extract '
+                        'the GT bundles\nof a chunk at the same time. If '
+                        'larger than 1, --threads is ignored.\n'
+                        '[%(default)s]')
+
+    p.add_argument('--max-memory', action='store', dest='max_memory',
+                   metavar='SIZE',
+                   help='memory budget of the shard, such as 512M or 8G. '
+                        'Limits the number\nof processes extracting the VCs. '
+                        'The shard fails if a single chunk\ndoes not fit.')
+
+    p.add_argument('-f', dest='force', action='store_true',
+                   required=False, help='overwrite output files')
+    p.add_argument('-v', dest='verbose', action='store_true',
+                   required=False, help='produce verbose output')
+
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if not os.path.isfile(args.tractogram):
+        parser.error('"{0}" must be a file!'.format(args.tractogram))
+
+    if not os.path.isdir(args.base_dir):
+        parser.error('"{0}" must be a directory!'.format(args.base_dir))
+
+    if os.path.isfile(args.out_file) and not args.force:
+        parser.error('"{0}" already exists.\nPlease remove or use -f to '
+                     'overwrite.'.format(args.out_file))
+
+    shard_index, nb_shards = args.shard
+    if nb_shards < 1 or not 0 <= shard_index < nb_shards:
+        parser.error('--shard INDEX must be between 0 and NB_SHARDS - 1.')
+
+    if args.processes < 1:
+        parser.error('--processes must be at least 1.')
+
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
+
+    if args.bundle_threads < 1:
+        parser.error('--bundle_threads must be at least 1.')
+
+    max_memory = None
+    if args.max_memory is not None:
+        try:
+            max_memory = parse_memory_size(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # Basic bundle attributes should be stored in the scoring data directory.
+    gt_bundles_attribs_path = os.path.join(args.base_dir,
+                                           'gt_bundles_attributes.json')
+    if not os.path.isfile(gt_bundles_attribs_path):
+        parser.error('Missing the "gt_bundles_attributes.json" file in the '
+                     'provided base directory.')
+
+    basic_bundles_attribs = load_attribs(gt_bundles_attribs_path)
+
+    # Check and compute orientation attribute for the submitted tractogram
+    try:
+        tract_attribute = get_tracts_attributes(args.tractogram,
+                                                args.orientation)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        partial = score_submission_shard(args.tractogram, tract_attribute,
+                                         args.base_dir, basic_bundles_attribs,
+                                         shard_index, nb_shards, args.verbose,
+                                         gt_cache_dir=args.gt_cache_dir,
+                                         nb_processes=args.processes,
+                                         nb_threads=args.threads,
+                                         max_memory=max_memory,
+                                         nb_bundle_threads=args.bundle_threads)
+    except ValueError as e:
+        parser.error(str(e))
+
+    save_partial_result(args.out_file, partial)
+
+
+if __name__ == "__main__":
+    main()
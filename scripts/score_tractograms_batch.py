@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import logging
+import os
+import sys
+
+from challenge_scoring.metrics.scoring import prepare_gt_data
+from challenge_scoring.utils.attributes import load_attribs
+from challenge_scoring.utils.filenames import mkdir
+from challenge_scoring.utils.submission import expand_tractogram_inputs, \
+    parse_memory_size, score_tractograms
+
+
+DESCRIPTION = """
+    Score many submissions for the ISMRM 2015 tractography challenge.
+
+    The ground truth data is loaded and prepared only once, and the
+    submissions are then scored by a pool of worker processes.
+
+    Each submission produces the same outputs as score_tractogram.py:
+    OUT_DIR/scores/<name>.json and, if requested, segmented files in
+    OUT_DIR/segmented.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('tractograms', action='store', nargs='+',
+                   metavar='TRACTS', type=str,
+                   help='Tractogram files, glob patterns or directories '
+                        'containing tractograms')
+
+    p.add_argument('base_dir', action='store',
+                   metavar='BASE_DIR', type=str,
+                   help='base directory for scoring data.\n'
+                        'See www.tractometer.org/downloads/downloads/'
+                        'scoring_data_tractography_challenge.tar.gz')
+
+    p.add_argument('out_dir',    action='store',
+                   metavar='OUT_DIR',  type=str,
+                   help='directory where to send score files')
+
+    p.add_argument('--orientation', action='store',
+                   choices=['RAS', 'LPS'],
+                   help='Orientation of the streamlines files. Needed for VTK.')
+
+    p.add_argument('--processes', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of worker processes used to score the '
+                        'tractograms. [%(default)s]')
+
+    p.add_argument('--gt_cache_dir', action='store', metavar='CACHE_DIR',
+                   help='directory where the prepared ground truth data is '
+                        'cached.\nThe cache is rebuilt automatically when '
+                        'the scoring data changes.')
+
+    p.add_argument('--max-memory', action='store', dest='max_memory',
+                   metavar='SIZE',
+                   help='memory budget of the whole batch, such as 16G. It '
+                        'is shared equally\nby the worker processes.')
+
+    p.add_argument('--allow-smaller-chunks', action='store_true',
+                   dest='allow_smaller_chunks',
+                   help='use smaller chunks when a single chunk does not fit '
+                        'in --max-memory,\ninstead of failing. This changes '
+                        'the results. Cannot be used with --resume.')
+
+    p.add_argument('--profile', action='store_true',
+                   help='save the profile of the scoring of each tractogram '
+                        'to\nOUT_DIR/scores/<name>_profile.json')
+
+    p.add_argument('--checkpoint', action='store_true',
+                   help='save checkpoints to OUT_DIR/checkpoints/<name> '
+                        'during the scoring.\nThey are removed once the '
+                        'scores are saved.')
+    p.add_argument('--resume', action='store_true',
+                   help='resume an interrupted batch. Tractograms that '
+                        'already have scores are\nskipped, and the '
+                        'others restart from their checkpoints.\n'
+                        'Implies --checkpoint.')
+
+    p.add_argument('--save_full_vc', action='store_true',
+                   help='save one file containing all VCs')
+    p.add_argument('--save_full_ic', action='store_true',
+                   help='save one file containing all ICs')
+    p.add_argument('--save_full_nc', action='store_true',
+                   help='save one file containing all NCs')
+
+    p.add_argument('--save_ib', action='store_true',
+                   help='save IB independently.')
+    p.add_argument('--save_vb', action='store_true',
+                   help='save VB independently.')
+
+    p.add_argument('-f', dest='force', action='store_true',
+                   required=False, help='overwrite output files')
+    p.add_argument('-v', dest='verbose', action='store_true',
+                   required=False, help='produce verbose output')
+
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if not os.path.isdir(args.base_dir):
+        parser.error('"{0}" must be a directory!'.format(args.base_dir))
+
+    if args.processes < 1:
+        parser.error('--processes must be at least 1.')
+
+    if args.allow_smaller_chunks and args.resume:
+        parser.error('--allow-smaller-chunks cannot be used with --resume.')
+
+    max_memory = None
+    if args.max_memory is not None:
+        try:
+            max_memory = parse_memory_size(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+
+    try:
+        tractograms = expand_tractogram_inputs(args.tractograms)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not len(tractograms):
+        parser.error('No tractogram found in the provided inputs.')
+
+    for tractogram in tractograms:
+        if not os.path.isfile(tractogram):
+            parser.error('"{0}" must be a file!'.format(tractogram))
+
+    # Basic bundle attributes should be stored in the scoring data directory.
+    gt_bundles_attribs_path = os.path.join(args.base_dir,
+                                           'gt_bundles_attributes.json')
+    if not os.path.isfile(gt_bundles_attribs_path):
+        parser.error('Missing the "gt_bundles_attributes.json" file in the '
+                     'provided base directory.')
+
+    basic_bundles_attribs = load_attribs(gt_bundles_attribs_path)
+
+    # Create the output directories before starting the workers, to avoid
+    # races between them.
+    mkdir(os.path.join(args.out_dir, "scores"))
+    if args.save_full_vc or args.save_full_ic or args.save_ib or \
+            args.save_vb or args.save_full_nc:
+        mkdir(os.path.join(args.out_dir, "segmented"))
+
+    logging.debug('Preparing GT data')
+    gt_data = prepare_gt_data(args.base_dir, basic_bundles_attribs,
+                              args.gt_cache_dir)
+
+    # Each worker process scores one tractogram at a time.
+    if max_memory is not None:
+        max_memory //= min(args.processes, len(tractograms))
+
+    results = score_tractograms(tractograms, gt_data,
+                                nb_processes=args.processes,
+                                base_dir=args.base_dir,
+                                out_dir=args.out_dir,
+                                basic_bundles_attribs=basic_bundles_attribs,
+                                orientation=args.orientation,
+                                save_full_vc=args.save_full_vc,
+                                save_full_ic=args.save_full_ic,
+                                save_full_nc=args.save_full_nc,
+                                save_IBs=args.save_ib,
+                                save_VBs=args.save_vb,
+                                force=args.force,
+                                verbose=args.verbose,
+                                profile=args.profile,
+                                checkpoint=args.checkpoint,
+                                resume=args.resume,
+                                max_memory=max_memory,
+                                allow_smaller_chunks=args.allow_smaller_chunks)
+
+    failures = [(t, err) for t, _, err in results if err is not None]
+    for tractogram, err in failures:
+        print('Failed to score {0}: {1}'.format(tractogram, err))
+
+    print('Scored {0} of {1} tractograms.'.format(
+        len(results) - len(failures), len(results)))
+
+    if len(failures):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
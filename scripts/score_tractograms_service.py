@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+from __future__ import division
+
+import argparse
+import logging
+import os
+
+from challenge_scoring.metrics.scoring import prepare_gt_data
+from challenge_scoring.utils.attributes import load_attribs
+from challenge_scoring.utils.filenames import mkdir
+from challenge_scoring.utils.service import ScoringService, \
+    serve_scoring_service
+from challenge_scoring.utils.submission import parse_memory_size
+
+
+DESCRIPTION = """
+    Run a scoring service for the ISMRM 2015 tractography challenge.
+
+    The ground truth data is loaded and prepared once, and submissions are
+    then scored on request, without paying for the startup of the scoring
+    and the preparation of the GT for each submission. Jobs are queued and
+    scored by a pool of worker processes.
+
+    The service is reached over HTTP:
+        POST /jobs       queue a job. The body is a JSON object such as
+                         {"tractogram": "/path/to/submission.tck"}, with
+                         optionally "orientation", "save_full_vc",
+                         "save_full_ic", "save_full_nc", "save_IBs" and
+                         "save_VBs".
+        GET /jobs        status of all jobs.
+        GET /jobs/<id>   status of a job, with its scores once it is done.
+
+    Each job produces the same outputs as score_tractogram.py in
+    OUT_DIR/<job id>.
+"""
+
+
+def buildArgsParser():
+    p = argparse.ArgumentParser(description=DESCRIPTION,
+                                formatter_class=argparse.RawTextHelpFormatter)
+
+    p.add_argument('base_dir', action='store',
+                   metavar='BASE_DIR', type=str,
+                   help='base directory for scoring data.\n'
+                        'See www.tractometer.org/downloads/downloads/'
+                        'scoring_data_tractography_challenge.tar.gz')
+
+    p.add_argument('out_dir',    action='store',
+                   metavar='OUT_DIR',  type=str,
+                   help='directory where to send the outputs of the jobs')
+
+    p.add_argument('--host', action='store', default='127.0.0.1',
+                   help='address on which the service listens. '
+                        '[%(default)s]')
+    p.add_argument('--port', action='store', type=int, default=8000,
+                   help='port on which the service listens. [%(default)s]')
+
+    p.add_argument('--processes', action='store', type=int, default=1,
+                   metavar='N',
+                   help='number of tractograms scored at the same time. '
+                        'Other jobs are\nqueued. [%(default)s]')
+
+    p.add_argument('--gt_cache_dir', action='store', metavar='CACHE_DIR',
+                   help='directory where the prepared ground truth data is '
+                        'cached.\nThe cache is rebuilt automatically when '
+                        'the scoring data changes.')
+
+    p.add_argument('--max-memory', action='store', dest='max_memory',
+                   metavar='SIZE',
+                   help='memory budget of the whole service, such as 16G. '
+                        'It is shared\nequally by the worker processes.')
+
+    p.add_argument('--allow-smaller-chunks', action='store_true',
+                   dest='allow_smaller_chunks',
+                   help='use smaller chunks when a single chunk does not fit '
+                        'in --max-memory,\ninstead of failing. This changes '
+                        'the results.')
+
+    p.add_argument('--profile', action='store_true',
+                   help='save the profile of the scoring of each job to\n'
+                        'OUT_DIR/<job id>/scores/<name>_profile.json')
+
+    p.add_argument('-v', dest='verbose', action='store_true',
+                   required=False, help='produce verbose output')
+
+    return p
+
+
+def main():
+    parser = buildArgsParser()
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+                        else logging.INFO)
+
+    if not os.path.isdir(args.base_dir):
+        parser.error('"{0}" must be a directory!'.format(args.base_dir))
+
+    if args.processes < 1:
+        parser.error('--processes must be at least 1.')
+
+    max_memory = None
+    if args.max_memory is not None:
+        try:
+            max_memory = parse_memory_size(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # Basic bundle attributes should be stored in the scoring data directory.
+    gt_bundles_attribs_path = os.path.join(args.base_dir,
+                                           'gt_bundles_attributes.json')
+    if not os.path.isfile(gt_bundles_attribs_path):
+        parser.error('Missing the "gt_bundles_attributes.json" file in the '
+                     'provided base directory.')
+
+    basic_bundles_attribs = load_attribs(gt_bundles_attribs_path)
+
+    mkdir(args.out_dir)
+
+    logging.info('Preparing GT data')
+    gt_data = prepare_gt_data(args.base_dir, basic_bundles_attribs,
+                              args.gt_cache_dir)
+
+    # Each worker process scores one tractogram at a time.
+    if max_memory is not None:
+        max_memory //= args.processes
+
+    service = ScoringService(gt_data, args.base_dir, basic_bundles_attribs,
+                             os.path.abspath(args.out_dir),
+                             nb_processes=args.processes,
+                             verbose=args.verbose,
+                             profile=args.profile,
+                             max_memory=max_memory,
+                             allow_smaller_chunks=args.allow_smaller_chunks)
+
+    try:
+        serve_scoring_service(service, args.host, args.port)
+    except KeyboardInterrupt:
+        logging.info('Stopping the scoring service')
+        service.close(wait=False)
+    else:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
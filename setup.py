@@ -49,7 +49,17 @@ ext_modules.append(Extension('challenge_scoring.tractanalysis.robust_streamlines
                                            os.path.join(
                                                os.path.dirname(
                                                    os.path.realpath(__file__)),
-                                               'challenge_scoring/c_src')]))
+                                               'challenge_scoring/c_src')],
+                             extra_compile_args=['-fopenmp'],
+                             extra_link_args=['-fopenmp']))
+ext_modules.append(Extension('challenge_scoring.tractanalysis.streamlines_distances',
+                             ['challenge_scoring/tractanalysis/streamlines_distances.pyx'],
+                             include_dirs=[numpy.get_include()],
+                             extra_compile_args=['-fopenmp'],
+                             extra_link_args=['-fopenmp']))
+ext_modules.append(Extension('challenge_scoring.tractanalysis.quickbundles',
+                             ['challenge_scoring/tractanalysis/quickbundles.pyx'],
+                             include_dirs=[numpy.get_include()]))
 
 dependencies = ['dipy', 'nibabel']
 